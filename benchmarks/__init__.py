@@ -0,0 +1,9 @@
+"""Benchmarks for the Go Redirector.
+
+Run these from the project root so go.cfg is found, e.g.:
+
+    python -m benchmarks.bench_regex
+
+bench_suite runs the standard set over a database from generate.py and
+saves the results as JSON, so runs can be compared with --compare.
+"""
@@ -0,0 +1,45 @@
+"""Revalidating pages instead of rendering them again.
+
+For the biggest list page, /toplinks and /special over a generated
+database, times a full render against a request that sends back the
+ETag it was given and gets a 304.
+"""
+
+import timeit
+
+import cherrypy
+
+import core
+import go
+from benchmarks.bench_suite import fakeRequest
+from benchmarks.generate import makeDatabase
+
+
+def perCall(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number
+
+
+def main(nlinks=10000):
+    db = core.MYGLOBALS.g_db = makeDatabase(nlinks)
+    root = go.Root()
+    biggest = max(db.lists.values(), key=lambda LL: len(LL.links))
+
+    print "%-28s %14s %14s" % ("", "render (ms)", "304 (ms)")
+    for label, path, handler, args in (("list page (%d links)" % len(biggest.links), "/." + biggest.name,
+                                        root.default, ("." + biggest.name,)),
+                                       ("toplinks", "/toplinks", root.toplinks, ()),
+                                       ("special", "/special", root.special, ())):
+        def get(etag=None):
+            fakeRequest(path)
+            if etag:
+                cherrypy.request.headers["If-None-Match"] = etag
+            return handler(*args)
+
+        get()
+        etag = cherrypy.response.headers["ETag"]
+        assert get(etag) == "" and cherrypy.response.status == 304
+        print "%-28s %14.3f %14.3f" % (label, perCall(get, 5) * 1e3, perCall(lambda: get(etag), 1000) * 1e3)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Splitting a long list into its recent edits and the rest.
+
+Builds one list of 10k links, a few of them edited within the last day,
+and times ListOfLinks.getLinks whole and with a limit, against the way it
+used to do it: every link's lastEdit() looked at, then each recent link
+removed from the full popularity order by a linear search.
+"""
+
+import time
+import timeit
+
+import core
+
+
+def oldGetLinks(LL, nDaysOfRecentEdits=1):
+    earliestRecentEdit = time.time() - nDaysOfRecentEdits * 24 * 3600
+
+    recent = [x for x in LL.links if x.lastEdit()[0] > earliestRecentEdit]
+    popular = LL.getPopularLinks()
+
+    for L in recent:
+        if L in popular:
+            popular.remove(L)
+
+    return recent, popular
+
+
+def perCall(fn, number=20, repeat=3):
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def main(nlinks=10000, nrecent=50, limit=100):
+    db = core.LinkDatabase()
+    for i in range(nlinks):
+        db.addLink(["long"], "http://example.com/long/%d" % i, "long %d" % i, "user", when=1500000000 + i)
+    LL = db.getList("long")
+    for i, L in enumerate(LL.links[::nlinks // nrecent]):
+        L.editedBy("editor", time.time() - 3600 - i)
+        L.clicked(i)
+
+    recent, popular = LL.getLinks()
+    old = oldGetLinks(LL)
+    assert (set(recent), popular) == (set(old[0]), old[1]) and len(recent) == nrecent
+
+    print "%d links, %d edited in the last day" % (nlinks, nrecent)
+    print "%-32s %10.1f us" % ("before: whole list", perCall(lambda: oldGetLinks(LL)) * 1e6)
+    print "%-32s %10.1f us" % ("getLinks()", perCall(lambda: LL.getLinks()) * 1e6)
+    print "%-32s %10.1f us" % ("getLinks(limit=%d)" % limit, perCall(lambda: LL.getLinks(limit=limit), 1000) * 1e6)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Round trip of a large synthetic export through go.py -i and -e.
+
+Writes an export of n links spread over about n/4 small lists and a few
+long ones, with click data and edits on every link, imports it into an
+empty database, exports that again and checks nothing was lost on the
+way.
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import core
+
+
+def writeExport(fn, nlinks, seed=0):
+    rnd = random.Random(seed)
+    nlists = max(1, nlinks // 4)
+    today = 737000
+    with open(fn, "w") as f:
+        f.write("variable project go\n")
+        for i in range(nlinks):
+            # a few lists per cluster; pickle recurses through connected links
+            kw = i // 4
+            lists = set(["kw%d" % kw, "kw%d" % (kw ^ rnd.randint(0, 3))])
+            if i % 10 == 0:
+                lists.add("big%d" % (i % 7))  # and a few very long lists
+            lists = "||".join(sorted(lists))
+            clicks = ",".join("%d:%d" % (today - d, rnd.randint(1, 50)) for d in range(rnd.randint(0, 5)))
+            f.write("link http://example.com/%d/%d %s %d,{%s} %d/user%d link number %d\n"
+                    % (i, rnd.randrange(10 ** 6), lists, rnd.randint(0, 1000), clicks,
+                       1500000000 + i, i % 100, i))
+        for i in range(0, nlists, 10):
+            f.write("list kw%d link top None 0,{} None\n" % i)
+
+
+def timeIt(fn, *args):
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+
+def main(nlinks=200000):
+    tmpdir = tempfile.mkdtemp(prefix="go-import-")
+    try:
+        core.cfg_fnDatabase = os.path.join(tmpdir, "godb.pickle")
+        src = os.path.join(tmpdir, "export.txt")
+        out = os.path.join(tmpdir, "reexport.txt")
+        writeExport(src, nlinks)
+        rows = sum(1 for _ in open(src))
+
+        db = core.LinkDatabase()
+        tImport = timeIt(db._import, src)
+        tExport = timeIt(db._export, out)
+
+        assert len(db.linksById) == nlinks
+        assert sum(1 for _ in open(out)) == 1 + nlinks + len(db.lists)
+
+        print
+        print "%8s %10s %10s %12s" % ("rows", "", "seconds", "rows/s")
+        print "%8d %10s %10.2f %12.0f" % (rows, "import", tImport, rows / tImport)
+        print "%8d %10s %10.2f %12.0f" % (rows, "export", tExport, rows / tExport)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,77 @@
+"""Completing and correcting keywords among many.
+
+Builds a KeywordIndex over 100k made-up keywords (letters as often as
+in English, some with a common word in front, so they share trigrams
+much as real keywords do) and times a
+prefix completion and a near-miss search for typos of existing keywords,
+against the scan of every list name that would otherwise be needed.
+"""
+
+import random
+import time
+import timeit
+
+import core
+import tools
+
+# letters about as often as in English, and some words keywords are made of
+_letters = "".join(c * n for c, n in zip("etaoinsrhldcumfpgwybvkxjqz",
+                                         (13, 9, 8, 8, 7, 7, 6, 6, 6, 4, 4, 3, 3, 2, 2, 2, 2, 2, 2, 1, 1, 1, 1, 1, 1, 1)))
+_words = "wiki docs jira git bug build test dev ops team plan api web mail cal hr it".split()
+
+
+def makeKeywords(n, rnd):
+    names = set()
+    while len(names) < n:
+        name = "".join(rnd.choice(_letters) for _ in range(rnd.randint(3, 9)))
+        if rnd.random() < 0.3:  # some are two parts, like team-wiki
+            name = rnd.choice(_words) + rnd.choice(("", "-")) + name
+        names.add(name)
+    return sorted(names)
+
+
+def typo(name, rnd):
+    i = rnd.randrange(len(name))
+    return name[:i] + rnd.choice("abcdefghijklmnopqrstuvwxyz") + name[i + 1:]
+
+
+def perCall(fn, args):
+    best = None
+    for _ in range(3):
+        start = time.time()
+        for a in args:
+            fn(a)
+        t = (time.time() - start) / len(args)
+        best = t if best is None else min(best, t)
+    return best
+
+
+def main(n=100000, queries=1000, seed=0):
+    rnd = random.Random(seed)
+    names = makeKeywords(n, rnd)
+
+    start = time.time()
+    index = core.KeywordIndex(names)
+    print "%d keywords, %d trigrams, built in %.2f s" % (len(index), len(index.trigrams), time.time() - start)
+
+    prefixes = [rnd.choice(names)[:rnd.randint(1, 5)] for _ in range(queries)]
+    typos = [typo(rnd.choice(names), rnd) for _ in range(queries)]
+    scanned = typos[:10]
+
+    print "%-36s %10.1f us" % ("complete(prefix)", perCall(index.complete, prefixes) * 1e6)
+    print "%-36s %10.1f us" % ("similar(typo, 1)", perCall(lambda kw: index.similar(kw, 1), typos) * 1e6)
+    print "%-36s %10.1f us" % ("similar(typo, 2)", perCall(lambda kw: index.similar(kw, 2), typos) * 1e6)
+    print "%-36s %10.1f us" % ("similar(typo), as suggestKeywords",
+                               perCall(lambda kw: index.similar(kw, 1 if len(kw) <= 10 else 2), typos) * 1e6)
+    print "%-36s %10.1f us" % ("scan every name, 1 edit (before)",
+                               perCall(lambda kw: [x for x in names if tools.editDistance(kw, x, 1) <= 1],
+                                       scanned) * 1e6)
+
+    found = sum(1 for kw in typos if index.similar(kw, 1))
+    print "%d of %d typos had a suggestion" % (found, queries)
+    print "%-36s %10.1f us" % ("add + remove", min(timeit.repeat(lambda: (index.add("zzqq"), index.remove("zzqq")),
+                                                                 number=1000, repeat=3)) / 1000 * 1e6)
+
+
+if __name__ == "__main__":
+    main()
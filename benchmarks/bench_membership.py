@@ -0,0 +1,46 @@
+"""Cost of editing a link in and out of a very long list.
+
+A folder keyword collects thousands of links.  For lists of growing size
+this times moving a link into the list and back out with editLink, as
+_modify_ does, then the same followed by reading the list's links, as the
+list page does, and then deleting a whole list; the edits should cost
+little more for a longer list, and deleting a list what its links number.
+"""
+
+import time
+import timeit
+
+import core
+
+
+def makeDatabase(nlinks):
+    db = core.LinkDatabase()
+    for i in range(nlinks):
+        db.addLink(["big/"], "http://example.com/%d/{*}" % i, "link %d" % i)
+    return db
+
+
+def main(sizes=(1000, 10000, 100000), number=200):
+    print "%8s %16s %16s %16s" % ("links", "edit in+out (us)", "+ links (us)", "delete list (s)")
+    for n in sizes:
+        db = makeDatabase(n)
+        L = db.addLink(["small/"], "http://example.com/moving/{*}", "moving")
+
+        def inAndOut():
+            db.editLink(L, L._url, L.title, ["small/", "big/"], "bench")
+            db.editLink(L, L._url, L.title, ["small/"], "bench")
+        perEdit = min(timeit.repeat(inAndOut, number=number, repeat=3)) / number
+
+        def inAndOutAndRead():
+            inAndOut()
+            db.getList("big/").links
+        perRead = min(timeit.repeat(inAndOutAndRead, number=number, repeat=3)) / number
+        assert db.getList("big/").links[0] is not L and len(db.getList("big/").links) == n
+
+        start = time.time()
+        db.deleteList(db.getList("big/"))
+        print "%8d %16.1f %16.1f %16.3f" % (n, perEdit * 1e6, perRead * 1e6, time.time() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Memory per link, and the cost of pickling it.
+
+Each size is built in a fresh interpreter: n links over n/4 lists, every
+link with two edits and clicks on a few of the last 30 days, as a busy
+database would have.  Resident memory is measured before and after
+building, and the database is then pickled the way snapshot() does.
+"""
+
+import json
+import subprocess
+import sys
+
+_child = r"""
+import json, pickle, random, time
+import core
+
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * %(pagesize)d
+
+n = %(n)d
+rnd = random.Random(0)
+before = rss()
+db = core.LinkDatabase()
+for i in range(n):
+    L = db.addLink("kw%%d" %% (i // 4), "http://example.com/%%d" %% i, "link %%d" %% i, "user%%d" %% (i %% 50))
+    L.editedBy("someone")
+    for day in rnd.sample(range(737000, 737030), rnd.randint(0, 6)):
+        L.clicked(rnd.randint(1, 20), day)
+after = rss()
+
+start = time.time()
+s = pickle.dumps(db)
+dump = time.time() - start
+start = time.time()
+pickle.loads(s)
+load = time.time() - start
+print json.dumps({"bytes": (after - before) / float(n), "pickle": len(s) / float(n), "dump": dump, "load": load})
+"""
+
+
+def measure(n):
+    import resource
+    out = subprocess.check_output([sys.executable, "-c", _child % {"n": n, "pagesize": resource.getpagesize()}],
+                                  stderr=open("/dev/null", "w"))
+    return json.loads(out.splitlines()[-1])
+
+
+def main(sizes=(10000, 100000)):
+    print "%8s %14s %14s %10s %10s" % ("links", "RSS/link (B)", "pickle/link", "dump (s)", "load (s)")
+    for n in sizes:
+        r = measure(n)
+        print "%8d %14.0f %14.0f %10.2f %10.2f" % (n, r["bytes"], r["pickle"], r["dump"], r["load"])
+
+
+if __name__ == "__main__":
+    main()
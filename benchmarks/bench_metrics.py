@@ -0,0 +1,73 @@
+"""What timing every request costs a redirect.
+
+Serves the same redirects through the whole CherryPy request pipeline,
+in process (WSGI, no sockets), from one app with tools.metrics on and one
+with it off, and reports the difference per request.  Also times the
+building blocks on their own: Histogram.observe and timed().
+"""
+
+import StringIO
+import timeit
+
+import cherrypy
+
+import core
+import go
+import metrics
+from benchmarks.generate import makeDatabase
+
+
+def wsgiGet(app, path):
+    path, _, query = path.partition("?")
+    environ = {"REQUEST_METHOD": "GET", "SCRIPT_NAME": "", "PATH_INFO": path, "QUERY_STRING": query,
+               "SERVER_NAME": "localhost", "SERVER_PORT": "80", "SERVER_PROTOCOL": "HTTP/1.1",
+               "HTTP_HOST": "localhost", "REMOTE_ADDR": "127.0.0.1", "REMOTE_PORT": "1234",
+               "wsgi.url_scheme": "http", "wsgi.input": StringIO.StringIO(""),
+               "wsgi.errors": StringIO.StringIO(), "wsgi.multithread": False,
+               "wsgi.multiprocess": False, "wsgi.run_once": False, "wsgi.version": (1, 0)}
+    status = []
+    body = app(environ, lambda s, headers, exc_info=None: status.append(s))
+    "".join(body)
+    if hasattr(body, "close"):
+        body.close()
+    return status[0]
+
+
+def perCall(fn, number, repeat=3):
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def main(nlinks=10000, number=1000):
+    db = core.MYGLOBALS.g_db = makeDatabase(nlinks)
+    keyword = sorted(LL.name for LL in db.lists.values() if LL._url == "freshest" and LL.name.startswith("kw"))[0]
+    cherrypy.config.update({"environment": "embedded", "log.screen": False})
+
+    apps = {}
+    for on in (False, True):
+        apps[on] = cherrypy.Application(go.Root(), config={"/": {"tools.metrics.on": on}})
+    assert wsgiGet(apps[True], "/" + keyword).startswith("307")
+
+    print "%-28s %12s %12s %10s" % ("", "off (us)", "on (us)", "overhead")
+    for label, path, cacheSize in (("redirect, cached", "/" + keyword, 1000),
+                                   ("redirect, uncached", "/" + keyword, 0),
+                                   ("regex, uncached", "/bug7-1234", 0)):
+        go.Root.resolutions = core.tools.LRUCache(cacheSize)
+        times = {False: [], True: []}
+        for _ in range(5):  # alternate, so drift on a busy machine hits both alike
+            for x in (False, True):
+                times[x].append(perCall(lambda: wsgiGet(apps[x], path), number))
+        off, on = min(times[False]), min(times[True])
+        print "%-28s %12.1f %12.1f %+9.1f%%" % (label, off * 1e6, on * 1e6, 100 * (on - off) / off)
+
+    def block():
+        with metrics.timed("bench"):
+            pass
+
+    h = metrics.Histogram("bench_seconds", "scratch")
+    print
+    print "%-28s %12.2f us" % ("Histogram.observe", perCall(lambda: h.observe(0.0003, "x"), 100000) * 1e6)
+    print "%-28s %12.2f us" % ("with timed(...)", perCall(block, 100000) * 1e6)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""Picking a random link, as /lucky and the help page do.
+
+Times LinkDatabase.getRandomLink against the way it used to be done, a
+random.choice from every link filtered by isGenerative() (and usage(),
+for the help page), and adding and deleting a link once the folder
+indexes are built, for databases of growing size.
+"""
+
+import random
+import timeit
+
+from benchmarks.generate import makeDatabase
+
+
+def perCall(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number
+
+
+def main(sizes=(1000, 10000, 100000)):
+    print "%8s %14s %14s %14s %14s %16s" % ("links", "lucky, before", "lucky (us)", "help, before",
+                                            "help (us)", "add+delete (us)")
+    for n in sizes:
+        db = makeDatabase(n)
+        assert db.getRandomLink() in db.getNonFolders()
+
+        # the scans /lucky and the help page used to make on every request
+        before = perCall(lambda: random.choice([x for x in db.linksById.values() if not x.isGenerative()]), 5)
+        beforeHelp = perCall(lambda: random.choice([x for x in db.linksById.values()
+                                                    if not x.isGenerative() and x.usage()]), 1)
+        lucky = perCall(db.getRandomLink, 10000)
+        helpPick = perCall(lambda: db.getRandomLink(usable=True), 10000)
+
+        def addAndDelete():
+            db.deleteLink(db.addLink(["f1/"], "http://example.com/moving/{*}", "moving"))
+        churn = perCall(addAndDelete, 200)
+        print "%8d %14.1f %14.2f %14.1f %14.2f %16.1f" % (n, before * 1e6, lucky * 1e6, beforeHelp * 1e6,
+                                                          helpPick * 1e6, churn * 1e6)
+
+
+if __name__ == "__main__":
+    main()
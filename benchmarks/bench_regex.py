@@ -0,0 +1,50 @@
+"""Keyword miss latency against the size of the regex table.
+
+Compares the old linear scan over LinkDatabase.regexes with the
+RegexIndex dispatcher behind LinkDatabase.matchRegexes.
+"""
+
+import random
+import re
+import string
+import timeit
+
+import core
+
+
+def makeDatabase(nregexes, seed=0):
+    rnd = random.Random(seed)
+    db = core.LinkDatabase()
+    for i in range(nregexes):
+        if i % 20 == 0:  # a few regexes have no literal prefix
+            regex = r"[a-z]{%d}\d{%d}" % (rnd.randint(2, 6), rnd.randint(2, 6))
+        else:
+            word = "".join(rnd.choice(string.lowercase) for _ in range(rnd.randint(2, 8)))
+            regex = r"%s%d-(\d+)" % (word, i)
+        db.addRegexList(regex, "http://example.com/%d/{1}" % i)
+    return db
+
+
+def linearScan(db, kw):
+    return [R for R in db.regexes.values() if re.match(R.regex, kw, re.IGNORECASE)]
+
+
+def timePerKeyword(fn, keywords, number):
+    return min(timeit.repeat(lambda: [fn(kw) for kw in keywords],
+                             number=number, repeat=3)) / number / len(keywords)
+
+
+def main(sizes=(10, 100, 500, 1000, 5000), number=2000):
+    keywords = ["nosuchkeyword", "wiki", "jira-1234", "x"]
+    print "%8s %14s %14s %8s" % ("regexes", "linear (us)", "indexed (us)", "speedup")
+    for n in sizes:
+        db = makeDatabase(n)
+        db.matchRegexes("warmup")
+        # past 100 regexes the linear scan thrashes re's pattern cache
+        tLinear = timePerKeyword(lambda kw: linearScan(db, kw), keywords, max(1, number // n))
+        tIndexed = timePerKeyword(db.matchRegexes, keywords, number)
+        print "%8d %14.2f %14.2f %7.1fx" % (n, tLinear * 1e6, tIndexed * 1e6, tLinear / tIndexed)
+
+
+if __name__ == "__main__":
+    main()
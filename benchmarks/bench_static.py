@@ -0,0 +1,49 @@
+"""Serving bootstrap.min.css.
+
+Times Root.bootstrap_css as it used to be, reading the file on every
+request, against static.Assets: a first request, a gzipped one, and one
+answered 304 from its ETag.  Also prints the bytes each sends.
+"""
+
+import os
+import timeit
+
+import cherrypy
+
+import static
+from benchmarks.bench_suite import fakeRequest
+
+
+def perCall(fn, number=2000):
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number
+
+
+def main(name="bootstrap.min.css"):
+    assets = static.Assets(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    def before():
+        fakeRequest("/bootstrap.css")
+        cherrypy.response.headers["Cache-control"] = "max-age=172800"
+        cherrypy.response.headers["Content-Type"] = "text/css"
+        return file(os.path.join(assets.directory, name)).read()
+
+    def get(*headers):
+        def serve():
+            fakeRequest("/bootstrap.css")
+            cherrypy.request.headers.update(dict(headers))
+            return assets.serve(name)
+        return serve
+
+    etag = assets.get(name).gzipEtag
+    cases = [("read from disk (before)", before),
+             ("from memory", get()),
+             ("from memory, gzip", get(("Accept-Encoding", "gzip"))),
+             ("304 Not Modified", get(("Accept-Encoding", "gzip"), ("If-None-Match", etag)))]
+
+    print "%-28s %10s %10s" % ("", "us", "bytes")
+    for label, fn in cases:
+        print "%-28s %10.1f %10d" % (label, perCall(fn) * 1e6, len(fn()))
+
+
+if __name__ == "__main__":
+    main()
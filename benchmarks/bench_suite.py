@@ -0,0 +1,230 @@
+"""The standard benchmarks, over a generated database, saved as JSON.
+
+Runs Root.default for a plain keyword, a folder, a regex and a miss (with
+the resolution cache off, and once more with it on), the /toplinks and
+list pages, saving and loading the database as a pickle and as SQLite,
+and export and import, all against benchmarks.generate.makeDatabase.
+Every result is the best time per operation over a few rounds.
+
+    python -m benchmarks.bench_suite [-n links] [-o results.json]
+    python -m benchmarks.bench_suite --compare old.json new.json
+
+Results are written to benchmarks/results/<time>.json unless -o is
+given, with enough about the run (sizes, python, git revision) to tell
+later which runs can be compared.
+"""
+
+import Cookie
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import cherrypy
+from cherrypy.lib import httputil
+
+import core
+import go
+import storage
+import tools
+from benchmarks.generate import makeDatabase
+
+_repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def bench(fn, minTime=0.2, rounds=3):
+    """Best seconds per call of fn over rounds of at least minTime each."""
+    best = None
+    ncalls = 1
+    for _ in range(rounds):
+        while True:
+            start = time.time()
+            for _ in range(ncalls):
+                fn()
+            elapsed = time.time() - start
+            if elapsed >= minTime or ncalls >= 10 ** 6:
+                break
+            ncalls *= 10
+        best = min(best, elapsed / ncalls) if best is not None else elapsed / ncalls
+    return {"seconds": best, "calls": ncalls}
+
+
+def fakeRequest(path):
+    """Make path the request cherrypy handlers see, as from localhost."""
+    req = cherrypy._cprequest.Request(httputil.Host("127.0.0.1", 80, ""), httputil.Host("127.0.0.1", 1234, ""))
+    req.base = "http://" + core.MYGLOBALS.cfg_hostname
+    req.path_info = path
+    req.query_string = ""
+    req.headers = httputil.HeaderMap()  # not the one Request shares between instances
+    req.cookie = Cookie.SimpleCookie()
+    cherrypy.serving.request = req
+    cherrypy.serving.response = cherrypy._cprequest.Response()
+
+
+def page(handler, path, *args, **kwargs):
+    def get():
+        fakeRequest(path)
+        return handler(*args, **kwargs)
+    return get
+
+
+def redirects(root, db, cached=False):
+    """Root.default for each kind of keyword, checking it does what it should."""
+    plain = sorted(LL.name for LL in db.lists.values() if LL.name.startswith("kw") and LL._url == "freshest")[0]
+    cases = [("plain", (plain,), db.lists[plain].links[0].url()),
+             ("folder", ("f3", "some", "path"), "http://example.com/folders/3/some/path"),
+             ("regex", ("bug7-1234",), "http://bugs.example.com/7/1234"),
+             ("miss", ("nosuchkeyword",), None)]
+
+    results = {}
+    for name, rest, location in cases:
+        get = page(root.default, "/" + "/".join(rest), *rest)
+        body = get()
+        if location is not None:
+            assert cherrypy.serving.response.headers.get("Location") == location, (
+                name, cherrypy.serving.response.headers.get("Location"), location)
+        else:
+            assert "nosuchkeyword" in body
+        results["redirect_%s%s" % (name, "_cached" if cached else "")] = bench(get)
+    return results
+
+
+def pages(root, db):
+    biggest = max(db.lists.values(), key=lambda LL: len(LL.links))
+    return {"toplinks": bench(page(root.toplinks, "/toplinks", "100")),
+            "list_page": bench(page(root.default, "/." + biggest.name, "." + biggest.name)),
+            "list_page_links": len(biggest.links)}
+
+
+def persistence(db, tmpdir):
+    """Pickle and SQLite snapshots of db, and loading them back."""
+    results = {}
+    picklefn = os.path.join(tmpdir, "godb.pickle")
+    saved = core.cfg_fnDatabase
+    core.cfg_fnDatabase = picklefn
+    try:
+        results["save_pickle"] = bench(db.save, minTime=0, rounds=1)
+        results["load_pickle"] = bench(lambda: core.LinkDatabase.load(picklefn, None), minTime=0, rounds=1)
+    finally:
+        core.cfg_fnDatabase = saved
+    results["pickle_bytes"] = os.path.getsize(picklefn)
+
+    sqlitefn = os.path.join(tmpdir, "godb.sqlite")
+    store = storage.SqliteStore(sqlitefn)
+    results["save_sqlite"] = bench(lambda: store.saveAll(db), minTime=0, rounds=1)
+    results["load_sqlite"] = bench(lambda: storage.SqliteStore(sqlitefn).load(), minTime=0, rounds=1)
+    return results
+
+
+def exportImport(db, tmpdir):
+    exportfn = os.path.join(tmpdir, "export.txt")
+    results = {"export": bench(lambda: db._export(exportfn), minTime=0, rounds=1)}
+
+    saved = core.cfg_fnDatabase
+    core.cfg_fnDatabase = os.path.join(tmpdir, "imported.pickle")
+    try:
+        results["import"] = bench(lambda: core.LinkDatabase()._import(exportfn), minTime=0, rounds=1)
+    finally:
+        core.cfg_fnDatabase = saved
+    results["export_lines"] = sum(1 for _ in open(exportfn))
+    return results
+
+
+def quietly(fn, *args):
+    """Call fn without the progress it prints."""
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        return fn(*args)
+    finally:
+        sys.stdout = stdout
+
+
+def gitRevision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=_repo,
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(nlinks=10000, seed=0):
+    start = time.time()
+    db = makeDatabase(nlinks, seed=seed)
+    results = {"generate": {"seconds": time.time() - start, "calls": 1}}
+
+    core.MYGLOBALS.g_db = db
+    root = go.Root()
+    resolutions = go.Root.resolutions
+    try:
+        go.Root.resolutions = tools.LRUCache(0)
+        results.update(redirects(root, db))
+        go.Root.resolutions = tools.LRUCache(1000)
+        results.update(redirects(root, db, cached=True))
+    finally:
+        go.Root.resolutions = resolutions
+    results.update(pages(root, db))
+
+    tmpdir = tempfile.mkdtemp(prefix="go-bench-")
+    try:
+        results.update(quietly(persistence, db, tmpdir))
+        results.update(quietly(exportImport, db, tmpdir))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return {"run": {"time": time.time(), "links": nlinks, "lists": len(db.lists),
+                    "regexes": len(db.regexes), "seed": seed, "revision": gitRevision(),
+                    "python": platform.python_version(), "machine": platform.machine(),
+                    "cpus": os.sysconf("SC_NPROCESSORS_ONLN")},
+            "results": results}
+
+
+def report(results):
+    for name in sorted(results):
+        r = results[name]
+        if isinstance(r, dict):
+            print "%-24s %12.6f s %10d calls" % (name, r["seconds"], r["calls"])
+        else:
+            print "%-24s %12d" % (name, r)
+
+
+def compare(old, new):
+    """Print the change in every timing found in both result files."""
+    print "%-24s %12s %12s %8s" % ("", "old (s)", "new (s)", "change")
+    for name in sorted(set(old["results"]) & set(new["results"])):
+        a, b = old["results"][name], new["results"][name]
+        if isinstance(a, dict) and isinstance(b, dict):
+            print "%-24s %12.6f %12.6f %+7.0f%%" % (name, a["seconds"], b["seconds"],
+                                                    100.0 * (b["seconds"] - a["seconds"]) / a["seconds"])
+
+
+def main():
+    parser = OptionParser(usage="%prog [-n links] [-o results.json] | --compare old.json new.json")
+    parser.add_option("-n", dest="nlinks", type="int", default=10000, help="links in the database")
+    parser.add_option("--seed", dest="seed", type="int", default=0, help="seed for the generator")
+    parser.add_option("-o", dest="output", help="write results here")
+    parser.add_option("--compare", dest="compare", action="store_true", help="compare two result files")
+    (opts, args) = parser.parse_args()
+
+    if opts.compare:
+        if len(args) != 2:
+            parser.error("--compare needs two result files")
+        return compare(*[json.load(open(fn)) for fn in args])
+
+    out = run(opts.nlinks, opts.seed)
+    report(out["results"])
+
+    fn = opts.output or os.path.join(_repo, "benchmarks", "results", "%s.json" % time.strftime("%Y%m%d-%H%M%S"))
+    if not os.path.isdir(os.path.dirname(os.path.abspath(fn))):
+        os.makedirs(os.path.dirname(os.path.abspath(fn)))
+    with open(fn, "w") as f:
+        json.dump(out, f, indent=1, sort_keys=True)
+    print "results in %s" % fn
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Redirect throughput with one and several worker processes.
+
+Each configuration starts go.py in a scratch directory (a copy of the
+templates and a go.cfg with journal mode on) with --workers N, seeds it
+with links, and has client processes hammer /<keyword> for a few seconds.
+Throughput can only grow with the number of cores; on a single core the
+interesting number is how little the shared journal costs.
+"""
+
+import json
+import os
+import pickle
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import core
+
+_repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_cfg = """[goconfig]
+cfg_fnDatabase: godb.pickle
+cfg_fnJournal: godb.journal
+cfg_urlFavicon: http://www.example.com/favicon.ico
+cfg_hostname: localhost
+cfg_urlSSO: None
+cfg_listenport: %(port)d
+"""
+
+_client = r"""
+import httplib, json, sys, time
+port, keywords, seconds = int(sys.argv[1]), sys.argv[2].split(","), float(sys.argv[3])
+conn = httplib.HTTPConnection("127.0.0.1", port)
+n = 0
+deadline = time.time() + seconds
+while time.time() < deadline:
+    conn.request("GET", "/" + keywords[n % len(keywords)], headers={"Host": "localhost"})
+    r = conn.getresponse()
+    r.read()
+    assert r.status in (301, 302, 303, 307), r.status
+    n += 1
+print json.dumps({"requests": n})
+"""
+
+
+def freePort():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def scratchDir(port, nlinks):
+    d = tempfile.mkdtemp(prefix="go-workers-")
+    for name in os.listdir(_repo):
+        if name.endswith((".py", ".html", ".css", ".txt")):
+            shutil.copy(os.path.join(_repo, name), d)
+    with open(os.path.join(d, "go.cfg"), "w") as f:
+        f.write(_cfg % {"port": port})
+
+    db = core.LinkDatabase()
+    for i in range(nlinks):
+        db.addLink("kw%d" % i, "http://example.com/%d" % i, "link %d" % i)
+    with open(os.path.join(d, "godb.pickle"), "wb") as f:
+        pickle.dump(db, f)
+    return d, sorted(db.lists)[:100]
+
+
+def waitForPort(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("server did not come up on port %d" % port)
+
+
+def measure(nworkers, nclients, seconds=5.0, nlinks=1000):
+    port = freePort()
+    d, keywords = scratchDir(port, nlinks)
+    server = subprocess.Popen([sys.executable, "go.py", "--workers", str(nworkers)], cwd=d,
+                              stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+    try:
+        waitForPort(port)
+        clients = [subprocess.Popen([sys.executable, "-c", _client, str(port), ",".join(keywords), str(seconds)],
+                                    stdout=subprocess.PIPE)
+                   for _ in range(nclients)]
+        total = sum(json.loads(c.communicate()[0])["requests"] for c in clients)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+        shutil.rmtree(d)
+    return total / seconds
+
+
+def main(workerCounts=(1, 2, 4), nclients=4):
+    print "%d cores, %d clients" % (os.sysconf("SC_NPROCESSORS_ONLN"), nclients)
+    print "%8s %14s" % ("workers", "requests/s")
+    for n in workerCounts:
+        print "%8d %14.0f" % (n, measure(n, nclients))
+
+
+if __name__ == "__main__":
+    main()
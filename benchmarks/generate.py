@@ -0,0 +1,61 @@
+"""A synthetic LinkDatabase of any size, the same every time for a seed.
+
+Links are spread over keyword lists in small clusters, as real keywords
+are (a link is usually under one or two related keywords), plus a few
+very long lists.  Folders (keyword/ links with a {*} url), regexes, list
+behaviours, edit histories and click histories over the last clickDays
+days are all generated from one random.Random(seed), so two databases
+made with the same arguments differ only in the dates their clicks are
+relative to.
+"""
+
+import random
+
+import core
+import tools
+
+_behaviors = ("freshest", "top", "random", "list")
+
+
+def makeDatabase(nlinks=10000, nlists=None, nregexes=100, nfolders=100, clickDays=30, seed=0, today=None):
+    """Return a new LinkDatabase of nlinks links over about nlists keyword
+    lists (nlinks / 4 if not given), nfolders folders and nregexes regexes.
+    """
+    rnd = random.Random(seed)
+    today = today or tools.today()
+    nlists = max(1, nlists or nlinks // 4)
+    db = core.LinkDatabase()
+    db.setVariable("project", "go")
+
+    for i in range(nlinks):
+        # a few lists per cluster; pickle recurses through connected links
+        kw = i * nlists // nlinks
+        lists = set(["kw%d" % kw, "kw%d" % min(nlists - 1, kw ^ rnd.randint(0, 3))])
+        if i % 10 == 0:
+            lists.add("big%d" % (i % 7))  # and a few very long lists
+        L = db.addLink(sorted(lists), "http://example.com/%d/%d" % (i, rnd.randrange(10 ** 6)),
+                       "link number %d" % i, "user%d" % (i % 100), when=1500000000 + i * 60)
+        if i % 3 == 0:
+            L.editedBy("user%d" % rnd.randrange(100), 1500000000 + i * 60 + 3600)
+
+    for i in range(nfolders):
+        db.addLink(["f%d/" % i], "http://example.com/folders/%d/{*}" % i, "folder %d" % i,
+                   when=1400000000 + i * 60)
+
+    for i in range(nregexes):
+        if i % 20 == 0:  # a few regexes have no literal prefix
+            regex = r"([a-z]{%d}\d{%d})" % (rnd.randint(2, 6), rnd.randint(2, 6))
+        else:
+            regex = r"bug%d-(\d+)" % i
+        db.addLink([regex], "http://bugs.example.com/%d/{1}" % i, "tracker %d" % i, when=1400000000 + i * 60)
+
+    for name in sorted(db.lists):
+        if name.startswith("kw") and rnd.random() < 0.2:
+            db.setBehavior(db.lists[name], rnd.choice(_behaviors))
+
+    objs = [db.linksById[k] for k in sorted(db.linksById)] + [db.lists[k] for k in sorted(db.lists)]
+    for obj in objs:
+        for day in sorted(rnd.sample(range(today - clickDays + 1, today + 1), rnd.randint(0, min(6, clickDays)))):
+            obj.clicked(rnd.randint(1, 50), day)
+
+    return db
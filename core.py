@@ -1,6 +1,9 @@
 """Core elements of the Go Redirector"""
 
 import ConfigParser
+import array
+import bisect
+import contextlib
 import pickle
 import os
 import shutil
@@ -12,14 +15,38 @@ import random
 import re
 import string
 import datetime
+import itertools
+import threading
 
+import metrics
 import tools
+from journal import Journal
 
 config = ConfigParser.ConfigParser()
 config.read('go.cfg')
 
 cfg_fnDatabase = config.get('goconfig', 'cfg_fnDatabase')
 
+try:
+    cfg_fnJournal = config.get('goconfig', 'cfg_fnJournal')
+except ConfigParser.NoOptionError:
+    cfg_fnJournal = None
+
+try:
+    cfg_snapshotInterval = config.getint('goconfig', 'cfg_snapshotInterval')
+except ConfigParser.NoOptionError:
+    cfg_snapshotInterval = 3600
+
+try:
+    cfg_clickFlushInterval = config.getint('goconfig', 'cfg_clickFlushInterval')
+except ConfigParser.NoOptionError:
+    cfg_clickFlushInterval = 60
+
+try:
+    cfg_clickFlushSize = config.getint('goconfig', 'cfg_clickFlushSize')
+except ConfigParser.NoOptionError:
+    cfg_clickFlushSize = 10000
+
 
 class Error(Exception):
     """base error exception class for go, never raised"""
@@ -31,6 +58,14 @@ class InvalidKeyword(Error):
     pass
 
 
+class JournalGap(Error):
+    """Error raised when another process has compacted journal records
+    into a snapshot before this one read them; the database has to be
+    loaded again.
+    """
+    pass
+
+
 class LinkDatabase:
     def __init__(self):
         self.regexes = {}        # regex -> RegexList
@@ -39,6 +74,7 @@ class LinkDatabase:
         self.linksById = {}      # link.linkid -> Link
         self.linksByUrl = {}     # link._url -> Link
         self._nextlinkid = 1
+        self._initTransient()
 
     def __repr__(self):
         return '%s(regexes=%s, lists=%s, vars=%s, byId=%s, byUrl=%s)' % (self.__class__.__name__,
@@ -47,26 +83,326 @@ class LinkDatabase:
                                                                          self.linksById,
                                                                          self.linksByUrl)
 
+    def __getstate__(self):
+        # locks, the journal and derived indexes are never pickled
+        state = self.__dict__.copy()
+        for k in self._transient:
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._initTransient()
+
+    _transient = ("_lock", "_journal", "_depth", "_store", "_dirty", "_dirtyVars", "_dirtyClicks",
+                  "_clickLock", "_clickDeltas", "_clicksFull", "_heldClicks", "_saver", "_saveWanted",
+                  "_regexIndex", "_popularLinks", "_popularLists", "_folders", "_nonFolders", "_keywords",
+                  "clickGeneration", "modified", "_writing")
+
+    _journalSeq = 0  # seq of the last journal record applied
+    generation = 0   # bumped by every change to what a keyword resolves to
+
+    # Readers (redirects, pages) take no lock.  Writers hold _lock, which
+    # serializes them, and change what readers iterate by replacing it
+    # (Link.lists, ListOfLinks.links) rather than changing it in place.
+    # _clickLock is held only briefly: by clicks, which are counted in
+    # place, and by writers just while they change something clicks also
+    # touch (the popularity indexes, the generations), never across a
+    # whole edit or a save, so that a click never waits on either.
+
+    def _initTransient(self):
+        self._lock = threading.RLock()
+        self._journal = None
+        self._depth = 0
+        self._store = None       # SqliteStore, if not pickled
+        self._dirty = set()      # links and lists changed since the last save to _store
+        self._dirtyVars = set()  # likewise for variable names
+        self._dirtyClicks = {}   # and (linkid, day ordinal) -> clicks, added to the store's counts
+        self._clickLock = threading.RLock()
+        self._clickDeltas = {}  # (linkid, day ordinal) -> clicks not yet saved
+        self._clicksFull = threading.Event()  # set at cfg_clickFlushSize deltas, or to save
+        self._heldClicks = None  # [(obj, day ordinal)] clicked while a snapshot is taken
+        self._saver = None       # the ClickFlusher that saves in the background, if running
+        self._saveWanted = False
+        self.clickGeneration = 0   # bumped by every click
+        self.modified = time.time()  # when the last change or click was made
+        self._writing = 0          # edits under way, during which no index is published
+        self._resetIndexes()
+
+    def _resetIndexes(self):
+        self._regexIndex = None    # RegexIndex over self.regexes
+        self._popularLinks = None  # PopularityIndex over self.linksById
+        self._popularLists = None  # PopularityIndex over self.lists
+        self._folders = None       # ChoiceIndex of the generative links
+        self._nonFolders = None    # ChoiceIndex of the others
+        self._keywords = None      # KeywordIndex of self.lists
+
+    def _index(self, name, build):
+        """Return the index called name, built by build() if there is none.
+        Readers build it without a lock, so it is only kept if nothing was
+        changed meanwhile: a writer that found no index would not have
+        updated it.
+        """
+        index = getattr(self, name)
+        if index is None:
+            generation = self.generation
+            index = build()
+            with self._clickLock:
+                if self.generation == generation and not self._writing:
+                    setattr(self, name, index)
+        return index
+
     @staticmethod
-    def load(db=cfg_fnDatabase):
+    def load(db=cfg_fnDatabase, journal=cfg_fnJournal, shared=False):
         """Attempt to load the database defined at cfg_fnDatabase. Create a
-        new one if the database doesn't already exist.
+        new one if the database doesn't already exist.  A name ending in
+        .sqlite is a SqliteStore rather than a pickle, and a redis:// url a
+        RedisStore, which keeps its own journal.  In journal mode, replay
+        the journal on top of it.
         """
+        if db.startswith("redis://"):
+            import storage
+            print "Loading DB from %s" % db
+            store = storage.RedisStore(db)
+            store.listen()  # before loading, so no change goes unnoticed
+            return store.open()
+
+        j = journal and Journal(journal, shared)
+        if j:
+            j.acquire()  # so nobody compacts between the snapshot and the journal
+
         try:
             print "Loading DB from %s" % db
-            return pickle.load(file(db))
-        except (IOError, EOFError):
-            print sys.exc_info()[1]
-            print "Creating new database..."
-            return LinkDatabase()
+            if db.endswith(".sqlite"):
+                import storage
+                ldb = storage.SqliteStore(db).load()
+            else:
+                try:
+                    ldb = pickle.load(file(db))
+                except (IOError, EOFError):
+                    print sys.exc_info()[1]
+                    print "Creating new database..."
+                    ldb = LinkDatabase()
+
+            if j:
+                ldb._attachJournal(j)
+        finally:
+            if j:
+                j.release()
+
+        return ldb
+
+    def openJournal(self, path, shared=False):
+        """Replay the journal at path and record all further edits to it.
+        A shared journal is also written by other processes; their edits are
+        picked up by refresh() and before every edit made here.
+        """
+        j = Journal(path, shared)
+        j.acquire()
+        try:
+            self._attachJournal(j)
+        finally:
+            j.release()
+
+    def _attachJournal(self, j):
+        with self._lock:
+            self._journal = j
+            n = self._catchUp()
+        print "Replayed %d journal records from %s" % (n, j.path)
+
+    def _catchUp(self):
+        """Replay the journal records this process has not seen yet."""
+        n = 0
+        if not self._journal.behind():
+            return n
+
+        self._depth += 1  # the records being replayed are journaled already
+        try:
+            for rec in self._journal.records():
+                if rec["seq"] <= self._journalSeq:
+                    continue  # already in the snapshot
+                if rec["seq"] != self._journalSeq + 1:
+                    raise JournalGap("journal goes from %s to %s" % (self._journalSeq, rec["seq"]))
+                self._replay(rec)
+                n += 1
+        finally:
+            self._depth -= 1
+
+        return n
+
+    def refresh(self):
+        """Pick up the edits other processes have made to a shared journal.
+        Raises JournalGap if the database has to be loaded again instead.
+        Clicks other nodes added to a shared store are counted here too.
+        """
+        if self._store is not None and self._store.sharedClicks:
+            clicks = self._store.takeClicks()
+            if clicks:
+                with self._lock:
+                    self._replayClicks(clicks, save=False)
+
+        if self._journal is None or not self._journal.poll():
+            return 0
+
+        with self._lock:
+            self._journal.acquire()
+            try:
+                return self._catchUp()
+            finally:
+                self._journal.release()
+
+    @contextlib.contextmanager
+    def _exclusive(self):
+        """Hold the journal against other processes, caught up with their
+        edits.  Nested uses, and databases without a journal, need nothing.
+        """
+        if self._journal is None or self._depth > 0:
+            yield
+            return
+
+        self._journal.acquire()
+        try:
+            self._catchUp()
+            yield
+        finally:
+            self._journal.release()
+
+    def _replay(self, rec):
+        op, args = rec["op"], rec["args"]
+        try:
+            if op == "addLink":
+                self.addLink(*args)
+            elif op == "editLink":
+                self.editLink(self.getLink(args[0]), *args[1:])
+            elif op == "deleteLink":
+                self.deleteLink(self.getLink(args[0]))
+            elif op == "deleteList":
+                self.deleteList(self.lists[args[0]])
+            elif op == "renameList":
+                self.renameList(self.lists[args[0]], args[1])
+            elif op == "setBehavior":
+                self.setBehavior(self.lists[args[0]], args[1])
+            elif op == "setVariable":
+                self.setVariable(*args)
+            elif op == "addRegexList":
+                self.addRegexList(*args)
+            elif op == "clicks":
+                self._replayClicks(args[0])
+            elif op == "snapshot":
+                pass  # the journal restarted after a snapshot
+            else:
+                raise ValueError("unknown op")
+        except Exception as e:
+            print "journal record %s (%s) failed: %r" % (rec["seq"], op, e)
+
+        self._journalSeq = rec["seq"]
+
+    @contextlib.contextmanager
+    def _logged(self, op, *args):
+        """Serialize a change to the database and, in journal mode, write it
+        ahead to the journal.  Changes made by nested calls are part of the
+        outermost one and are not recorded separately.  The generation is
+        bumped once the change is complete.
+        """
+        with self._lock:
+            with self._exclusive():
+                if self._depth == 0 and self._journal is not None:
+                    self._append(op, args)
+
+                self._depth += 1
+                with self._clickLock:
+                    self._writing += 1
+                try:
+                    yield
+                finally:
+                    with self._clickLock:
+                        self.generation += 1
+                        self.modified = time.time()
+                        self._writing -= 1
+                    self._depth -= 1
+
+    def _journalClicks(self, clicks):
+        """Write clicks already counted in memory to the journal, in turn
+        with the edits.  Unlike _logged(), this leaves the generation alone:
+        no keyword resolves any differently for them.
+        """
+        with self._lock:
+            with self._exclusive():
+                self._append("clicks", [clicks])
+
+    def _append(self, op, args):
+        self._journalSeq += 1
+        self._journal.append({"seq": self._journalSeq, "op": op, "args": args})
 
     def save(self):
+        """Make the changes since the last save durable: from the
+        ClickFlusher thread, if one is running, so that the request that
+        made them does not wait for a snapshot, or else right away.
+        """
+        if self._journal is not None:
+            return  # every change is already in the journal
+
+        if self._saver is not None:
+            self._saveWanted = True
+            self._clicksFull.set()  # wake it up
+            return
+
+        self.snapshot()
+
+    def snapshot(self):
+        """Write the whole database to cfg_fnDatabase, rotating backups, or
+        just what changed to its SqliteStore.  In journal mode the journal
+        starts over once the snapshot is in place, with a marker record that
+        lets other processes sharing it notice.
+        """
+        with self._lock, self._exclusive(), metrics.timed("save"):
+            if self._store is not None:
+                self._saveToStore()
+            else:
+                self._pickle()
+
+            if self._journal is not None:
+                self._journal.truncate()
+                self._append("snapshot", [])
+
+    def snapshotShared(self, interval):
+        """The periodic snapshot: taken only if no other node sharing the
+        journal has taken one in the last interval seconds, so that one node
+        does them all.  True if it was taken here.
+        """
+        if self._journal is not None and not self._journal.claim("snapshotter", interval * 0.9):
+            return False  # the 0.9 leaves room for the claimant's timer to drift
+        self.snapshot()
+        return True
+
+    def _saveToStore(self):
+        with self._clickLock:
+            dirty, self._dirty = self._dirty, set()
+            dirtyVars, self._dirtyVars = self._dirtyVars, set()
+            dirtyClicks, self._dirtyClicks = self._dirtyClicks, {}
+        try:
+            # a store that keeps no clicks leaves them to flushClicks()
+            with self._clicksHeld(saved=not self._store.sharedClicks):
+                if self._store.sharedClicks:
+                    self._store.save(self, dirty, dirtyVars)
+                else:
+                    self._store.save(self, dirty, dirtyVars, clickDeltas=dirtyClicks)
+        except Exception:
+            with self._clickLock:
+                self._dirty |= dirty
+                self._dirtyVars |= dirtyVars
+            self._addDirtyClicks(dirtyClicks.items())
+            raise
+
+    def _pickle(self):
         backupcount = 5
         dbdir = os.path.dirname(cfg_fnDatabase)
         (fd, tmpname) = tempfile.mkstemp(dir=dbdir)
         f = os.fdopen(fd, 'w')
-        pickle.dump(self, f)
+        with self._clicksHeld():
+            pickle.dump(self, f)
         f.flush()
+        os.fsync(f.fileno())
         f.close()
 
         for i in reversed(range(backupcount - 1)):
@@ -78,101 +414,410 @@ class LinkDatabase:
             shutil.move(cfg_fnDatabase, cfg_fnDatabase + "-0")
         shutil.move(tmpname, cfg_fnDatabase)
 
+    @contextlib.contextmanager
+    def _clicksHeld(self, saved=True):
+        """Count clicks aside while the block runs, and on the objects once
+        it is done, so that a snapshot taken in it is the database as it was
+        when it started, without holding up redirects.  The clicks counted
+        before are in the snapshot, if saved, and need no saving, unless it
+        fails.
+        """
+        with self._clickLock:
+            deltas = {}
+            if saved:
+                deltas, self._clickDeltas = self._clickDeltas, {}
+                self._clicksFull.clear()
+            self._heldClicks = []
+        try:
+            yield
+        except Exception:
+            with self._clickLock:
+                for key, n in deltas.items():
+                    self._clickDeltas[key] = self._clickDeltas.get(key, 0) + n
+            raise
+        finally:
+            with self._clickLock:
+                held, self._heldClicks = self._heldClicks, None
+                for obj, todayord in held:
+                    self._click(obj, todayord)
+
+    def _touch(self, *objs):
+        """Mark objs to be written at the next save to the store, and the
+        lists among them changed.
+        """
+        with self._clickLock:
+            for obj in objs:
+                if isinstance(obj, ListOfLinks):
+                    obj.generation += 1
+            if self._store is not None:
+                self._dirty.update(objs)
+
     def nextlinkid(self):
         r = self._nextlinkid
         self._nextlinkid += 1
         return r
 
     def addRegexList(self, regex=None, url=None, desc=None, owner=""):
-        r = RegexList(self.nextlinkid(), regex)
-        r._url = url
-        self._addRegexList(r, owner)
+        with self._logged("addRegexList", regex, url, desc, owner):
+            r = RegexList(self.nextlinkid(), regex)
+            r._url = url
+            self._addRegexList(r, owner)
 
     def _addRegexList(self, r, owner):
         self.regexes[r.regex] = r
+        self._regexIndex = None
         self._addList(r)     # add to all indexes
 
-    def addLink(self, lists, url, title, owner=""):
+    def matchRegexes(self, kw):
+        """Return (RegexList, match) for every regex that matches kw."""
+        return self._index("_regexIndex", lambda: RegexIndex(self.regexes.values())).match(kw)
+
+    def addLink(self, lists, url, title, owner="", when=None):
         if url in self.linksByUrl:
             raise RuntimeError("existing url")
 
         if type(lists) == str:
             lists = lists.split()
 
-        link = Link(self.nextlinkid(), url, title)
-
         for kw in lists:
-            self.getList(kw, create=True).addLink(link)
+            self.getList(kw, create=False)  # validate before journaling
 
-        self._addLink(link, owner)
+        when = when or time.time()
+        with self._logged("addLink", lists, url, title, owner, when):
+            link = Link(self.nextlinkid(), url, title)
+
+            for kw in lists:
+                self.getList(kw, create=True).addLink(link)
+
+            self._addLink(link, owner, when)
 
         return link
 
-    def _addLink(self, link, editor=None):
+    def _addLink(self, link, editor=None, when=None):
         if editor:
-            link.editedBy(editor)
+            link.editedBy(editor, when)
 
+        self._touch(link, *link.lists)
         self.linksById[link.linkid] = link
         self.linksByUrl[link._url] = link
+        with self._clickLock:
+            if self._popularLinks is not None:
+                self._popularLinks.add(link)
+            self.generation += 1
+        self._reclassify(link)
+
+    def _reclassify(self, link):
+        """Keep the folder indexes in step with link's list memberships."""
+        if self._folders is None and self._nonFolders is None:
+            return
+        present = self.linksById.get(link.linkid) is link
+        generative = present and link.isGenerative()
+        for index, belongs in ((self._folders, generative), (self._nonFolders, present and not generative)):
+            if index is None:
+                continue
+            if belongs:
+                index.add(link)
+            else:
+                index.remove(link)
+
+    def editLink(self, link, url, title, lists, editor, when=None):
+        """Give link a new url and title and make lists its exact set of
+        lists, deleting any list left empty.  Raises InvalidKeyword, before
+        changing anything, if any of the list names is invalid.
+        """
+        listnames = []
+        for listname in lists:
+            if "{*}" in url and listname[-1] != "/":
+                listname += "/"
+            self.getList(listname, create=False)  # validate
+            if listname not in listnames:
+                listnames.append(listname)
+
+        when = when or time.time()
+        with self._logged("editLink", link.linkid, url, title, listnames, editor, when):
+            self._touch(link, *link.lists)
+            if link._url != url:
+                self._changeLinkUrl(link, url)
+            link.title = title
+
+            newlistset = [self.getList(x, create=True) for x in listnames]
+
+            for LL in newlistset:
+                if LL not in link.lists:
+                    LL.addLink(link)
+
+            for LL in [x for x in link.lists]:
+                if LL not in newlistset:
+                    LL.removeLink(link)
+                    if not LL._members:
+                        self.deleteList(LL)
+
+            link.lists = newlistset
+            self._touch(*newlistset)
+            self._reclassify(link)
+
+            link.editedBy(editor, when)
+
+    def setBehavior(self, LL, behavior):
+        """Set what go/<list> redirects to: list | freshest | top | random
+        or the linkid of one of its links.
+        """
+        with self._logged("setBehavior", LL.name, behavior):
+            LL._url = behavior
+            self._touch(LL)
+
+    def setVariable(self, varname, value):
+        with self._logged("setVariable", varname, value):
+            self.variables[varname] = value
+            self._dirtyVars.add(varname)
 
     def _changeLinkUrl(self, link, newurl):
         if link._url in self.linksByUrl:
             del self.linksByUrl[link._url]
         link._url = newurl
         self.linksByUrl[newurl] = link
+        with self._clickLock:
+            self.generation += 1
 
     def _addList(self, LL):
         self.lists[LL.name] = LL
+        self._touch(LL)
+        with self._clickLock:
+            if self._popularLists is not None:
+                self._popularLists.add(LL)
+        if self._keywords is not None and not isinstance(LL, RegexList):
+            self._keywords.add(LL.name)
 
     def deleteLink(self, link):
-        for LL in list(link.lists):
-            LL.removeLink(link)
-            if not LL.links:  # auto-delete lists with no links
-                self.deleteList(LL)
-
-        self._removeLinkFromUrls(link._url)
-
-        if link.linkid in self.linksById:
-            del self.linksById[link.linkid]
-
-        if isinstance(link, RegexList):
-            del self.regexes[link.regex]
+        with self._logged("deleteLink", link.linkid):
+            self._touch(link, *link.lists)
+            for LL in list(link.lists):
+                LL.removeLink(link)
+                if not LL._members:  # auto-delete lists with no links
+                    self.deleteList(LL)
+
+            self._removeLinkFromUrls(link._url)
+
+            if link.linkid in self.linksById:
+                del self.linksById[link.linkid]
+                with self._clickLock:
+                    if self._popularLinks is not None:
+                        self._popularLinks.remove(link)
+                self._reclassify(link)
+
+            if isinstance(link, RegexList):
+                del self.regexes[link.regex]
+                self._regexIndex = None
 
         return "deleted go/%s" % link.linkid
 
     def _removeLinkFromUrls(self, url):
         if url in self.linksByUrl:
             del self.linksByUrl[url]
+        with self._clickLock:
+            self.generation += 1
 
     def deleteList(self, LL):
-        for link in list(LL.links):
-            LL.removeLink(link)
-
-        del self.lists[LL.name]
-        self.deleteLink(LL)
+        with self._logged("deleteList", LL.name):
+            self._touch(LL)
+            links = LL.links
+            LL.removeLinks(links)
+            for link in links:
+                self._reclassify(link)
+
+            del self.lists[LL.name]
+            with self._clickLock:
+                if self._popularLists is not None:
+                    self._popularLists.remove(LL)
+            if self._keywords is not None and not isinstance(LL, RegexList):
+                self._keywords.remove(LL.name)
+            self.deleteLink(LL)
         return "deleted go/%s" % LL.name
 
     def getLink(self, linkid):
         return self.linksById.get(int(linkid), None)
 
-    def getAllLists(self):
-        return tools.byClicks(self.lists.values())
+    def click(self, *objs):
+        """Count a click on each of objs and keep the popularity indexes
+        in step with their new click counts.  The clicks are saved later,
+        by flushClicks().
+        """
+        todayord = tools.today()
+        with self._clickLock:
+            for obj in objs:
+                if self._heldClicks is not None:
+                    self._heldClicks.append((obj, todayord))
+                else:
+                    self._click(obj, todayord)
+
+    def _click(self, obj, todayord):
+        self._countClicks(obj, 1, todayord)
+
+        if obj.linkid > 0:
+            key = (obj.linkid, todayord)
+            self._addDirtyClicks([(key, 1)])
+            self._clickDeltas[key] = self._clickDeltas.get(key, 0) + 1
+            if len(self._clickDeltas) >= cfg_clickFlushSize:
+                self._clicksFull.set()
+
+    def flushClicks(self):
+        """Save the clicks counted since the last flush: straight to a
+        shared store, as one journal record in journal mode, otherwise with
+        a snapshot.  Returns the number of (link, day) counts saved.
+        """
+        with self._clickLock:
+            deltas, self._clickDeltas = self._clickDeltas, {}
+            self._clicksFull.clear()
+            saveWanted, self._saveWanted = self._saveWanted, False
 
-    def getSpecialLinks(self):
-        links = set()
-        # TODO, do we have to check the database here??
-        for R in self.load().regexes.values():
-            links.update(R.links)
+        try:
+            if deltas:
+                if self._store is not None and self._store.sharedClicks:
+                    self._store.addClicks(deltas)
+                elif self._journal is not None:
+                    self._journalClicks(sorted([linkid, day, n] for (linkid, day), n in deltas.items()))
+                else:
+                    self.snapshot()
+                    saveWanted = False
+        except Exception:
+            with self._clickLock:  # to be saved by the next flush
+                for key, n in deltas.items():
+                    self._clickDeltas[key] = self._clickDeltas.get(key, 0) + n
+                self._saveWanted = self._saveWanted or saveWanted
+            raise
+        if saveWanted:
+            self.snapshot()  # for save()
+
+        return len(deltas)
+
+    def handOver(self, new):
+        """Pass the clicks not yet saved here to new, this database loaded
+        afresh, with the ClickFlusher saving them, and let go of the store.
+        """
+        with self._clickLock:
+            deltas, self._clickDeltas = self._clickDeltas, {}
+            self._clicksFull.clear()
+            saver, self._saver = self._saver, None
+
+        with new._lock:
+            new._replayClicks(sorted([linkid, day, n] for (linkid, day), n in deltas.items()), save=False)
+            with new._clickLock:
+                for key, n in deltas.items():
+                    new._clickDeltas[key] = new._clickDeltas.get(key, 0) + n
+                new._saver = new._saver or saver
+
+        if self._store is not None:
+            self._store.close()
+
+    def _replayClicks(self, clicks, save=True):
+        byId = dict((LL.linkid, LL) for LL in self.lists.values())
+        byId.update(self.linksById)
+        with self._clickLock:
+            for linkid, day, n in clicks:
+                if linkid in byId:
+                    self._countClicks(byId[linkid], n, day)
+                    if save:
+                        self._addDirtyClicks([((linkid, day), n)])
+
+    def _addDirtyClicks(self, deltas):
+        """Count ((linkid, day), n) deltas toward the next save to a store
+        that saves clicks, as counts added rather than with each object,
+        which would rewrite all of a clicked list's rows.
+        """
+        if self._store is not None and not self._store.sharedClicks:
+            with self._clickLock:
+                for key, n in deltas:
+                    self._dirtyClicks[key] = self._dirtyClicks.get(key, 0) + n
+
+    def _countClicks(self, obj, n, day):
+        obj.clicked(n, day)
+
+        if self._popularLinks is not None and self.linksById.get(obj.linkid) is obj:
+            self._popularLinks.update(obj)
+
+        if isinstance(obj, ListOfLinks):
+            if self._popularLists is not None and self.lists.get(obj.name) is obj:
+                self._popularLists.update(obj)
+            obj.generation += 1
+
+        for LL in obj.lists:
+            LL.generation += 1  # its page shows the clicks of its links
+            if LL._popularityChanged(obj) and LL._url == "top":
+                self.generation += 1  # go/<LL> now goes somewhere else
+
+        self.clickGeneration += 1
+        self.modified = time.time()
+
+    def version(self):
+        """The journal position, and with a store that shares clicks its
+        click counter, which every process sharing them agrees on once it has
+        read as far; or None without a journal.  Clicks not yet flushed are
+        left out, as they are this process's alone.
+        """
+        if self._journal is None:
+            return None
+        if self._store is not None and self._store.sharedClicks:
+            return self._journalSeq, self._store.clickSeq
+        return (self._journalSeq,)  # flushed clicks are journal records
 
-        links.update(self.getFolders())
+    def getAllLists(self):
+        return self._index("_popularLists", lambda: PopularityIndex(self.lists.values())).top()
 
-        return list(links)
+    def getTopLinks(self, n=None):
+        """Return the n most clicked non-folder links, in tools.byClicks order."""
+        ret = []
+        for L in self._index("_popularLinks", lambda: PopularityIndex(self.linksById.values())):
+            if len(ret) == n:
+                break
+            if not L.isGenerative():
+                ret.append(L)
+        return ret
+
+    def getSpecialLinks(self):
+        # every link of a regex is generative, so this is just the folders
+        return self.getFolders()
 
     def getFolders(self):
-        return [x for x in self.linksById.values() if x.isGenerative()]
+        return list(self._index("_folders", lambda: ChoiceIndex(x for x in self.linksById.values()
+                                                                if x.isGenerative())))
 
     def getNonFolders(self):
-        return [x for x in self.linksById.values() if not x.isGenerative()]
+        return list(self._index("_nonFolders", lambda: ChoiceIndex(x for x in self.linksById.values()
+                                                                   if not x.isGenerative())))
+
+    def getRandomLink(self, usable=False, tries=20):
+        """A non-folder link at random, or None if there are none.  With
+        usable, one that has a usage(): the first of tries picks that has
+        one, else one of all those that have, found the slow way, as usage()
+        changes with every click and edit and so is not indexed.
+        """
+        nonFolders = self._index("_nonFolders", lambda: ChoiceIndex(x for x in self.linksById.values()
+                                                                    if not x.isGenerative()))
+        link = nonFolders.choice()
+        if not usable:
+            return link
+        for _ in range(tries):
+            if link is None or link.usage():
+                return link
+            link = nonFolders.choice()
+
+        usableLinks = [L for L in nonFolders if L.usage()]
+        return random.choice(usableLinks) if usableLinks else None
+
+    def completeKeyword(self, prefix, n=10):
+        """Up to n keywords that begin with prefix, in order."""
+        return self._index("_keywords", self._keywordIndex).complete(prefix.lower(), n)
+
+    def suggestKeywords(self, kw, n=5):
+        """Up to n keywords a typo or two away from kw, closest first."""
+        kw = kw.lower()
+        maxDistance = 1 if len(kw) <= 10 else 2  # two are too many for shorter ones
+        index = self._index("_keywords", self._keywordIndex)
+        return [name for d, name in index.similar(kw, maxDistance, n)]
+
+    def _keywordIndex(self):
+        # a regex is no keyword anyone would type
+        return KeywordIndex(name for name, LL in self.lists.items() if not isinstance(LL, RegexList))
 
     def getList(self, listname, create=False):
         if "\\" in listname:  # is a regex
@@ -206,22 +851,37 @@ class LinkDatabase:
     def renameList(self, LL, newname):
         assert newname not in self.lists
         oldname = LL.name
-        self.lists[newname] = self.lists[oldname]
-        del self.lists[oldname]
-        LL.name = newname
+        with self._logged("renameList", oldname, newname):
+            self.lists[newname] = self.lists[oldname]
+            del self.lists[oldname]
+            LL.name = newname
+            if self._keywords is not None and not isinstance(LL, RegexList):
+                self._keywords.add(newname)
+                self._keywords.remove(oldname)
+            self._touch(LL)
+            for link in LL.links:  # the new name may end in a slash
+                self._reclassify(link)
         return "renamed go/%s to go/%s" % (oldname, LL.name)
 
     def _export(self, fn):
+        """Write the database to fn as text, one object per line."""
         print "exporting to %s" % fn
+        start = time.time()
+        n = 0
         with file(fn, "w") as f:
-            for k, v in self.variables.items():
-                f.write("variable %s %s\n" % (k, v))
+            for n, line in enumerate(self._exportLines(), 1):
+                f.write(line + "\n")
+        _reportRate("exported", n, start)
+
+    def _exportLines(self):
+        for k, v in self.variables.items():
+            yield "variable %s %s" % (k, v)
 
-            for L in self.linksById.values():
-                f.write(L._export() + "\n")
+        for L in self.linksById.values():
+            yield L._export()
 
-            for LL in self.lists.values():
-                f.write(LL._export() + "\n")
+        for LL in self.lists.values():
+            yield LL._export()
 
     # for the tsv dumper
     def _dump(self, fh):
@@ -229,40 +889,147 @@ class LinkDatabase:
             fh.write(link._dump() + "\n")
 
     def _import(self, fn):
+        """Add the objects exported to fn.  Links whose url is already in
+        the database are skipped.  The indexes are rebuilt, and the database
+        saved, once at the end.
+        """
         print "importing from %s" % fn
+        start = time.time()
         with file(fn, "r") as f:
-            for l in f.readlines():
-                if not l.strip():
+            n = self._importObjects(_parseExport(f), start)
+        _reportRate("imported", n, start)
+
+        self._resetIndexes()
+        for obj in self.linksById.values() + self.lists.values():
+            self._touch(obj)
+        self._dirtyVars.update(self.variables)
+        self.snapshot()
+
+    def _importObjects(self, objects, start):
+        self._resetIndexes()  # rebuilt when next needed
+        added = {}  # ListOfLinks -> links imported into it, in file order
+        n = 0
+        for n, (kind, obj, listnames) in enumerate(objects, 1):
+            if kind == "link":
+                if obj._url in self.linksByUrl:
                     continue
-                print l.strip()
-                a, b = string.split(l, " ", 1)
-                if a == "regex":
-                    R = RegexList(self.nextlinkid())
-                    R._import(b)
-                elif a == "link":
-                    L = Link(self.nextlinkid())
-                    L._import(b)
-                    self._addLink(L)
-                elif a == "list":
-                    listname, rest = string.split(b, " ", 1)
-                    if listname in self.lists:
-                        LL = self.lists[listname]
-                    else:
-                        LL = ListOfLinks(self.nextlinkid())
-                    LL._import(b)
-                elif a == "variable":
-                    k, v = b.split(" ", 1)
-                    self.variables[k] = v.strip()
-
-        assert self._nextlinkid == max(self.linksById.keys()) + 1
-
-        self.save()
+                obj.linkid = self.nextlinkid()
+                self.linksById[obj.linkid] = self.linksByUrl[obj._url] = obj
+                for name in listnames:
+                    LL = self.lists.get(name) or self.getList(name, create=True)
+                    added.setdefault(LL, []).append(obj)
+                    obj.lists.append(LL)
+            elif kind == "variable":
+                self.variables[obj[0]] = obj[1]
+            else:  # a list or regex, likely created by its links already
+                LL = self.lists.get(obj.name)
+                if LL is None:
+                    obj.linkid = self.nextlinkid()
+                    if kind == "regex":
+                        self.regexes[obj.regex] = obj
+                    LL = self.lists[obj.name] = obj
+                LL._url = obj._url
+                LL.title = obj.title
+                LL.edits = obj.edits
+                LL.archivedClicks, LL.clickData = obj.archivedClicks, obj.clickData
+                LL._recount()
+
+            if n % 100000 == 0:
+                _reportRate("read", n, start)
+
+        for LL, links in added.items():
+            LL._addMembers(links)  # as if each had been added in turn
+
+        for LL in self.lists.values():
+            # the export turned linkid behaviors into urls, as linkids change
+            if not isinstance(LL, RegexList) and LL._url not in _behaviors and not tools.is_int(LL._url):
+                L = self.linksByUrl.get(LL._url)
+                LL._url = str(L.linkid) if L in LL else "list"
+
+        return n
+
+
+_behaviors = ("", "list", "freshest", "top", "random")
+
+
+def _parseExport(lines):
+    """Yield (kind, object, list names) for each line of an export, where
+    kind is the line's first word and the object is not in any database.
+    """
+    for line in lines:
+        line = line.rstrip("\r\n")  # a title may be empty, or end in spaces
+        if not line.strip():
+            continue
+
+        kind, rest = line.split(" ", 1)
+        if kind == "link":
+            L = Link()
+            yield kind, L, L._import(rest)
+        elif kind == "list":
+            LL = ListOfLinks()
+            LL._import(rest)
+            yield kind, LL, None
+        elif kind == "regex":
+            R = RegexList()
+            R._import(rest)
+            yield kind, R, None
+        elif kind == "variable":
+            k, v = rest.split(" ", 1)
+            yield kind, (k, v.strip()), None
+
+
+def _parseClicks(s):
+    """Parse the "{day:clicks,...}" of an export without eval()."""
+    s = s.strip("{}").replace("L", "")  # longs, from older exports
+    if not s:
+        return {}
+    numbers = iter(map(int, s.replace(":", ",").split(",")))
+    return dict(zip(numbers, numbers))
+
+
+def _reportRate(what, n, start):
+    elapsed = max(time.time() - start, 1e-6)
+    print "%s %d rows in %.1fs (%d rows/s)" % (what, n, elapsed, n / elapsed)
+
+
+def _slotsOf(cls, _cache={}):
+    """Every slot of cls, its own and inherited, that is pickled."""
+    if cls not in _cache:
+        _cache[cls] = tuple(k for c in cls.__mro__ for k in getattr(c, "__slots__", ())
+                            if k not in cls._transient)
+    return _cache[cls]
 
 
 class Clickable(object):
+    # hundreds of thousands of these are kept in memory, so no __dict__
+    __slots__ = ("archivedClicks", "_clicks", "recentClicks", "lastClickDay")
+    _transient = ()  # slots that are never pickled
+
     def __init__(self):
         self.archivedClicks = 0
-        self.clickData = {}
+        self._clicks = ()        # day ordinal, clicks, ... by day, for about 30 days
+        self.recentClicks = 0    # sum(clickData.values())
+        self.lastClickDay = 0    # max(clickData.keys())
+
+    def __getstate__(self):
+        state = {}
+        for k in _slotsOf(type(self)):
+            try:
+                state[k] = getattr(self, k)
+            except AttributeError:
+                pass
+        return state
+
+    def __setstate__(self, state):
+        if "clickData" in state:  # pickled before _clicks, with a __dict__
+            state = dict(state)
+            self.clickData = state.pop("clickData")
+
+        for k in _slotsOf(type(self)):
+            if k in state:
+                setattr(self, k, state[k])
+        for k in self._transient:
+            setattr(self, k, None)
 
     def __repr__(self):
         return '%s(archivedClicks=%s, clickData=%s)' % (self.__class__.__name__,
@@ -272,56 +1039,77 @@ class Clickable(object):
     def clickinfo(self):
         return "%s recent clicks (%s total); last visited %s" % (self.recentClicks, self.totalClicks, tools.prettyday(self.lastClickDay))
 
+    @property
+    def totalClicks(self):
+        return self.archivedClicks + self.recentClicks
+
+    @property
+    def lastClickTime(self):
+        if not self.lastClickDay:
+            return 0
+        return time.mktime(datetime.date.fromordinal(self.lastClickDay).timetuple())
+
     def __getattr__(self, attrname):
-        if attrname == "totalClicks":
-            return self.archivedClicks + sum(self.clickData.values())
-        elif attrname == "recentClicks":
-            return sum(self.clickData.values())
-        elif attrname == "lastClickTime":
-            if not self.clickData:
-                return 0
-            maxk = max(self.clickData.keys())
-            return time.mktime(datetime.date.fromordinal(maxk).timetuple())
-        elif attrname == "lastClickDay":
-            if not self.clickData:
-                return 0
-            return max(self.clickData.keys())
+        # objects pickled before the running counters existed
+        if attrname in ("recentClicks", "lastClickDay"):
+            self._recount()
+            return getattr(self, attrname)
         else:
             raise AttributeError(attrname)
 
-    def clicked(self, n=1):
-        todayord = tools.today()
-        if todayord not in self.clickData:
-            # partition clickdata around 30 days ago
-            archival = []
-            recent = []
-            for od, nclicks in self.clickData.items():
-                if todayord - 30 > od:
-                    archival.append((od, nclicks))
+    @property
+    def clickData(self):
+        """A new {day ordinal: clicks} for the last 30 or so days."""
+        c = self._clicks
+        return dict(zip(c[::2], c[1::2]))
+
+    @clickData.setter
+    def clickData(self, clicks):
+        self._clicks = array.array("i", [x for day in sorted(clicks) for x in (day, clicks[day])]) or ()
+
+    def _recount(self):
+        c = self._clicks
+        self.recentClicks = sum(c[1::2])
+        self.lastClickDay = max(c[::2] or [0])
+
+    def clicked(self, n=1, todayord=None):
+        todayord = todayord or tools.today()
+        recent = self.recentClicks
+        c = self._clicks
+        if c and c[-2] == todayord:
+            c[-1] += n
+        elif todayord in c[::2]:
+            c[c[::2].index(todayord) * 2 + 1] += n
+        else:
+            days = {todayord: n}
+            for i in range(0, len(c), 2):
+                if todayord - 30 > c[i]:
+                    # archive the days that have fallen out of the 30 day window
+                    self.archivedClicks += c[i + 1]
+                    recent -= c[i + 1]
                 else:
-                    recent.append((od, nclicks))
-
-            # archive older samples
-            if archival:
-                self.archivedClicks += sum(nclicks for od, nclicks in archival)
+                    days[c[i]] = c[i + 1]
+            self.clickData = days
 
-            # recent will have at least one sample if it was ever clicked
-            recent.append((todayord, n))
-            self.clickData = dict(recent)
-        else:
-            self.clickData[todayord] += n
+        self.recentClicks = recent + n
+        self.lastClickDay = max(self.lastClickDay, todayord)
 
     def _export(self):
-        return "%d,%s" % (self.archivedClicks, "".join(str(self.clickData).split()))
+        c = self._clicks
+        return "%d,{%s}" % (self.archivedClicks, ",".join("%d:%d" % x for x in zip(c[::2], c[1::2])))
 
     def _import(self, s):
         archivedClicks, clickdict = s.split(",", 1)
         self.archivedClicks = int(archivedClicks)
-        self.clickData = eval(clickdict)
+        self.clickData = _parseClicks(clickdict)
+        self._recount()
         return self
 
 
 class Link(Clickable):
+    __slots__ = ("linkid", "_url", "title", "edits", "lists", "_template")
+    _transient = ("_template",)  # derived state, never pickled
+
     def __init__(self, linkid=0, url="", title=""):
         Clickable.__init__(self)
 
@@ -331,6 +1119,7 @@ class Link(Clickable):
 
         self.edits = []    # (edittime, editorname); [-1] is most recent
         self.lists = []    # List() instances
+        self._template = None  # UrlTemplate for _url, parsed on first use
 
     def __repr__(self):
         return '%s(linkid=%s, url=%s, title=%s, edits=%s, lists=%s)' % (self.__class__.__name__,
@@ -344,8 +1133,8 @@ class Link(Clickable):
     def listnames(self):
         return [x.name for x in self.lists]
 
-    def _export(self):
-        a = "+".join(self._url.split())
+    def _export(self, url=None):
+        a = "+".join((url or self._url).split())
         b = "||".join([x.name for x in self.lists]) or "None"
         c = Clickable._export(self)
         d = ",".join(["%d/%s" % x for x in self.edits]) or "None"
@@ -361,30 +1150,36 @@ class Link(Clickable):
         return "%s\t%s\t%s" % (a, b, c)
 
     def _import(self, line):
-        self._url, lists, clickdata, edits, title = line.split(" ", 4)
-        print ">>", line
-        print self._url
-        if self._url in MYGLOBALS.g_db.linksByUrl:
-            self._url = MYGLOBALS.g_db.linksByUrl[self._url].linkid
-            print "XYZ", self._url
+        """Read the fields of an exported line into this link, and return
+        the names of the lists it belongs to.
+        """
+        fields = line.split(" ", 4)
+        if len(fields) == 4:
+            fields.append("")  # no title, and the space before it trimmed
+        self._url, lists, clickdata, edits, title = fields
 
+        listnames = []
         if lists != "None":
             for listname in lists.split("||"):
                 if "{*}" in self._url:
                     if listname[-1] != "/":
                         listname += "/"
-                MYGLOBALS.g_db.getList(listname, create=True).addLink(self)
+                listnames.append(listname)
 
         self.title = title.strip()
 
         Clickable._import(self, clickdata)
 
         if edits != "None":
-            edits = [x.split("/") for x in edits.split(",")]
+            edits = [x.split("/", 1) for x in edits.split(",")]
             self.edits = [(float(x[0]), x[1]) for x in edits]
 
-    def editedBy(self, editor):
-        self.edits.append((time.time(), editor))
+        return listnames
+
+    def editedBy(self, editor, when=None):
+        self.edits.append((when or time.time(), editor))
+        for LL in self.lists:
+            LL._editsChanged(self)
 
     def lastEdit(self):
         if not self.edits:
@@ -405,20 +1200,21 @@ class Link(Clickable):
             else:
                 return self._url
 
-    def url(self, keyword=None, args=None):
-        remainingPath = (keyword or cherrypy.request.path_info).split("/")[2:]
-        d = {"*": "/".join(remainingPath), "0": keyword}
-        d.update(MYGLOBALS.g_db.variables)
-        d.update(tools.getDictFromCookie("variables"))
+    def url(self, keyword=None, args=None, path=None):
+        # the path is this request's unless given
+        remainingPath = (keyword or path or cherrypy.request.path_info).split("/")[2:]
 
-        while True:
-            try:
-                return string.Formatter().vformat(self._url, args or remainingPath, d)
-            except KeyError as e:
-                missingKey = e.args[0]
-                d[missingKey] = "{%s}" % missingKey
-            except IndexError as e:
-                return None
+        # _url can be assigned directly, so check the template still fits
+        tmpl = self._template
+        if tmpl is None or tmpl.url != self._url:
+            tmpl = self._template = UrlTemplate(self._url)
+
+        scopes = [{"*": "/".join(remainingPath), "0": keyword}]
+        if tmpl.names:
+            scopes.append(MYGLOBALS.g_db.variables)
+            scopes.append(tools.getDictFromCookie("variables"))
+
+        return tmpl.expand(args or remainingPath, scopes)
 
     def mainKeyword(self):
         goesStraightThere = [LL for LL in self.lists if LL.goesDirectlyTo(self)]
@@ -441,20 +1237,187 @@ class Link(Clickable):
         return "%.02f" % c
 
 
+class UrlTemplate(object):
+    """A link's url parsed once into literal text and replacement fields,
+    so that it can be expanded in one pass.  Positional fields ({0}, {1})
+    index the args, {*} is the rest of the path and any other name is a
+    variable; names that are not defined are left in place as "{name}",
+    and a missing positional arg makes the whole url None.  This is
+    exactly what string.Formatter().vformat() gave with a retry on every
+    KeyError, which is still used for the rare url that needs more (field
+    attributes or indexes, nested format specs).
+    """
+    def __init__(self, url):
+        self.url = url
+        self.parts = []     # (literal, key or None, conversion, format spec)
+        self.names = set()  # named fields other than {*}
+        self.simple = True
+
+        try:
+            for literal, field, spec, conversion in _formatter.parse(url):
+                if field is None:
+                    self.parts.append((literal, None, None, None))
+                    continue
+
+                key, rest = field._formatter_field_name_split()
+                if list(rest) or "{" in spec or conversion not in (None, "r", "s"):
+                    self.simple = False
+                    break
+
+                self.parts.append((literal, key, conversion, spec))
+                if not isinstance(key, (int, long)) and key != "*":
+                    self.names.add(key)
+        except ValueError:
+            self.simple = False  # let vformat() raise it at expansion time
+
+    def __repr__(self):
+        return '%s(url=%s)' % (self.__class__.__name__, self.url)
+
+    def expand(self, args, scopes):
+        """Expand with positional args and named values looked up in each of
+        scopes, later ones first.  Returns None if args are too few.
+        """
+        if not self.simple:
+            return self._vformat(args, scopes)
+
+        out = []
+        for literal, key, conversion, spec in self.parts:
+            out.append(literal)
+            if key is None:
+                continue
+
+            if isinstance(key, (int, long)):
+                if key >= len(args):
+                    return None
+                obj = args[key]
+            else:
+                for scope in reversed(scopes):
+                    if key in scope:
+                        obj = scope[key]
+                        break
+                else:
+                    obj = "{%s}" % key
+
+            if conversion == "r":
+                obj = repr(obj)
+            elif conversion == "s":
+                obj = str(obj)
+
+            out.append(format(obj, spec))
+
+        return "".join(out)
+
+    def _vformat(self, args, scopes):
+        d = {}
+        for scope in scopes:
+            d.update(scope)
+
+        while True:
+            try:
+                return _formatter.vformat(self.url, args, d)
+            except KeyError as e:
+                missingKey = e.args[0]
+                d[missingKey] = "{%s}" % missingKey
+            except IndexError as e:
+                return None
+
+
+_formatter = string.Formatter()
+
+
+# held while a ListOfLinks changes its links or keeps a new index of them
+_listLock = threading.RLock()
+
+
 class ListOfLinks(Link):
     # for convenience, inherits from Link.  most things that apply
     # to Link applies to a ListOfLinks too
+    __slots__ = ("name", "_members", "_lastOrder", "_sorted", "_keys", "_links", "_popular", "_edited",
+                 "generation")
+
     def __init__(self, linkid=0, name="", redirect="freshest"):
         Link.__init__(self, linkid)
         self.name = name
         self._url = redirect  # list | freshest | top | random
         self.links = []
+        self._popular = None  # PopularityIndex over self.links
+        self._edited = None   # EditIndex over self.links
+        self.generation = 0   # bumped by every change to it or its links, and their clicks
 
     def __repr__(self):
         return '%s(linkid=%s, name=%s, redirect=%s, links=%s)' % (self.__class__.__name__,
                                                                   self.linkid, self.name,
                                                                   self._url, self.links)
 
+    _transient = Link._transient + ("_links", "_popular", "_edited", "generation")
+
+    def __getstate__(self):
+        state = Link.__getstate__(self)
+        del state["_members"], state["_lastOrder"], state["_sorted"], state["_keys"]
+        state["links"] = self.links  # freshest first, as before there was _members
+        return state
+
+    def __setstate__(self, state):
+        Link.__setstate__(self, state)
+        self.links = state.get("links", [])
+        self.generation = 0
+
+    def __contains__(self, link):
+        return link in self._members
+
+    @property
+    def links(self):
+        """The links, freshest first, in a list that is never changed but
+        replaced, the next time it is asked for, once the links change.
+        """
+        links = self._links
+        if links is None:
+            with _listLock:
+                if self._links is None:
+                    self._links = self._sorted[:]
+                links = self._links
+        return links
+
+    @links.setter
+    def links(self, links):
+        with _listLock:
+            self._members = {}  # Link -> order it was added in; higher is fresher
+            self._sorted = []   # the links, freshest first, kept in order as they change
+            self._keys = []     # -order of each of _sorted, to bisect
+            self._lastOrder = 0
+            self._addMembers(reversed(links))
+
+    def order(self, link):
+        """When link was added, relative to the other links; higher is
+        fresher.  None if it is not one of them.
+        """
+        return self._members.get(link)
+
+    def _addMembers(self, links, orders=None):
+        """Add links, each fresher than the last, or in the orders given.
+        Their own lists are left alone.
+        """
+        with _listLock:
+            added = []
+            for link, order in zip(links, orders or itertools.repeat(None)):
+                if link not in self._members:
+                    if order is None:
+                        order = self._lastOrder + 1
+                    self._members[link] = order
+                    self._lastOrder = max(self._lastOrder, order)
+                    added.append((link, order))
+
+            if len(added) == 1:
+                [(link, order)] = added
+                i = bisect.bisect(self._keys, -order)
+                self._keys.insert(i, -order)
+                self._sorted.insert(i, link)
+            elif added:  # sorted once, rather than inserted one at a time
+                self._sorted = sorted(self._members, key=self._members.get, reverse=True)
+                self._keys = [-self._members[L] for L in self._sorted]
+            self._links = None
+            self._popular = self._edited = None  # rebuilt when next wanted
+
     def isGenerative(self):
         return self.name[-1] == "/"
 
@@ -464,43 +1427,113 @@ class ListOfLinks(Link):
 
         return self.name
 
+    # links and link.lists are replaced, never changed in place, so that
+    # readers can go through them while they are edited
+
     def addLink(self, link):
-        if link not in self.links:
-            self.links.insert(0, link)
-            link.lists.append(self)
+        with _listLock:
+            if link not in self._members:
+                popular, edited = self._popular, self._edited
+                self._addMembers([link])
+                link.lists = link.lists + [self]
+                if popular is not None:
+                    popular.add(link)
+                    self._popular = popular
+                if edited is not None:
+                    edited.add(link)
+                    self._edited = edited
 
     def removeLink(self, link):
-        if link in self.links:
-            self.links.remove(link)
-        if self in link.lists:
-            link.lists.remove(self)
+        self.removeLinks([link])
+
+    def removeLinks(self, links):
+        with _listLock:
+            removed = []
+            for link in links:
+                order = self._members.pop(link, None)
+                if order is not None:
+                    removed.append((link, order))
+                    if self._popular is not None:
+                        self._popular.remove(link)
+                    if self._edited is not None:
+                        self._edited.remove(link)
+                if self in link.lists:
+                    link.lists = [x for x in link.lists if x is not self]
+
+            if len(removed) == 1:
+                [(link, order)] = removed
+                i = bisect.bisect_left(self._keys, -order)
+                while self._sorted[i] is not link:  # past others of the same order
+                    i += 1
+                del self._keys[i], self._sorted[i]
+            elif removed:  # filtered once, rather than deleted one at a time
+                self._sorted = [L for L in self._sorted if L in self._members]
+                self._keys = [-self._members[L] for L in self._sorted]
+            if removed:
+                self._links = None
+
+    def _popularityChanged(self, link):
+        """Reposition link after a click; True if the top link changed."""
+        if self._popular is None:
+            return False
+        before = self._popular.top(1)
+        self._popular.update(link)
+        return self._popular.top(1) != before
+
+    def _editsChanged(self, link):
+        with _listLock:
+            if self._edited is not None:
+                self._edited.update(link)
 
     def getRecentLinks(self):
         return self.links
 
-    def getPopularLinks(self):
-        return tools.byClicks(self.links)
-
-    def getLinks(self, nDaysOfRecentEdits=1):
-        earliestRecentEdit = time.time() - nDaysOfRecentEdits * 24 * 3600
-
-        recent = [x for x in self.links if x.lastEdit()[0] > earliestRecentEdit]
-        popular = self.getPopularLinks()
-
-        for L in recent:
-            popular.remove(L)
+    def getPopularLinks(self, n=None):
+        popular = self._popular
+        if popular is None:
+            links = self.links
+            popular = PopularityIndex(links)
+            with _listLock:
+                if self.links is links:  # else changed meanwhile; see LinkDatabase._index
+                    self._popular = popular
+        return popular.top(n)
+
+    def getEditedLinks(self, since=0):
+        """The links last edited after since, most recently edited first."""
+        edited = self._edited
+        if edited is None:
+            # built under the lock, unlike _popular, as edits are not made
+            # under _clickLock; no edit can then be missed by the new index
+            with _listLock:
+                if self._edited is None:
+                    self._edited = EditIndex(self.links)
+                edited = self._edited
+        return edited.since(since)
+
+    def getLinks(self, nDaysOfRecentEdits=1, limit=None):
+        """Return (recent, popular): the links edited in the last
+        nDaysOfRecentEdits days, most recently edited first, and the others,
+        most clicked first.  With a limit, at most that many of each.
+        """
+        edited = self.getEditedLinks(time.time() - nDaysOfRecentEdits * 24 * 3600)
+        skip = set(edited)  # all of them, even those past the limit
+        recent = edited[:limit]
 
+        # the recent links are the only ones to pass over on the way to limit
+        n = None if limit is None else limit + len(skip)
+        popular = [L for L in self.getPopularLinks(n) if L not in skip][:limit]
         return recent, popular
 
     def getDefaultLink(self):
-        if not self._url or self._url == "list":
+        links = self.links  # a list being deleted meanwhile has none left
+        if not self._url or self._url == "list" or not links:
             return None
         elif self._url == "top":
-            return self.getPopularLinks()[0]
+            return (self.getPopularLinks(1) or [None])[0]
         elif self._url == "random":
-            return random.choice(self.links)
+            return random.choice(links)
         elif self._url == "freshest":
-            return self.getRecentLinks()[0]
+            return links[0]
         else:
             return MYGLOBALS.g_db.getLink(self._url)
 
@@ -508,7 +1541,7 @@ class ListOfLinks(Link):
         if not self._url or self._url == "list":
             return None
         elif self._url == "top":
-            return self.getPopularLinks()[0].url(keyword, args)
+            return self.getPopularLinks(1)[0].url(keyword, args)
         elif self._url == "random":
             return random.choice(self.links).url(keyword, args)
         elif self._url == "freshest":
@@ -525,25 +1558,22 @@ class ListOfLinks(Link):
             return result
 
     def _export(self):
-        if tools.is_int(self._url):  # linkid needs to be converted for export
-            L = MYGLOBALS.g_db.getLink(self._url)
-            if L and L in self.links:
-                print L
-                self._url = L._url
-            else:
-                print "fixing unknown dest linkid for", self.name
-                self._url = "list"
+        url = self._url
+        if tools.is_int(url):  # linkids change on import, so export the url
+            L = [x for x in self.links if x.linkid == int(url)]
+            url = L[0]._url if L else "list"
 
-        return ("list %s " % self.name) + Link._export(self)
+        return ("list %s " % self.name) + Link._export(self, url)
 
     def _import(self, line):
         self.name, _, rest = line.split(" ", 2)
         assert _ == "link"
-        MYGLOBALS.g_db._addList(self)
-        Link._import(self, rest)
+        return Link._import(self, rest)
 
 
 class RegexList(ListOfLinks):
+    __slots__ = ("regex",)
+
     def __init__(self, linkid=0, regex=""):
         ListOfLinks.__init__(self, linkid, regex)
 
@@ -559,17 +1589,18 @@ class RegexList(ListOfLinks):
     def isGenerative(self):
         return True
 
-    def matches(self, kw=None):
+    def matches(self, kw=None, m=None):
         if kw is None:
             kw = cherrypy.request.path_info.split("/")[1]
 
         ret = []
 
-        m = re.match(self.regex, kw, re.IGNORECASE)
+        if m is None:
+            m = re.match(self.regex, kw, re.IGNORECASE)
         if m:
             deflink = self.getDefaultLink()
             for L in deflink and [deflink] or self.links:
-                url = L.url(keyword=kw, args=(m.group(0)) + m.groups())
+                url = L.url(keyword=kw, args=(m.group(0),) + m.groups())
                 ret.append((L, Link(0, url, L.title)))
 
         return ret
@@ -583,7 +1614,7 @@ class RegexList(ListOfLinks):
         if not m:
             return None
 
-        return ListOfLinks.url(self, keyword=kw, args=(m.group(0)) + m.groups())
+        return ListOfLinks.url(self, keyword=kw, args=(m.group(0),) + m.groups())
 
     def _export(self):
         return ("regex %s " % self.regex) + ListOfLinks._export(self)
@@ -591,15 +1622,356 @@ class RegexList(ListOfLinks):
     def _import(self, line):
         self.regex, _, rest = line.split(" ", 2)
         assert _ == "list"
-        ListOfLinks._import(self, rest)
+        return ListOfLinks._import(self, rest)
 
 
-class MyGlobals(object):
+_regexMeta = set(".^$*+?{}[]\\|()")
+
+
+def _literalPrefix(regex):
+    """Return the lowercased literal text every match of regex must begin
+    with, or "" if there is none (e.g. the regex starts with a class or
+    contains an alternation).
+    """
+    if "|" in regex:
+        return ""
+    if regex.startswith("^"):
+        regex = regex[1:]
+
+    prefix = []
+    for c in regex:
+        if c in _regexMeta:
+            if c in "*?{" and prefix:
+                prefix.pop()  # quantified, so the previous char is optional
+            break
+        prefix.append(c)
+
+    return "".join(prefix).lower()
+
+
+class RegexIndex(object):
+    """Dispatches a keyword to every RegexList whose regex matches it.
+
+    Regexes are compiled once.  Those that begin with a literal prefix are
+    bucketed by its first character, so a keyword is only run against the
+    regexes that could match it plus the few without a literal prefix.
+    """
+    def __init__(self, regexes=()):
+        self.buckets = {}     # first char of prefix -> [(prefix, pattern, RegexList)]
+        self.unprefixed = []  # [(pattern, RegexList)]
+        for R in regexes:
+            self.add(R)
+
+    def __repr__(self):
+        return '%s(buckets=%s, unprefixed=%s)' % (self.__class__.__name__,
+                                                  len(self.buckets),
+                                                  len(self.unprefixed))
 
-    g_db = LinkDatabase.load()
+    def __len__(self):
+        return sum(len(v) for v in self.buckets.values()) + len(self.unprefixed)
+
+    def add(self, R):
+        try:
+            pattern = re.compile(R.regex, re.IGNORECASE)
+        except re.error:
+            return  # can never match; getRegex() refuses these anyway
+
+        prefix = _literalPrefix(R.regex)
+        if prefix:
+            self.buckets.setdefault(prefix[0], []).append((prefix, pattern, R))
+        else:
+            self.unprefixed.append((pattern, R))
+
+    def match(self, kw):
+        """Return [(RegexList, match object)] for all regexes matching kw."""
+        ret = []
+        kwlower = kw.lower()
+        for prefix, pattern, R in self.buckets.get(kwlower[:1], ()):
+            if kwlower.startswith(prefix):
+                m = pattern.match(kw)
+                if m:
+                    ret.append((R, m))
+
+        for pattern, R in self.unprefixed:
+            m = pattern.match(kw)
+            if m:
+                ret.append((R, m))
+
+        return ret
+
+
+class PopularityIndex(object):
+    """Clickables kept in tools.byClicks() order as their clicks change.
+
+    Entries are sorted (-recentClicks, -totalClicks, linkid, obj) tuples;
+    the key each object was filed under is remembered so it can be found
+    again after its click counts have moved on.
+    """
+    def __init__(self, objs=()):
+        self.entries = sorted(self._key(obj) + (obj,) for obj in objs)
+        self.keys = dict((e[-2], e[:-1]) for e in self.entries)  # linkid -> key
+
+    def __repr__(self):
+        return '%s(entries=%s)' % (self.__class__.__name__, len(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        # over a copy, as clicks may reorder the entries meanwhile
+        return (e[-1] for e in self.entries[:])
+
+    @staticmethod
+    def _key(obj):
+        return (-obj.recentClicks, -obj.totalClicks, obj.linkid)
+
+    def add(self, obj):
+        # in at the new place before out of the old, so readers of the
+        # entries never find obj missing
+        key = self._key(obj)
+        bisect.insort(self.entries, key + (obj,))
+        self.remove(obj)
+        self.keys[obj.linkid] = key
+
+    def remove(self, obj):
+        key = self.keys.pop(obj.linkid, None)
+        if key is not None:
+            del self.entries[bisect.bisect_left(self.entries, key)]
+
+    def update(self, obj):
+        if self.keys.get(obj.linkid) != self._key(obj):
+            self.add(obj)
+
+    def top(self, n=None):
+        return [e[-1] for e in self.entries[:n]]
+
+
+class EditIndex(PopularityIndex):
+    """Links kept most recently edited first, as they are edited."""
+
+    @staticmethod
+    def _key(obj):
+        return (-obj.lastEdit()[0], obj.linkid)
+
+    def since(self, when):
+        """The links last edited after when."""
+        # (-when,) sorts ahead of every entry edited at when exactly
+        return self.top(bisect.bisect_left(self.entries, (-when,)))
+
+
+class ChoiceIndex(object):
+    """A set of objects in an array, so that one can be picked at random
+    in one lookup.  Each object's place in the array is remembered, and an
+    object removed has its place taken by the last one.
+    """
+    def __init__(self, objs=()):
+        self.items = list(objs)
+        self.places = dict((obj, i) for i, obj in enumerate(self.items))
+
+    def __repr__(self):
+        return '%s(items=%s)' % (self.__class__.__name__, len(self.items))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, obj):
+        return obj in self.places
+
+    def __iter__(self):
+        return iter(self.items[:])
+
+    def add(self, obj):
+        if obj not in self.places:
+            self.places[obj] = len(self.items)
+            self.items.append(obj)
+
+    def remove(self, obj):
+        i = self.places.pop(obj, None)
+        if i is not None:
+            last = self.items.pop()
+            if last is not obj:
+                self.items[i] = last
+                self.places[last] = i
+
+    def choice(self):
+        """An object at random, or None if there are none."""
+        while True:
+            items = self.items
+            if not items:
+                return None
+            try:
+                return items[int(random.random() * len(items))]
+            except IndexError:  # removed from meanwhile
+                pass
+
+
+def _trigrams(s):
+    s = "^%s$" % s
+    return set(s[i:i + 3] for i in range(len(s) - 2))
+
+
+class KeywordIndex(object):
+    """List names, sorted for completing a prefix, and filed by trigram
+    for finding those a few edits away from a keyword.
+
+    d edits spoil at most 3d of a name's trigrams, so a name within d
+    edits of a keyword shares one of any 3d + 1 of the keyword's trigrams.
+    Only the names filed under its rarest 3d + 1 are considered, and of
+    those only the maxMeasured sharing the most trigrams are measured.
+    """
+    maxMeasured = 30
+
+    def __init__(self, names=()):
+        self.names = sorted(names)
+        self.trigrams = {}  # trigram -> set of names
+        for name in self.names:
+            for t in _trigrams(name):
+                self.trigrams.setdefault(t, set()).add(name)
+
+    def __repr__(self):
+        return '%s(names=%s, trigrams=%s)' % (self.__class__.__name__, len(self.names), len(self.trigrams))
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name):
+        i = bisect.bisect_left(self.names, name)
+        if self.names[i:i + 1] != [name]:
+            self.names.insert(i, name)
+            for t in _trigrams(name):
+                self.trigrams.setdefault(t, set()).add(name)
+
+    def remove(self, name):
+        i = bisect.bisect_left(self.names, name)
+        if self.names[i:i + 1] == [name]:
+            del self.names[i]
+            for t in _trigrams(name):
+                names = self.trigrams.get(t)
+                if names is not None:
+                    names.discard(name)
+                    if not names:
+                        del self.trigrams[t]
+
+    def complete(self, prefix, n=10):
+        """Up to n names that begin with prefix, in order."""
+        i = bisect.bisect_left(self.names, prefix)
+        return [x for x in self.names[i:i + n] if x.startswith(prefix)]
+
+    def similar(self, kw, maxDistance=2, n=10):
+        """Up to n other names at most maxDistance edits from kw, closest
+        first, as [(distance, name)].  Names too short to share a trigram
+        with kw may be missed.
+        """
+        grams = _trigrams(kw)
+        filed = sorted((self.trigrams.get(t, ()) for t in grams), key=len)
+        candidates = set().union(*filed[:3 * maxDistance + 1])  # in one go, as writers change them
+
+        least = len(grams) - 3 * maxDistance
+        ranked = []
+        for name in candidates:
+            if abs(len(name) - len(kw)) <= maxDistance and name != kw:
+                shared = sum(1 for names in filed if name in names)
+                if shared >= least:
+                    ranked.append((-shared, name))
+        ranked.sort()
+
+        found = []
+        for _, name in ranked[:self.maxMeasured]:
+            d = tools.editDistance(kw, name, maxDistance)
+            if d <= maxDistance:
+                found.append((d, name))
+        return sorted(found)[:n]
+
+
+class ClickFlusher(cherrypy.process.plugins.SimplePlugin):
+    """Saves the clicks a LinkDatabase has counted every interval seconds,
+    or sooner once cfg_clickFlushSize of them are waiting, and the snapshots
+    LinkDatabase.save() asks for, from a thread of its own so that requests
+    never wait on them.  Flushes once more when the engine stops.
+    """
+    def __init__(self, bus, db=None, interval=cfg_clickFlushInterval):
+        cherrypy.process.plugins.SimplePlugin.__init__(self, bus)
+        self._db = db
+        self.interval = interval
+        self.thread = None
+        self.stopping = False
+
+    def start(self):
+        self.stopping = False
+        if self._db is not None or MYGLOBALS.dbReady.is_set():
+            self.db._saver = self  # or run() will, once it is loaded
+        self.thread = threading.Thread(target=self.run, name="ClickFlusher")
+        self.thread.daemon = True
+        self.thread.start()
+    start.priority = 80
+
+    def stop(self):
+        if self.thread:
+            self.stopping = True
+            self.db._clicksFull.set()
+            self.thread.join()
+            self.thread = None
+        self.flush()
+        self.db._saver = None
+
+    @property
+    def db(self):
+        # without one of its own, follow MYGLOBALS.g_db, which may be reloaded
+        return self._db or MYGLOBALS.g_db
+
+    def run(self):
+        self.db._saver = self
+        while not self.stopping:
+            self.db._clicksFull.wait(self.interval)
+            self.flush()
+
+    def flush(self):
+        try:
+            self.db.flushClicks()
+        except Exception:
+            self.bus.log("Error saving clicks", level=40, traceback=True)
+
+
+class MyGlobals(object):
+    """Settings, and the link database, g_db.  g_db is loaded from
+    cfg_fnDatabase when it is first used rather than when core is
+    imported; loadDatabase() loads it sooner, in the background if asked.
+    """
 
     def __init__(self):
         self.db_hnd = None
+        self._db = None
+        self._dbLock = threading.Lock()
+        self._load = LinkDatabase.load
+        self.dbReady = threading.Event()  # set once g_db is loaded
+
+    @property
+    def g_db(self):
+        if self._db is None:
+            self.loadDatabase(self._load)
+        return self._db
+
+    @g_db.setter
+    def g_db(self, db):
+        self._db = db
+        self.dbReady.set()
+
+    def loadDatabase(self, load=LinkDatabase.load, background=False):
+        """Set g_db to load(), unless it is loaded already, and return it.
+        In the background, return the thread loading it instead; until it
+        is done, using g_db waits for it.
+        """
+        self._load = load  # so g_db loads it the same way, if it gets there first
+        if background:
+            thread = threading.Thread(target=self.loadDatabase, args=(load,), name="LoadDatabase")
+            thread.daemon = True
+            thread.start()
+            return thread
+
+        with self._dbLock:
+            if self._db is None:
+                self.g_db = load()
+        return self._db
 
     def __repr__(self):
         return '%s(hnd=%s)' % (self.__class__.__name__, self.db_hnd)
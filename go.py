@@ -6,20 +6,30 @@ long URLs. Few remember how to write in cursive, most people don't remember
 common phone numbers, and just about everyone needs a way around bookmarks.
 """
 
+import email.utils
+import hashlib
+import json
+import math
 import os
 import os.path
 import pwd
 import socket
 import sys
+import time
 import urllib
 import ConfigParser
 import cherrypy
 import jinja2
 import random
+from cherrypy.lib import httputil
 from optparse import OptionParser
 
-from core import ListOfLinks, Link, MYGLOBALS, InvalidKeyword
+from core import ListOfLinks, Link, LinkDatabase, MYGLOBALS, InvalidKeyword, ClickFlusher
+from core import cfg_fnDatabase, cfg_fnJournal, cfg_snapshotInterval
+import metrics
+import static
 import tools
+import workers
 
 __author__ = "Saul Pwanson <saul@pwanson.com>"
 __credits__ = "Bill Booth, Bryce Bockman, treebird"
@@ -38,12 +48,61 @@ MYGLOBALS.cfg_urlSSO = config.get('goconfig', 'cfg_urlSSO')
 MYGLOBALS.cfg_urlEditBase = "https://" + MYGLOBALS.cfg_hostname
 MYGLOBALS.cfg_listenPort = int(config.get('goconfig', 'cfg_listenPort'))
 
+try:
+    MYGLOBALS.cfg_resolutionCacheSize = config.getint('goconfig', 'cfg_resolutionCacheSize')
+except ConfigParser.NoOptionError:
+    MYGLOBALS.cfg_resolutionCacheSize = 10000
+
+try:
+    MYGLOBALS.cfg_templateCacheDir = config.get('goconfig', 'cfg_templateCacheDir')
+except ConfigParser.NoOptionError:
+    MYGLOBALS.cfg_templateCacheDir = None
+
+try:
+    MYGLOBALS.cfg_precompileTemplates = config.getboolean('goconfig', 'cfg_precompileTemplates')
+except ConfigParser.NoOptionError:
+    MYGLOBALS.cfg_precompileTemplates = False
+
+try:
+    MYGLOBALS.cfg_metrics = config.getboolean('goconfig', 'cfg_metrics')
+except ConfigParser.NoOptionError:
+    MYGLOBALS.cfg_metrics = True
+
+try:
+    MYGLOBALS.cfg_backgroundLoad = config.getboolean('goconfig', 'cfg_backgroundLoad')
+except ConfigParser.NoOptionError:
+    MYGLOBALS.cfg_backgroundLoad = False
+
+try:
+    MYGLOBALS.cfg_listLimit = config.getint('goconfig', 'cfg_listLimit')
+except ConfigParser.NoOptionError:
+    MYGLOBALS.cfg_listLimit = None
+
 
-def config_jinja():
+class TimedTemplate(jinja2.Template):
+    """A template whose renders count toward the render phase."""
+
+    def render(self, *args, **kwargs):
+        with metrics.timed("render"):
+            return jinja2.Template.render(self, *args, **kwargs)
+
+
+def config_jinja(cachedir=None, precompiled=False):
     """Construct a jinja environment, provide filters and globals
-    to templates.
+    to templates.  Compiled templates are kept in cachedir, if given, so
+    later processes can skip compiling them.  A precompiled environment
+    never checks its template files for changes.
     """
-    env = jinja2.Environment(loader=jinja2.FileSystemLoader("."))
+    bytecode_cache = None
+    if cachedir:
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(cachedir)
+
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader("."),
+                             bytecode_cache=bytecode_cache,
+                             auto_reload=not precompiled)
+    env.template_class = TimedTemplate
     env.filters['time_t'] = tools.prettytime
     env.filters['int'] = int
     env.filters['escapekeyword'] = tools.escapekeyword
@@ -57,8 +116,18 @@ def config_jinja():
     return env
 
 
+def precompile_templates(env):
+    """Load every template up front, so no request waits on a compile."""
+    names = sorted(x for x in os.listdir(".") if x.endswith(".html"))
+    for name in names:
+        env.get_template(name)
+    return names
+
+
 class Root(object):
-    env = config_jinja()
+    # (path, cookie variables) -> (Location, objects to count a click on)
+    resolutions = tools.LRUCache(MYGLOBALS.cfg_resolutionCacheSize)
+    maxBatch = 1000  # keywords resolved by one _resolve_ request
 
     def redirect(self, url, status=307):
         cherrypy.response.status = status
@@ -70,6 +139,37 @@ class Root(object):
     def notfound(self, msg):
         return env.get_template("notfound.html").render(message=msg)
 
+    def notModified(self, *generations):
+        """Tag this page with the generations it was rendered from, and
+        True, with a 304, if the browser already has it.  A page depends
+        on the database generation, today's date, its url and the cookies
+        it was asked with, as well as the generations given.  With a
+        journal, the database's version stands for all the generations, so
+        that every worker tags the same page alike.
+        """
+        db = MYGLOBALS.g_db
+        req, headers = cherrypy.request, cherrypy.response.headers
+        state = db.version() or (db.generation,) + generations
+        version = (tools.today(), req.base, req.path_info, req.query_string, req.headers.get("Cookie", "")) + state
+        etag = '"%s"' % hashlib.sha1(repr(version)).hexdigest()
+        # a page rendered in the same second as the last change is not as
+        # new as that second, which may see more changes
+        modified = int(math.ceil(db.modified))
+
+        headers["ETag"] = etag
+        headers["Last-Modified"] = httputil.HTTPDate(min(modified, int(time.time())))
+        headers["Cache-control"] = "no-cache"  # always check, and cheaply
+
+        wanted = req.headers.get("If-None-Match")
+        if wanted is not None:
+            fresh = etag in [x.strip() for x in wanted.split(",")]
+        else:
+            since = email.utils.parsedate_tz(req.headers.get("If-Modified-Since", ""))
+            fresh = since is not None and email.utils.mktime_tz(since) >= modified
+        if fresh:
+            cherrypy.response.status = 304
+        return fresh
+
     def redirectIfNotFullHostname(self, scheme=None):
         if scheme is None:
             scheme = cherrypy.request.scheme
@@ -98,7 +198,7 @@ class Root(object):
     @cherrypy.expose
     def robots_txt(self):
         # Specifically for the internal GSA
-        return file("robots.txt").read()
+        return assets.serve("robots.txt", maxAge=3600)
 
     @cherrypy.expose
     def favicon_ico(self):
@@ -107,14 +207,18 @@ class Root(object):
 
     @cherrypy.expose
     def bootstrap_css(self):
-        cherrypy.response.headers["Cache-control"] = "max-age=172800"
-        cherrypy.response.headers["Content-Type"] = "text/css"
-        return file("bootstrap.min.css").read()
+        return assets.serve("bootstrap.min.css")
+
+    @cherrypy.expose
+    def images(self, *path):
+        return imageAssets.serve(os.path.join(*path) if path else "")
 
     @cherrypy.expose
     def lucky(self):
-        luckylink = random.choice(MYGLOBALS.g_db.getNonFolders())
-        luckylink.clicked()
+        luckylink = MYGLOBALS.g_db.getRandomLink()
+        if luckylink is None:
+            raise cherrypy.HTTPRedirect("/")
+        MYGLOBALS.g_db.click(luckylink)
         return self.redirect(tools.deampify(luckylink.url()))
 
     @cherrypy.expose
@@ -126,10 +230,77 @@ class Root(object):
 
         return env.get_template('index.html').render(now=tools.today())
 
+    def lookup(self, keyword):
+        """The list keyword names, if any, and otherwise the regex matches
+        for it, as (list, [(regex, link, generated link)]).
+        """
+        with metrics.timed("list_lookup"):
+            ll = MYGLOBALS.g_db.getList(keyword, create=False)
+
+        matches = []
+        if not ll:
+            with metrics.timed("regex_scan"):
+                for R, m in MYGLOBALS.g_db.matchRegexes(keyword):
+                    matches.extend([(R, L, genL) for L, genL in R.matches(keyword, m)])
+        return ll, matches
+
+    def resolve(self, path):
+        """Where go<path> redirects, as (Location, objects to count a click
+        on, None).  If it shows a page instead (a list, a choice of regex
+        matches or not found) Location is None and the last item is what
+        lookup() found, so the page need not look again, or None if it did
+        not get that far.  Nothing is clicked.
+        """
+        # the destination depends only on the path, the variables and the
+        # database, which bumps its generation whenever it changes
+        cachekey = (path, frozenset(tools.getDictFromCookie("variables").items()))
+        generation = (MYGLOBALS.g_db, MYGLOBALS.g_db.generation)
+        cached = self.resolutions.get(cachekey, generation)
+        if cached:
+            return cached + (None,)
+
+        rest = [x for x in path.split("/") if x]  # as cherrypy splits it for default()
+        if not rest or rest[0][0] == ".":  # forced list page
+            return None, (), None
+
+        keyword = rest[0]
+        if rest[1:]:
+            keyword += "/"
+
+        try:
+            found = ll, matches = self.lookup(keyword)
+        except InvalidKeyword:
+            return None, (), None
+
+        if not ll:
+            if len(matches) != 1:
+                return None, (), found
+
+            R, L, genL = matches[0]  # actual regex, generated link
+            resolved = (tools.deampify(genL.url(path=path)), (R, L))
+            behavior = R._url
+        else:
+            listtarget = ll.getDefaultLink()
+            if not listtarget:
+                return None, (), found
+
+            resolved = (tools.deampify(listtarget.url(path=path)), (ll, listtarget))
+            behavior = ll._url
+
+        if behavior != "random":
+            self.resolutions.put(cachekey, resolved, generation)
+        return resolved + (None,)
+
     @cherrypy.expose
     def default(self, *rest, **kwargs):
         self.redirectIfNotFullHostname()
 
+        location, clicked, found = self.resolve(cherrypy.request.path_info)
+        if location:
+            MYGLOBALS.g_db.click(*clicked)
+            return self.redirect(location)
+
+        # a page, then
         keyword = rest[0]
         rest = rest[1:]
 
@@ -147,47 +318,67 @@ class Root(object):
             #  to go to the keyword/ index
             keyword += "/"
 
-        # try it as a list
-        try:
-            ll = MYGLOBALS.g_db.getList(keyword, create=False)
-        except InvalidKeyword as e:
-            return self.notfound(str(e))
+        # try it as a list, unless resolve() already has
+        if found is None:
+            try:
+                found = self.lookup(keyword)
+            except InvalidKeyword as e:
+                return self.notfound(str(e))
+        ll, matches = found
 
         if not ll:  # nonexistent list
-            # check against all special cases
-            matches = []
-            for R in MYGLOBALS.g_db.regexes.values():
-                matches.extend([(R, L, genL) for L, genL in R.matches(keyword)])
-
             if not matches:
                 kw = tools.sanitary(keyword)
                 if not kw:
                     return self.notfound("No match found for '%s'" % keyword)
 
                 # serve up empty fake list
-                return env.get_template('list.html').render(L=ListOfLinks(linkid=0), keyword=kw)
-            elif len(matches) == 1:
-                R, L, genL = matches[0]  # actual regex, generated link
-                R.clicked()
-                L.clicked()
-                return self.redirect(tools.deampify(genL.url()))
-            else:  # len(matches) > 1
+                return env.get_template('list.html').render(L=ListOfLinks(linkid=0), keyword=kw,
+                                                            suggestions=MYGLOBALS.g_db.suggestKeywords(kw))
+            else:  # more than one, or one asked for as a list
                 LL = ListOfLinks(linkid=-1)  # -1 means non-editable
                 LL.links = [genL for R, L, genL in matches]
                 return env.get_template('list.html').render(L=LL, keyword=keyword)
 
-        listtarget = ll.getDefaultLink()
+        if self.notModified(ll.generation):
+            return ""
+        tmplList = env.get_template('list.html')
+        return tmplList.render(L=ll, keyword=keyword, limit=MYGLOBALS.cfg_listLimit)
 
-        if listtarget and not forceListDisplay:
-            ll.clicked()
-            listtarget.clicked()
-            return self.redirect(tools.deampify(listtarget.url()))
+    @cherrypy.expose
+    def _resolve_(self, q=()):
+        """Where each of a batch of keywords, with or without a path after
+        them, redirects, as JSON: {"urls": {keyword: url or null}}.  Asked
+        for with ?q=kw&q=kw/path, or by POSTing {"keywords": [...]}.  A
+        click is counted on each, all at once.
+        """
+        if cherrypy.request.method == "POST":
+            try:
+                keywords = json.loads(cherrypy.request.body.read())["keywords"]
+            except (ValueError, KeyError, TypeError):
+                raise cherrypy.HTTPError(400, 'expected {"keywords": [...]}')
+        else:
+            keywords = tools.makeList(q)
+        if len(keywords) > self.maxBatch:
+            raise cherrypy.HTTPError(413, "at most %d keywords at once" % self.maxBatch)
 
-        tmplList = env.get_template('list.html')
-        return tmplList.render(L=ll, keyword=keyword)
+        if not all(isinstance(kw, basestring) for kw in keywords):
+            raise cherrypy.HTTPError(400, "keywords must be strings")
+
+        urls = {}
+        clicked = []
+        for kw in keywords:
+            urls[kw], objs, _ = self.resolve("/" + kw.lstrip("/"))
+            clicked.extend(objs)
+        MYGLOBALS.g_db.click(*clicked)
+
+        cherrypy.response.headers["Content-Type"] = "application/json"
+        return json.dumps({"urls": urls})
 
     @cherrypy.expose
     def special(self):
+        if self.notModified(MYGLOBALS.g_db.clickGeneration):
+            return ""
         LL = ListOfLinks(linkid=-1)
         LL.name = "Smart Keywords"
         LL.links = MYGLOBALS.g_db.getSpecialLinks()
@@ -206,7 +397,7 @@ class Root(object):
     def _link_(self, linkid):
         link = MYGLOBALS.g_db.getLink(linkid)
         if link:
-            link.clicked()
+            MYGLOBALS.g_db.click(link)
             return self.redirect(link.url(), status=301)
 
         cherrypy.response.status = 404
@@ -240,7 +431,8 @@ class Root(object):
         K = MYGLOBALS.g_db.getList(keyword, create=False)
 
         if "behavior" in kwargs:
-            K._url = kwargs["behavior"]
+            MYGLOBALS.g_db.setBehavior(K, kwargs["behavior"])
+            MYGLOBALS.g_db.save()
 
         return self.redirectToEditList(keyword)
 
@@ -249,6 +441,7 @@ class Root(object):
         # username = getSSOUsername()
 
         MYGLOBALS.g_db.deleteLink(MYGLOBALS.g_db.getLink(linkid))
+        MYGLOBALS.g_db.save()
 
         return self.redirect("/." + returnto)
 
@@ -274,33 +467,10 @@ class Root(object):
 
         if linkid:
             link = MYGLOBALS.g_db.getLink(linkid)
-            if link._url != url:
-                MYGLOBALS.g_db._changeLinkUrl(link, url)
-            link.title = title
-
-            newlistset = []
-            for listname in lists:
-                if "{*}" in url:
-                    if listname[-1] != "/":
-                        listname += "/"
-                try:
-                    newlistset.append(MYGLOBALS.g_db.getList(listname, create=True))
-                except:
-                    return self.redirectToEditLink(error="invalid keyword '%s'" % listname, **kwargs)
-
-            for LL in newlistset:
-                if LL not in link.lists:
-                    LL.addLink(link)
-
-            for LL in [x for x in link.lists]:
-                if LL not in newlistset:
-                    LL.removeLink(link)
-                    if not LL.links:
-                        MYGLOBALS.g_db.deleteList(LL)
-
-            link.lists = newlistset
-
-            link.editedBy(username)
+            try:
+                MYGLOBALS.g_db.editLink(link, url, title, lists, username)
+            except InvalidKeyword as e:
+                return self.redirectToEditLink(error="invalid keyword: %s" % e, **kwargs)
 
             MYGLOBALS.g_db.save()
 
@@ -340,16 +510,47 @@ class Root(object):
 
     @cherrypy.expose
     def toplinks(self, n="100"):
+        if self.notModified(MYGLOBALS.g_db.clickGeneration):
+            return ""
         return env.get_template("toplinks.html").render(n=int(n))
 
     @cherrypy.expose
     def variables(self):
+        if self.notModified():
+            return ""
         return env.get_template("variables.html").render()
 
     @cherrypy.expose
     def help(self):
         return env.get_template("help.html").render()
 
+    @cherrypy.expose
+    def _complete_(self, q="", n="10"):
+        """Keywords beginning with q, and others a typo or two away, as JSON."""
+        try:
+            n = max(0, min(int(n), 100))
+        except ValueError:
+            raise cherrypy.HTTPError(400, "n must be a number")
+        cherrypy.response.headers["Content-Type"] = "application/json"
+        return json.dumps({"query": q,
+                           "completions": MYGLOBALS.g_db.completeKeyword(q, n) if q else [],
+                           "suggestions": MYGLOBALS.g_db.suggestKeywords(q, n) if q else []})
+
+    @cherrypy.expose
+    def _metrics_(self):
+        cherrypy.response.headers["Content-Type"] = "text/plain; version=0.0.4"
+        return metrics.render()
+
+    @cherrypy.expose
+    def healthz(self):
+        """200 once the database is loaded, and 503 until then."""
+        cherrypy.response.headers["Content-Type"] = "text/plain"
+        cherrypy.response.headers["Cache-control"] = "no-cache"
+        if not MYGLOBALS.dbReady.is_set():
+            cherrypy.response.status = 503
+            return "loading\n"
+        return "ok\n"
+
     @cherrypy.expose
     def _override_vars_(self, **kwargs):
         cherrypy.response.cookie["variables"] = urllib.urlencode(kwargs)
@@ -360,7 +561,7 @@ class Root(object):
     @cherrypy.expose
     def _set_variable_(self, varname="", value=""):
         if varname and value:
-            MYGLOBALS.g_db.variables[varname] = value
+            MYGLOBALS.g_db.setVariable(varname, value)
             MYGLOBALS.g_db.save()
 
         return self.redirect("/variables")
@@ -381,11 +582,9 @@ def main(opts):
     # s.ssl_certificate_chain = 'gd_bundle.crt'
     # s.subscribe()
 
-    # checkpoint the database every 60 seconds
-    # cherrypy.process.plugins.BackgroundTask(60, lambda: MYGLOBALS.g_db.save()).start()
-    file_path = os.getcwd().replace("\\", "/")
-    conf = {'/images': {"tools.staticdir.on": True, "tools.staticdir.dir": file_path + "/images"}}
-    print "Cherrypy conf: %s" % conf
+    images = sorted(os.listdir("images")) if os.path.isdir("images") else []
+    assets.preload(["bootstrap.min.css", "robots.txt"])
+    imageAssets.preload(images)
 
     if opts.runas:
         # Check for requested user, raises KeyError if they don't exist.
@@ -393,10 +592,66 @@ def main(opts):
         # Drop privs to requested user, raises OSError if not privileged.
         cherrypy.process.plugins.DropPrivileges(
             cherrypy.engine, uid=pwent.pw_uid, gid=pwent.pw_gid).subscribe()
-    cherrypy.config.update(conf)  # hack? TODO
+    if MYGLOBALS.cfg_precompileTemplates:
+        print "Precompiled %d templates" % len(precompile_templates(env))
+
+    if opts.workers:
+        if not journaled:
+            sys.exit("--workers needs cfg_fnJournal or a redis:// cfg_fnDatabase in go.cfg")
+        listener = workers.listen('::', MYGLOBALS.cfg_listenPort)
+        workers.serve(opts.workers, lambda i: start(i, listener))
+    else:
+        start()
+
+
+def start(worker=0, listener=None):
+    """Run the server in this process, on its own or as one of the workers
+    accepting on listener.
+    """
+    if listener is not None:
+        MYGLOBALS.loadDatabase(lambda: LinkDatabase.load(shared=True), background=MYGLOBALS.cfg_backgroundLoad)
+        workers.adopt(listener)
+        # re-executing a worker would start a whole new set of workers
+        cherrypy.config.update({'engine.autoreload.on': False})
+    else:
+        MYGLOBALS.loadDatabase(background=MYGLOBALS.cfg_backgroundLoad)
+
+    conf = {'/': {'tools.metrics.on': MYGLOBALS.cfg_metrics}}
+    if listener is not None or shared:
+        # pick up what other processes or nodes changed before each request
+        conf['/']['tools.refresh_db.on'] = True
+
+    # save clicks in the background, and on the way down
+    ClickFlusher(cherrypy.engine).subscribe()
+
+    if journaled and worker == 0:
+        # compact the journal into a fresh snapshot now and then, on one node
+        cherrypy.process.plugins.Monitor(cherrypy.engine, lambda: MYGLOBALS.g_db.snapshotShared(cfg_snapshotInterval),
+                                         frequency=cfg_snapshotInterval).subscribe()
+
     cherrypy.quickstart(Root(), "/", config=conf)
 
-env = config_jinja()
+
+metrics.Sampled("go_resolution_cache_hits_total", "Redirects served from the resolution cache.",
+                "counter", lambda: Root.resolutions.hits)
+metrics.Sampled("go_resolution_cache_misses_total", "Redirects not found in the resolution cache.",
+                "counter", lambda: Root.resolutions.misses)
+metrics.Sampled("go_resolution_cache_entries", "Redirects in the resolution cache.",
+                "gauge", lambda: len(Root.resolutions))
+# none of these wait for the database to load
+metrics.Sampled("go_db_loaded", "1 once the database is loaded.", "gauge", lambda: int(MYGLOBALS.dbReady.is_set()))
+metrics.Sampled("go_links", "Links in the database.", "gauge",
+                lambda: MYGLOBALS.dbReady.is_set() and len(MYGLOBALS.g_db.linksById) or 0)
+metrics.Sampled("go_db_generation", "Changes to what keywords resolve to since the database was loaded.",
+                "gauge", lambda: MYGLOBALS.dbReady.is_set() and MYGLOBALS.g_db.generation or 0)
+
+# a Redis database is shared with other nodes and has its own journal
+shared = cfg_fnDatabase.startswith("redis://")
+journaled = bool(cfg_fnJournal) or shared
+
+env = config_jinja(MYGLOBALS.cfg_templateCacheDir, MYGLOBALS.cfg_precompileTemplates)
+assets = static.Assets(".")  # bootstrap.min.css, robots.txt
+imageAssets = static.Assets("images")  # its own root, so /images/.. reaches nothing else
 
 if __name__ == "__main__":
 
@@ -409,6 +664,8 @@ if __name__ == "__main__":
                       help="Dump the db to stdout.")
     parser.add_option("--runas", dest="runas",
                       help="Run as the provided user.")
+    parser.add_option("--workers", dest="workers", type="int", default=0,
+                      help="Serve from this many worker processes (needs cfg_fnJournal).")
     (opts, args) = parser.parse_args()
     if opts.importfile:
         MYGLOBALS.g_db._import(opts.importfile)
@@ -417,5 +674,4 @@ if __name__ == "__main__":
     elif opts.dump:
         MYGLOBALS.g_db._dump(sys.stdout)
     else:
-        env = config_jinja()
         main(opts)
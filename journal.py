@@ -0,0 +1,113 @@
+"""Append-only journal of edits to the Go Redirector's LinkDatabase"""
+
+import fcntl
+import json
+import os
+
+
+class Journal(object):
+    """A file of JSON records, one per line, each fsynced as it is written.
+
+    Records are written ahead of the change they describe, so an edit is
+    durable by the time the request that made it returns.  Replaying the
+    journal on top of the last snapshot rebuilds the database.
+
+    A shared journal is written by several processes.  acquire() and
+    release() then lock it against the others, and records() picks up
+    where this process last left off.
+    """
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self.f = open(path, "a+")
+        self.pos = 0  # end of the records read or written so far
+        self.head = None  # the first of them
+
+    def __repr__(self):
+        return '%s(path=%s, shared=%s)' % (self.__class__.__name__, self.path, self.shared)
+
+    def acquire(self):
+        if self.shared:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+
+    def release(self):
+        if self.shared:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+
+    def behind(self):
+        """True if the journal changed since this process last used it."""
+        return os.fstat(self.f.fileno()).st_size != self.pos
+
+    poll = behind  # already cheap
+
+    def claim(self, name, seconds):
+        """True: only one process on one host writes snapshots of a journal
+        file, so there is no one to claim name from.
+        """
+        return True
+
+    def append(self, record):
+        # latin-1 maps every byte string to unicode and back unchanged
+        line = json.dumps(record, encoding="latin-1") + "\n"
+        self.f.write(line)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        if self.pos == 0:
+            self.head = line
+        self.pos = self.f.tell()
+
+    def records(self):
+        """Yield the complete records added since this process last read or
+        wrote the journal, oldest first; all of them if it has been emptied
+        since.  A torn record left at the end by a crash in the middle of
+        append() is dropped.
+        """
+        if self._restarted():
+            self.pos = 0
+
+        self.f.seek(self.pos)
+        for line in iter(self.f.readline, ""):
+            if not line.endswith("\n"):
+                self.f.truncate(self.pos)
+                break
+            if self.pos == 0:
+                self.head = line
+            self.pos += len(line)
+            yield _bytes(json.loads(line))
+
+    def _restarted(self):
+        """True if the journal was emptied since this process last used it;
+        it may have grown past where this process left off again since.
+        """
+        if self.pos == 0:
+            return False
+        if os.fstat(self.f.fileno()).st_size < self.pos:
+            return True
+        self.f.seek(0)
+        return self.f.readline() != self.head
+
+    def truncate(self):
+        """Empty the journal, once a snapshot holds everything in it."""
+        self.f.truncate(0)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.pos = 0
+
+    def close(self):
+        self.f.close()
+
+
+def _bytes(obj):
+    """Turn the unicode strings json hands back into the byte strings the
+    rest of the database uses.
+    """
+    if isinstance(obj, unicode):
+        try:
+            return obj.encode("latin-1")
+        except UnicodeEncodeError:
+            return obj
+    elif isinstance(obj, list):
+        return [_bytes(x) for x in obj]
+    elif isinstance(obj, dict):
+        return dict((_bytes(k), _bytes(v)) for k, v in obj.items())
+    return obj
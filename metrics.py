@@ -0,0 +1,180 @@
+"""Request and phase timings for the Go Redirector, in Prometheus text format.
+
+The metrics tool times every request by the Root method that handled it,
+and timed() times the phases inside one (list lookup, regex scan, template
+render) and saves.  Both only take the time and bump a few counters under
+a lock, cheap enough to leave on under full redirect load.  Everything is
+per process: with --workers each worker counts what it served.
+"""
+
+import bisect
+import threading
+import time
+
+import cherrypy
+
+# upper bounds, in seconds, of the latency histogram buckets
+_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_metrics = []  # in the order they are rendered
+
+
+def _labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                             for k, v in pairs)
+
+
+def _number(x):
+    return repr(float(x)) if isinstance(x, float) else str(x)
+
+
+class Histogram(object):
+    """Observations counted by bucket, with their sum, per set of labels."""
+
+    def __init__(self, name, help, labelnames=(), buckets=_buckets):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series = {}  # label values -> [count per bucket, then above the last], sum
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def __repr__(self):
+        return '%s(name=%s, series=%s)' % (self.__class__.__name__, self.name, len(self.series))
+
+    def observe(self, seconds, *labels):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            s = self.series.get(labels)
+            if s is None:
+                s = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            s[0][i] += 1
+            s[1] += seconds
+
+    def count(self, *labels):
+        with self.lock:
+            s = self.series.get(labels)
+            return s and sum(s[0]) or 0
+
+    def render(self):
+        yield "# HELP %s %s" % (self.name, self.help)
+        yield "# TYPE %s histogram" % self.name
+        with self.lock:
+            series = sorted((k, list(counts), total) for k, (counts, total) in self.series.items())
+        for labels, counts, total in series:
+            n = 0
+            for le, c in zip(self.buckets + ("+Inf",), counts):
+                n += c
+                yield "%s_bucket%s %d" % (self.name, _labels(self.labelnames, labels, [("le", le)]), n)
+            yield "%s_sum%s %r" % (self.name, _labels(self.labelnames, labels), total)
+            yield "%s_count%s %d" % (self.name, _labels(self.labelnames, labels), n)
+
+
+class Counter(object):
+    """A count that only goes up, per set of labels."""
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.series = {}  # label values -> count
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def __repr__(self):
+        return '%s(name=%s, series=%s)' % (self.__class__.__name__, self.name, len(self.series))
+
+    def inc(self, n, *labels):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + n
+
+    def render(self):
+        yield "# HELP %s %s" % (self.name, self.help)
+        yield "# TYPE %s counter" % self.name
+        with self.lock:
+            series = sorted(self.series.items())
+        for labels, n in series:
+            yield "%s%s %s" % (self.name, _labels(self.labelnames, labels), _number(n))
+
+
+class Sampled(object):
+    """A counter or gauge kept elsewhere, read by fn when rendered."""
+
+    def __init__(self, name, help, kind, fn):
+        self.name = name
+        self.help = help
+        self.kind = kind  # counter | gauge
+        self.fn = fn
+        _metrics.append(self)
+
+    def __repr__(self):
+        return '%s(name=%s, kind=%s)' % (self.__class__.__name__, self.name, self.kind)
+
+    def render(self):
+        yield "# HELP %s %s" % (self.name, self.help)
+        yield "# TYPE %s %s" % (self.name, self.kind)
+        yield "%s %s" % (self.name, _number(self.fn()))
+
+
+requests = Histogram("go_request_seconds", "Time to handle a request, by the Root method that handled it.",
+                     ("handler",))
+responses = Counter("go_responses_total", "Responses sent, by handler and status.", ("handler", "status"))
+phases = Histogram("go_phase_seconds", "Time spent in one part of a request, or saving, by phase.", ("phase",))
+
+
+class timed(object):
+    """with timed("regex_scan"): ... adds the time the block took to phases."""
+    __slots__ = ("phase", "start")
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc):
+        phases.observe(time.time() - self.start, self.phase)
+
+
+def render():
+    """Every metric, in Prometheus text format."""
+    lines = []
+    for m in _metrics:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+def _startRequest():
+    req = cherrypy.serving.request
+    req.metricsHandler = getattr(getattr(req.handler, "callable", None), "__name__", "none")
+    req.metricsStart = time.time()
+
+
+def _endRequest():
+    req = cherrypy.serving.request
+    start = getattr(req, "metricsStart", None)
+    if start is None:
+        return
+
+    handler = req.metricsHandler
+    requests.observe(time.time() - start, handler)
+    responses.inc(1, handler, str(cherrypy.serving.response.status).split(" ", 1)[0])
+
+
+class MetricsTool(cherrypy.Tool):
+    """Time each request from when its handler is found until it is sent."""
+
+    def __init__(self):
+        # ahead of refresh_db, so catching up on the journal is counted
+        cherrypy.Tool.__init__(self, 'on_start_resource', _startRequest, priority=10)
+
+    def _setup(self):
+        cherrypy.Tool._setup(self)
+        cherrypy.serving.request.hooks.attach('on_end_request', _endRequest)
+
+
+cherrypy.tools.metrics = MetricsTool()
@@ -0,0 +1,120 @@
+"""Static files for the Go Redirector, served from memory.
+
+Each file is read once, with a gzipped copy if that is smaller, and a
+strong ETag for each.  A request whose If-None-Match names the ETag gets
+an empty 304.  Files are checked for a new mtime on every request and read
+again when they have one, so an edited stylesheet shows up without a
+restart.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import StringIO
+import threading
+
+import cherrypy
+
+_compressible = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+
+def _gzip(data):
+    buf = StringIO.StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=9, mtime=0)
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+
+def _acceptsGzip(headers):
+    qvalues = dict((e.value.lower(), e.qvalue) for e in headers.elements("Accept-Encoding"))
+    return qvalues.get("gzip", qvalues.get("*", 0)) > 0  # q=0 refuses it
+
+
+class Asset(object):
+    """One file's contents, as read at mtime, ready to send."""
+
+    def __init__(self, path, contentType=None):
+        self.path = path
+        self.contentType = contentType or mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.mtime = os.stat(path).st_mtime
+        with open(path, "rb") as f:
+            self.body = f.read()
+        self.etag = '"%s"' % hashlib.sha1(self.body).hexdigest()
+
+        self.gzipped = None
+        if self.contentType.startswith(_compressible):
+            gzipped = _gzip(self.body)
+            if len(gzipped) < len(self.body):
+                self.gzipped = gzipped
+                self.gzipEtag = '"%s-gz"' % self.etag.strip('"')
+
+    def __repr__(self):
+        return '%s(path=%s, bytes=%s, gzipped=%s)' % (self.__class__.__name__, self.path, len(self.body),
+                                                      self.gzipped and len(self.gzipped))
+
+
+class Assets(object):
+    """The files under directory, each read when first asked for."""
+
+    def __init__(self, directory, maxAge=172800):
+        self.directory = os.path.abspath(directory)
+        self.maxAge = maxAge
+        self.assets = {}  # path relative to directory -> Asset
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return '%s(directory=%s, assets=%s)' % (self.__class__.__name__, self.directory, len(self.assets))
+
+    def preload(self, names):
+        """Read names now, rather than on the first request for each."""
+        for name in names:
+            self.get(name)
+
+    def get(self, name):
+        """The Asset for name, read again if the file has changed, or None
+        if there is no such file under directory.
+        """
+        path = os.path.normpath(os.path.join(self.directory, name))
+        if not path.startswith(self.directory + os.sep):
+            return None
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+
+        asset = self.assets.get(name)
+        if asset is None or asset.mtime != mtime:
+            try:
+                asset = Asset(path)
+            except (IOError, OSError):
+                return None
+            with self.lock:
+                self.assets[name] = asset
+        return asset
+
+    def serve(self, name, maxAge=None):
+        """Respond to this request with the file name, 404 if there is none."""
+        asset = self.get(name)
+        if asset is None:
+            raise cherrypy.NotFound()
+
+        req, headers = cherrypy.serving.request, cherrypy.serving.response.headers
+        body, etag = asset.body, asset.etag
+        if asset.gzipped is not None:
+            headers["Vary"] = "Accept-Encoding"
+            if _acceptsGzip(req.headers):
+                body, etag = asset.gzipped, asset.gzipEtag
+                headers["Content-Encoding"] = "gzip"
+
+        headers["Content-Type"] = asset.contentType
+        headers["ETag"] = etag
+        headers["Cache-control"] = "max-age=%d" % (self.maxAge if maxAge is None else maxAge)
+
+        wanted = req.headers.get("If-None-Match", "")
+        if wanted.strip() == "*" or etag in [x.strip() for x in wanted.split(",")]:
+            cherrypy.serving.response.status = 304
+            headers.pop("Content-Encoding", None)
+            return ""
+        return body
@@ -0,0 +1,550 @@
+"""SQLite and Redis storage for the Go Redirector's LinkDatabase.
+
+The link graph still lives in memory, where the redirect path and its
+indexes need it.  A store keeps a copy of it elsewhere, and each save
+writes only the links, lists and variables that changed since the last
+one, and the clicks counted since, in a single transaction.
+
+A SqliteStore is a normalized copy in a local file.  A RedisStore is
+shared by several go nodes: edits go through a journal kept in Redis,
+which every node replays, and clicks are added straight to counters in
+Redis and published to the other nodes.
+
+To convert an existing pickle:
+
+    python storage.py godb.pickle godb.sqlite
+    python storage.py godb.pickle redis://localhost:6379/0
+"""
+
+import json
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+import core
+import tools
+from journal import _bytes
+
+_schema = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value);
+CREATE TABLE IF NOT EXISTS links (
+    linkid INTEGER PRIMARY KEY,
+    url TEXT NOT NULL,
+    title TEXT,
+    archived INTEGER NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS links_url ON links (url);
+CREATE TABLE IF NOT EXISTS lists (
+    linkid INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    redirect,
+    regex INTEGER NOT NULL DEFAULT 0,
+    title TEXT,
+    archived INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS memberships (
+    listid INTEGER NOT NULL,
+    linkid INTEGER NOT NULL,
+    pos INTEGER NOT NULL,
+    PRIMARY KEY (listid, linkid));
+CREATE INDEX IF NOT EXISTS memberships_linkid ON memberships (linkid);
+CREATE TABLE IF NOT EXISTS edits (
+    linkid INTEGER NOT NULL,
+    time REAL NOT NULL,
+    editor TEXT);
+CREATE INDEX IF NOT EXISTS edits_linkid ON edits (linkid);
+CREATE TABLE IF NOT EXISTS variables (
+    name TEXT PRIMARY KEY,
+    value);
+CREATE TABLE IF NOT EXISTS clicks (
+    linkid INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    PRIMARY KEY (linkid, day));
+"""
+
+_tables = ("links", "lists", "memberships", "edits", "variables", "clicks")
+
+
+class SqliteStore(object):
+    """Links, lists, memberships, edits, variables and daily clicks, one
+    table each, in the SQLite file at path.
+    """
+    sharedClicks = False  # clicks are added to the counts here by save()
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.text_factory = str  # byte strings in and out, like the pickle
+        self.conn.executescript(_schema)
+
+    def __repr__(self):
+        return '%s(path=%s)' % (self.__class__.__name__, self.path)
+
+    def close(self):
+        self.conn.close()
+
+    def load(self):
+        """Build a LinkDatabase from the store and attach the store to it."""
+        db = core.LinkDatabase()
+        c = self.conn
+        meta = dict(c.execute("SELECT key, value FROM meta"))
+        db._nextlinkid = meta.get("nextlinkid", 1)
+        db._journalSeq = meta.get("journalSeq", 0)
+
+        byId = {}
+        for linkid, url, title, archived in c.execute("SELECT linkid, url, title, archived FROM links"):
+            L = core.Link(linkid, title=title)
+            L._url = url  # stored canonical already
+            L.archivedClicks = archived
+            db.linksById[linkid] = db.linksByUrl[url] = byId[linkid] = L
+
+        for linkid, name, redirect, regex, title, archived in c.execute(
+                "SELECT linkid, name, redirect, regex, title, archived FROM lists"):
+            if regex:
+                LL = db.regexes[name] = core.RegexList(linkid, name)
+            else:
+                LL = core.ListOfLinks(linkid, name)
+            LL._url = redirect
+            LL.title = title
+            LL.archivedClicks = archived
+            db.lists[name] = byId[linkid] = LL
+
+        members = {}  # listid -> links, orders
+        for listid, linkid, pos in c.execute("SELECT listid, linkid, pos FROM memberships ORDER BY listid, pos"):
+            if listid in byId and linkid in byId:
+                links, orders = members.setdefault(listid, ([], []))
+                links.append(byId[linkid])
+                orders.append(-pos)
+                byId[linkid].lists.append(byId[listid])
+        for listid, (links, orders) in members.items():
+            byId[listid]._addMembers(links, orders)
+
+        for linkid, when, editor in c.execute("SELECT linkid, time, editor FROM edits ORDER BY rowid"):
+            if linkid in byId:
+                byId[linkid].edits.append((when, editor))
+
+        clickData = {}
+        for linkid, day, n in c.execute("SELECT linkid, day, n FROM clicks"):
+            if linkid in byId:
+                clickData.setdefault(linkid, {})[day] = n
+        for linkid, obj in byId.items():
+            obj.clickData = clickData.get(linkid, {})
+            obj._recount()
+
+        db.variables = dict(c.execute("SELECT name, value FROM variables"))
+        db._store = self
+        return db
+
+    def save(self, db, objs, varnames, clickDeltas=None):
+        """Write the rows of objs (links and lists) and of the variables
+        named, or delete them if they are no longer in db, and add
+        clickDeltas, {(linkid, day): n}, to the daily click counts.
+        """
+        objs = [x for x in objs if x.linkid > 0]  # generated links are never stored
+        with self.conn:
+            for obj in objs:
+                self._delete(obj)
+            for obj in objs:
+                if _current(db, obj):
+                    self._write(obj)
+
+            written = set(obj.linkid for obj in objs)  # with all their clicks already
+            clicks = [(n, linkid, day) for (linkid, day), n in (clickDeltas or {}).items() if linkid not in written]
+            self.conn.executemany("INSERT OR IGNORE INTO clicks VALUES (?, ?, 0)", [x[1:] for x in clicks])
+            self.conn.executemany("UPDATE clicks SET n = n + ? WHERE linkid = ? AND day = ?", clicks)
+
+            for name in varnames:
+                if name in db.variables:
+                    self.conn.execute("INSERT OR REPLACE INTO variables VALUES (?, ?)", (name, db.variables[name]))
+                else:
+                    self.conn.execute("DELETE FROM variables WHERE name = ?", (name,))
+
+            self.conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                  [("nextlinkid", db._nextlinkid), ("journalSeq", db._journalSeq)])
+
+    def saveAll(self, db):
+        """Replace everything in the store with db."""
+        with self.conn:
+            for table in _tables:
+                self.conn.execute("DELETE FROM %s" % table)
+        self.save(db, db.linksById.values() + db.lists.values(), db.variables.keys())
+
+    def _delete(self, obj):
+        c = self.conn
+        c.execute("DELETE FROM links WHERE linkid = ?", (obj.linkid,))
+        c.execute("DELETE FROM lists WHERE linkid = ?", (obj.linkid,))
+        c.execute("DELETE FROM memberships WHERE listid = ? OR linkid = ?", (obj.linkid, obj.linkid))
+        c.execute("DELETE FROM edits WHERE linkid = ?", (obj.linkid,))
+        c.execute("DELETE FROM clicks WHERE linkid = ?", (obj.linkid,))
+
+    def _write(self, obj):
+        c = self.conn
+        if isinstance(obj, core.ListOfLinks):
+            c.execute("INSERT OR REPLACE INTO lists VALUES (?, ?, ?, ?, ?, ?)",
+                      (obj.linkid, obj.name, obj._url, isinstance(obj, core.RegexList),
+                       obj.title, obj.archivedClicks))
+            # the list's own rows were just deleted, and its members' with it;
+            # pos is ascending from the freshest, and stays put when others change
+            c.executemany("INSERT OR REPLACE INTO memberships VALUES (?, ?, ?)",
+                          [(obj.linkid, L.linkid, -obj.order(L)) for L in obj.links])
+        else:
+            c.execute("INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?)",
+                      (obj.linkid, obj._url, obj.title, obj.archivedClicks))
+            c.executemany("INSERT OR REPLACE INTO memberships VALUES (?, ?, ?)",
+                          [(LL.linkid, obj.linkid, -LL.order(obj)) for LL in obj.lists if obj in LL])
+
+        c.executemany("INSERT INTO edits VALUES (?, ?, ?)",
+                      [(obj.linkid, when, editor) for when, editor in obj.edits])
+        c.executemany("INSERT INTO clicks VALUES (?, ?, ?)",
+                      [(obj.linkid, day, n) for day, n in obj.clickData.items()])
+
+
+def _current(db, obj):
+    """True if obj is still part of db, rather than deleted or replaced."""
+    if isinstance(obj, core.ListOfLinks):
+        return db.lists.get(obj.name) is obj
+    return db.linksById.get(obj.linkid) is obj
+
+
+class RedisStore(object):
+    """Links, lists and variables as JSON in Redis hashes, plus a counter
+    per link and day, shared by every go node pointed at the same Redis.
+
+    Each node keeps the whole database in memory as its read cache.  Edits
+    go through the journal (a RedisJournal) and clicks through addClicks();
+    both are announced on a pub/sub channel, so a node that listen()s only
+    goes to Redis when something changed.
+
+    The redis module is only needed for this store; pass client to use
+    something else that speaks the same commands.
+    """
+    sharedClicks = True  # clicks go straight to Redis, not into saves
+
+    def __init__(self, url=None, client=None, prefix="go:"):
+        if client is None:
+            import redis
+            client = redis.StrictRedis.from_url(url)
+        self.url = url
+        self.r = client
+        self.prefix = prefix
+        self.node = uuid.uuid4().hex  # to ignore our own announcements
+        self.journal = RedisJournal(self)
+        self._clickLock = threading.Lock()
+        self._clicks = []  # [linkid, day, n] announced by other nodes
+        self._heardSeq = 0  # the click counter as of the last of those
+        self.clickSeq = 0   # and as of the clicks this node has counted
+        self._pubsub = None  # while listen()ing
+
+    def __repr__(self):
+        return '%s(url=%s, prefix=%s)' % (self.__class__.__name__, self.url, self.prefix)
+
+    def key(self, name):
+        return self.prefix + name
+
+    def open(self):
+        """Load the database and replay the journal on top of it."""
+        self.journal.acquire()
+        try:
+            db = self.load()
+            db._attachJournal(self.journal)
+        finally:
+            self.journal.release()
+        return db
+
+    def load(self):
+        """Build a LinkDatabase from the store and attach the store to it."""
+        p = self.r.pipeline()
+        for name in ("meta", "links", "lists", "variables", "clicks", "archived"):
+            p.hgetall(self.key(name))
+        meta, links, lists, variables, clicks, archived = p.execute()
+
+        db = core.LinkDatabase()
+        db._nextlinkid = int(meta.get("nextlinkid", 1))
+        db._journalSeq = int(meta.get("journalSeq", 0))
+        self.clickSeq = self._heardSeq = int(meta.get("clickSeq", 0))
+
+        byId = {}
+        for linkid, data in links.items():
+            d = _bytes(json.loads(data))
+            L = core.Link(int(linkid), title=d["title"])
+            L._url = d["url"]
+            L.edits = [tuple(x) for x in d["edits"]]
+            db.linksById[L.linkid] = db.linksByUrl[L._url] = byId[L.linkid] = L
+
+        members = {}
+        for linkid, data in lists.items():
+            d = _bytes(json.loads(data))
+            if d["regex"]:
+                LL = db.regexes[d["name"]] = core.RegexList(int(linkid), d["name"])
+            else:
+                LL = core.ListOfLinks(int(linkid), d["name"])
+            LL._url = d["redirect"]
+            LL.title = d["title"]
+            LL.edits = [tuple(x) for x in d["edits"]]
+            db.lists[LL.name] = byId[LL.linkid] = LL
+            members[LL] = d["links"]
+
+        for LL, linkids in members.items():
+            LL.links = [byId[linkid] for linkid in linkids if linkid in byId]
+            for L in LL.links:
+                L.lists.append(LL)
+
+        for linkid, n in archived.items():
+            if int(linkid) in byId:
+                byId[int(linkid)].archivedClicks = int(n)
+
+        oldest = tools.today() - 30
+        clickData = {}
+        for field, n in clicks.items():
+            linkid, day = [int(x) for x in field.split(":")]
+            if linkid in byId:
+                if day < oldest:
+                    byId[linkid].archivedClicks += int(n)
+                else:
+                    clickData.setdefault(linkid, {})[day] = int(n)
+        for linkid, obj in byId.items():
+            obj.clickData = clickData.get(linkid, {})
+            obj._recount()
+
+        db.variables = variables
+        db._store = self
+        return db
+
+    def save(self, db, objs, varnames, clicks=False):
+        """Write objs (links and lists) and the variables named, or delete
+        them if they are no longer in db.  Clicks are only written if asked,
+        as addClicks() keeps them up to date.
+        """
+        p = self.r.pipeline()
+        for obj in objs:
+            if obj.linkid <= 0:
+                continue  # generated links are never stored
+
+            table = self.key("lists" if isinstance(obj, core.ListOfLinks) else "links")
+            if _current(db, obj):
+                p.hset(table, obj.linkid, json.dumps(self._row(obj), encoding="latin-1"))
+            else:
+                p.hdel(table, obj.linkid)
+
+            if clicks:
+                p.hset(self.key("archived"), obj.linkid, obj.archivedClicks)
+                for day, n in obj.clickData.items():
+                    p.hset(self.key("clicks"), "%d:%d" % (obj.linkid, day), n)
+
+        for name in varnames:
+            if name in db.variables:
+                p.hset(self.key("variables"), name, db.variables[name])
+            else:
+                p.hdel(self.key("variables"), name)
+
+        p.hset(self.key("meta"), "nextlinkid", db._nextlinkid)
+        p.hset(self.key("meta"), "journalSeq", db._journalSeq)
+        p.execute()
+
+    def saveAll(self, db):
+        """Replace everything in the store with db."""
+        self.r.delete(*[self.key(x) for x in ("meta", "links", "lists", "variables", "clicks", "archived",
+                                              "journal")])
+        self.save(db, db.linksById.values() + db.lists.values(), db.variables.keys(), clicks=True)
+
+    def _row(self, obj):
+        row = {"title": obj.title, "edits": obj.edits}
+        if isinstance(obj, core.ListOfLinks):
+            row.update(name=obj.name, redirect=obj._url, regex=isinstance(obj, core.RegexList),
+                       links=[L.linkid for L in obj.links])
+        else:
+            row.update(url=obj._url)
+        return row
+
+    def addClicks(self, deltas):
+        """Add {(linkid, day): n} to the counters and tell the other nodes,
+        numbering the batch with the store's click counter.
+        """
+        clicks = sorted([linkid, day, n] for (linkid, day), n in deltas.items())
+        seq = self.r.hincrby(self.key("meta"), "clickSeq", 1)
+        p = self.r.pipeline()
+        for linkid, day, n in clicks:
+            p.hincrby(self.key("clicks"), "%d:%d" % (linkid, day), n)
+        p.publish(self.key("changes"), "clicks %s %d %s" % (self.node, seq, json.dumps(clicks)))
+        p.execute()
+        with self._clickLock:
+            self.clickSeq = max(self.clickSeq, seq)
+
+    def takeClicks(self):
+        """Return the clicks other nodes announced since the last call."""
+        with self._clickLock:
+            clicks, self._clicks = self._clicks, []
+            self.clickSeq = max(self.clickSeq, self._heardSeq)
+        return clicks
+
+    def listen(self):
+        """Follow the other nodes' announcements in a background thread."""
+        p = self.r.pubsub(ignore_subscribe_messages=True)
+        p.subscribe(self.key("changes"))
+        self._pubsub = p
+        self.journal.listening = True
+        t = threading.Thread(target=self._listen, args=(p,), name="RedisStore")
+        t.daemon = True
+        t.start()
+        return t
+
+    def close(self):
+        """Stop following the other nodes, once this store is replaced."""
+        pubsub, self._pubsub = self._pubsub, None
+        self.journal.listening = False
+        self.journal.close()
+        if pubsub is not None:
+            pubsub.unsubscribe()
+
+    def _listen(self, pubsub):
+        for msg in pubsub.listen():
+            if pubsub is not self._pubsub:
+                return  # closed
+            data = msg["data"]
+            if data == "journal":
+                self.journal.notified.set()
+            elif data.startswith("clicks "):
+                _, node, seq, clicks = data.split(" ", 3)
+                if node != self.node:
+                    with self._clickLock:
+                        self._clicks.extend(json.loads(clicks))
+                        self._heardSeq = max(self._heardSeq, int(seq))
+
+
+class RedisJournal(object):
+    """The journal of a RedisStore: the same records as a shared Journal,
+    in a Redis list, locked against other nodes by a key with a timeout.
+    """
+    shared = True
+    lockTimeout = 30000  # ms before a lock left by a dead node expires
+
+    # release or renew the lock only if this node still holds it, in one step
+    releaseScript = ("if redis.call('get', KEYS[1]) == ARGV[1] then "
+                     "return redis.call('del', KEYS[1]) else return 0 end")
+    renewScript = ("if redis.call('get', KEYS[1]) == ARGV[1] then "
+                   "return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end")
+
+    def __init__(self, store):
+        self.store = store
+        self.r = store.r
+        self.path = store.url
+        self.pos = 0         # records read or written so far
+        self.epoch = None    # bumped by every truncate()
+        self.listening = False
+        self.notified = threading.Event()  # something changed since records()
+        self.notified.set()
+        self._token = None
+        self._renewer = None  # keeps the lock from expiring while it is held
+        self._closed = threading.Event()
+
+    def __repr__(self):
+        return '%s(store=%s)' % (self.__class__.__name__, self.store)
+
+    def acquire(self):
+        token = uuid.uuid4().hex
+        while not self.r.set(self.store.key("lock"), token, nx=True, px=self.lockTimeout):
+            time.sleep(0.005)
+        self._token = token
+
+        if self._renewer is None:
+            self._renewer = threading.Thread(target=self._renew, name="RedisJournal")
+            self._renewer.daemon = True
+            self._renewer.start()
+
+    def release(self):
+        token, self._token = self._token, None
+        self.r.eval(self.releaseScript, 1, self.store.key("lock"), token)
+
+    def _renew(self):
+        """Push the lock's timeout back while this node holds it, however
+        long a snapshot takes; it still expires if the node dies.
+        """
+        while not self._closed.wait(self.lockTimeout / 3000.0):
+            token = self._token
+            if token is not None:
+                self.r.eval(self.renewScript, 1, self.store.key("lock"), token, self.lockTimeout)
+
+    def claim(self, name, seconds):
+        """True if no other node claimed name in the last seconds, which it
+        now cannot until they are up.
+        """
+        return bool(self.r.set(self.store.key(name), self.store.node, nx=True, px=int(seconds * 1000)))
+
+    def poll(self):
+        """Cheap check for behind(): with listen() no round trip at all."""
+        if self.listening:
+            return self.notified.is_set()
+        return self.behind()
+
+    def behind(self):
+        p = self.r.pipeline()
+        p.hget(self.store.key("meta"), "epoch")
+        p.llen(self.store.key("journal"))
+        epoch, n = p.execute()
+        return epoch != self.epoch or n != self.pos
+
+    def append(self, record):
+        p = self.r.pipeline()
+        p.rpush(self.store.key("journal"), json.dumps(record, encoding="latin-1"))
+        p.publish(self.store.key("changes"), "journal")
+        self.pos = p.execute()[0]
+
+    def records(self):
+        """Yield the records added since this node last read or wrote the
+        journal; all of them if it has been truncated since.
+        """
+        self.notified.clear()
+        p = self.r.pipeline()
+        p.hget(self.store.key("meta"), "epoch")
+        p.lrange(self.store.key("journal"), self.pos, -1)
+        epoch, lines = p.execute()
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.pos = 0
+            lines = self.r.lrange(self.store.key("journal"), 0, -1)
+
+        for line in lines:
+            self.pos += 1
+            yield _bytes(json.loads(line))
+
+    def truncate(self):
+        p = self.r.pipeline()
+        p.delete(self.store.key("journal"))
+        p.hincrby(self.store.key("meta"), "epoch", 1)
+        p.publish(self.store.key("changes"), "journal")
+        self.epoch = str(p.execute()[1])
+        self.pos = 0
+
+    def close(self):
+        self._closed.set()
+
+
+def openStore(target):
+    """The store for target: a redis:// url or an SQLite file."""
+    if target.startswith("redis://"):
+        return RedisStore(target)
+    return SqliteStore(target)
+
+
+def migrate(picklefn, target):
+    """Copy the pickled database at picklefn into a new store at target."""
+    db = pickle.load(file(picklefn))
+    store = openStore(target)
+    store.saveAll(db)
+
+    copy = store.load()
+    assert sorted(copy.linksById) == sorted(db.linksById)
+    assert sorted(copy.lists) == sorted(db.lists)
+    print "Migrated %d links, %d lists and %d variables from %s to %s" % (
+        len(copy.linksById), len(copy.lists), len(copy.variables), picklefn, target)
+    return store
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: %s godb.pickle godb.sqlite|redis://host:port/db" % sys.argv[0])
+    migrate(sys.argv[1], sys.argv[2])
@@ -1,16 +1,685 @@
 """unit tests for core.py"""
 
+import pickle
+import random
+import string
 import pytest
 import sys
 import os
+import threading
+import time
+import traceback
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
 
 import go
 import core
+import tools
 
 
 def test_nextlinkid():
     """The link IDs are started at 1."""
     mydb = core.LinkDatabase()
     assert mydb._nextlinkid == 1
+
+
+def test_literal_prefix():
+    """Only text every match must begin with counts as a literal prefix."""
+    assert core._literalPrefix(r"Bug(\d+)") == "bug"
+    assert core._literalPrefix(r"^cr\d+") == "cr"
+    assert core._literalPrefix(r"abc?\d") == "ab"
+    assert core._literalPrefix(r"foo|bar") == ""
+    assert core._literalPrefix(r"[a-z]+\d") == ""
+
+
+def test_match_regexes():
+    """The regex index finds every matching regex and follows adds/deletes."""
+    mydb = core.LinkDatabase()
+    mydb.addRegexList(r"bug(\d+)", "http://bugs/{1}")
+    mydb.addRegexList(r"bu\w+", "http://bu/{0}")
+    mydb.addRegexList(r"\d+", "http://num/{0}")
+
+    found = sorted(R.regex for R, m in mydb.matchRegexes("BUG123"))
+    assert found == [r"bu\w+", r"bug(\d+)"]
+    assert [R.regex for R, m in mydb.matchRegexes("42")] == [r"\d+"]
+    assert mydb.matchRegexes("nomatch") == []
+
+    mydb.deleteLink(mydb.regexes[r"bu\w+"])
+    assert [R.regex for R, m in mydb.matchRegexes("bug123")] == [r"bug(\d+)"]
+
+
+def test_click_counters(monkeypatch):
+    """Click counters are kept up to date and roll old days into the archive."""
+    L = core.Link(1, "http://example.com/")
+    monkeypatch.setattr(core.tools, "today", lambda: 1000)
+    L.clicked()
+    L.clicked(2)
+    assert (L.recentClicks, L.totalClicks, L.lastClickDay) == (3, 3, 1000)
+
+    monkeypatch.setattr(core.tools, "today", lambda: 1040)
+    L.clicked()
+    assert L.clickData == {1040: 1}
+    assert (L.archivedClicks, L.recentClicks, L.totalClicks, L.lastClickDay) == (3, 1, 4, 1040)
+
+
+def test_click_counters_old_pickle():
+    """Links pickled without running counters recompute them on first use."""
+    L = core.Link(1, "http://example.com/")
+    L.archivedClicks = 5
+    L.clickData = {1000: 2, 1010: 3}
+    del L.recentClicks, L.lastClickDay
+    L = pickle.loads(pickle.dumps(L))
+    assert (L.recentClicks, L.totalClicks, L.lastClickDay) == (5, 10, 1010)
+
+
+class _OldLink(object):
+    """A Link as pickled before it had __slots__, attributes in __dict__."""
+
+
+def test_old_pickle_migrates():
+    """Pickles with a __dict__ and clickData as a dict still load."""
+    old = _OldLink()
+    old.__dict__.update(linkid=7, _url="http://example.com/", title="old", edits=[(1.0, "bob")],
+                        lists=[], archivedClicks=2, clickData={1010: 3, 1000: 2})
+    s = pickle.dumps(old).replace("c%s\n_OldLink\n" % _OldLink.__module__, "ccore\nLink\n")
+    L = pickle.loads(s)
+    assert type(L) is core.Link and not hasattr(L, "__dict__")
+    assert L._template is None
+    assert (L.linkid, L.url(), L.title) == (7, "http://example.com/", "old")
+    assert L.clickData == {1000: 2, 1010: 3}
+    assert (L.recentClicks, L.totalClicks, L.lastClickDay) == (5, 7, 1010)
+    L.clicked(1, 1010)
+    assert L.clickData == {1000: 2, 1010: 4}
+    L.clicked(1, 1035)  # 1000 falls out of the window
+    assert (L.clickData, L.archivedClicks, L.recentClicks) == ({1010: 4, 1035: 1}, 4, 5)
+
+
+def test_popularity_index():
+    """Top links and per-list popularity follow clicks, adds and deletes."""
+    mydb = core.LinkDatabase()
+    a = mydb.addLink("shared", "http://a.example.com/", "a")
+    b = mydb.addLink("shared", "http://b.example.com/", "b")
+    c = mydb.addLink("other", "http://c.example.com/", "c")
+    LL = mydb.getList("shared")
+    assert mydb.getTopLinks() == [a, b, c]
+
+    mydb.click(c, c, b)
+    assert mydb.getTopLinks() == [c, b, a]
+    assert mydb.getTopLinks(2) == [c, b]
+    assert LL.getPopularLinks() == [b, a]
+
+    mydb.click(a, a, a)
+    assert LL.getPopularLinks() == [a, b]
+    assert mydb.getTopLinks(1) == [a]
+
+    mydb.deleteLink(a)
+    assert mydb.getTopLinks() == [c, b]
+    assert LL.getPopularLinks() == [b]
+
+    mydb.click(mydb.getList("other"))
+    assert mydb.getAllLists()[0].name == "other"
+
+
+def test_list_membership():
+    """Lists keep their links freshest first through adds, removes and pickling."""
+    mydb = core.LinkDatabase()
+    a, b, c = [mydb.addLink("docs", "http://%s.example.com/" % x, x) for x in "abc"]
+    LL = mydb.getList("docs")
+    assert LL.links == [c, b, a] and a in LL and LL.order(c) > LL.order(b)
+
+    links = LL.links
+    LL.removeLink(b)
+    assert LL.links == [c, a] and links == [c, b, a]  # replaced, not changed
+    assert b not in LL and LL.order(b) is None and b.lists == []
+    LL.addLink(b)
+    LL.addLink(a)  # already there; stays put
+    assert LL.links == [b, c, a] and b.lists == [LL]
+
+    copy = pickle.loads(pickle.dumps(mydb))
+    assert [L.title for L in copy.getList("docs").links] == ["b", "c", "a"]
+
+    # a link loaded with an order between the others goes in its place
+    d = core.Link(99, "http://d.example.com/", "d")
+    LL._addMembers([d], [LL.order(c)])
+    assert LL.links == [b, c, d, a]
+    LL.removeLink(c)
+    assert LL.links == [b, d, a]
+
+
+def test_recent_and_popular_links():
+    """getLinks splits recent edits from the rest, most clicked first, up to a limit."""
+    mydb = core.LinkDatabase()
+    now = time.time()
+    a, b, c, d = [mydb.addLink("docs", "http://%s.example.com/" % x, x, "me", when=now - 10 * 86400)
+                  for x in "abcd"]
+    LL = mydb.getList("docs")
+    mydb.click(a, b, b, c, c, c)
+    assert LL.getLinks() == ([], [c, b, a, d])
+
+    mydb.editLink(b, b._url, "b", ["docs"], "me", when=now - 60)
+    mydb.editLink(d, d._url, "d", ["docs"], "me", when=now - 30)
+    assert LL.getLinks() == ([d, b], [c, a])
+    assert LL.getLinks(limit=1) == ([d], [c])
+    assert LL.getEditedLinks(now - 45) == [d]
+
+    LL.removeLink(d)
+    e = mydb.addLink("docs", "http://e.example.com/", "e", "me")
+    assert LL.getLinks(limit=2) == ([e, b], [c, a])
+
+
+def test_recent_links_past_the_limit():
+    """A recent link cut off by the limit is not shown as a popular one either."""
+    mydb = core.LinkDatabase()
+    now = time.time()
+    a, b, c = [mydb.addLink("docs", "http://%s.example.com/" % x, x, "me", when=now - 10 * 86400)
+               for x in "abc"]
+    LL = mydb.getList("docs")
+    mydb.click(a, b, b, c, c, c)
+
+    mydb.editLink(c, c._url, "c", ["docs"], "me", when=now - 60)
+    mydb.editLink(b, b._url, "b", ["docs"], "me", when=now - 30)
+    assert LL.getLinks(limit=1) == ([b], [a])
+
+
+def test_folder_indexes():
+    """Folders and the other links stay apart through adds, edits and deletes."""
+    mydb = core.LinkDatabase()
+    a = mydb.addLink("plain", "http://a.example.com/", "a")
+    f = mydb.addLink("docs/", "http://docs.example.com/{*}", "f")
+    assert mydb.getFolders() == [f] and mydb.getNonFolders() == [a]
+    assert mydb.getRandomLink() is a
+
+    mydb.editLink(a, "http://a.example.com/{*}", "a", ["more/"], "me")
+    b = mydb.addLink("plain", "http://b.example.com/", "b")
+    assert set(mydb.getFolders()) == set([a, f]) and mydb.getNonFolders() == [b]
+
+    mydb.deleteLink(b)
+    mydb.deleteLink(f)
+    assert mydb.getFolders() == [a] and mydb.getNonFolders() == []
+    assert mydb.getRandomLink() is None
+
+    # the help page's pick finds the one link with a keyword among many
+    b = mydb.addLink("plain", "http://b.example.com/", "b")
+    others = [mydb.addLink("plain", "http://b.example.com/%d" % i, "other") for i in range(100)]
+    mydb.setBehavior(mydb.getList("plain"), str(b.linkid))
+    assert all(mydb.getRandomLink(usable=True, tries=2) is b for i in range(20))
+    mydb.setBehavior(mydb.getList("plain"), "list")
+    assert mydb.getRandomLink(usable=True) is None
+    assert mydb.getRandomLink() in others + [b]
+
+    index = core.ChoiceIndex("abcd")
+    index.remove("b")
+    assert index.items == ["a", "d", "c"] and index.places["d"] == 1
+    assert index.choice() in "acd"
+
+
+def test_list_generations():
+    """A list's generation moves on with its links, their edits and clicks, and no one else's."""
+    mydb = core.LinkDatabase()
+    a = mydb.addLink("docs", "http://a.example.com/", "a")
+    b = mydb.addLink("other", "http://b.example.com/", "b")
+    docs, other = mydb.getList("docs"), mydb.getList("other")
+
+    seen = docs.generation, other.generation, mydb.generation, mydb.clickGeneration
+    mydb.click(a)
+    assert docs.generation > seen[0] and other.generation == seen[1]
+    assert mydb.generation == seen[2] and mydb.clickGeneration > seen[3]
+
+    seen = docs.generation, other.generation, mydb.generation
+    mydb.editLink(b, b._url, "b", ["other", "docs"], "me")
+    assert docs.generation > seen[0] and other.generation > seen[1] and mydb.generation > seen[2]
+
+
+def test_keyword_suggestions():
+    """Completions and near misses follow lists as they are added, renamed and deleted."""
+    mydb = core.LinkDatabase()
+    for kw in ("docs", "doctor", "dogs", "wiki", "calendar"):
+        mydb.addLink(kw, "http://%s.example.com/" % kw, kw)
+    assert mydb.completeKeyword("DO") == ["docs", "doctor", "dogs"]
+    assert mydb.completeKeyword("do", 1) == ["docs"]
+    assert mydb.suggestKeywords("dcos") == []  # two edits, too many for a short keyword
+    assert mydb.suggestKeywords("docz") == ["docs"]
+    assert mydb.suggestKeywords("calender") == ["calendar"]
+
+    mydb.renameList(mydb.getList("wiki"), "wikis")
+    mydb.deleteList(mydb.getList("dogs"))
+    assert mydb.completeKeyword("wi") == ["wikis"] and mydb.completeKeyword("dog") == []
+    assert mydb.suggestKeywords("wikiz") == ["wikis"]
+    assert mydb.suggestKeywords("dogs") == ["docs"]
+
+
+def test_keyword_suggestions_skip_regexes():
+    """A regex list is never offered as a keyword, whenever it was added."""
+    mydb = core.LinkDatabase()
+    mydb.addLink("docs", "http://docs.example.com/", "docs")
+    mydb.addRegexList(r"doc\d+", "http://docs.example.com/{1}")
+    assert mydb.completeKeyword("doc") == ["docs"]
+    mydb.addRegexList(r"docs\w", "http://docs.example.com/{1}")
+    assert mydb.completeKeyword("doc") == ["docs"]
+    assert mydb.suggestKeywords(r"docs\x") == []
+    mydb.deleteList(mydb.regexes[r"doc\d+"])
+    assert mydb.completeKeyword("doc") == ["docs"]
+
+
+def test_lazy_database_load():
+    """The database is loaded when first used, or in the background, once."""
+    loads = []
+    release = threading.Event()
+
+    def load():
+        release.wait(5)
+        loads.append(1)
+        return core.LinkDatabase()
+
+    g = core.MyGlobals()
+    assert not g.dbReady.is_set()
+    thread = g.loadDatabase(load, background=True)
+    assert not g.dbReady.is_set()
+    release.set()
+    mydb = g.g_db  # waits for the thread, rather than loading another
+    thread.join()
+    assert g.dbReady.is_set() and g.g_db is mydb and loads == [1]
+    assert g.loadDatabase(load) is mydb and loads == [1]
+
+
+def test_journal_replay(tmpdir):
+    """Edits recorded to the journal rebuild the same database on replay."""
+    path = str(tmpdir.join("godb.journal"))
+    mydb = core.LinkDatabase()
+    mydb.openJournal(path)
+    a = mydb.addLink("docs wiki", "http://a.example.com/", "a", "alice")
+    b = mydb.addLink("docs", "http://b.example.com/", "b", "bob")
+    mydb.editLink(a, "http://a2.example.com/", "a2", ["wiki", "new"], "carol")
+    mydb.setBehavior(mydb.getList("docs"), "top")
+    mydb.setVariable("project", "go")
+    mydb.deleteLink(b)
+
+    replayed = core.LinkDatabase()
+    replayed.openJournal(path)
+    assert sorted(replayed.lists) == ["new", "wiki"]
+    assert replayed.variables == {"project": "go"}
+    assert replayed.linksById.keys() == [a.linkid]
+    link = replayed.getLink(a.linkid)
+    assert (link._url, link.title, link.edits) == (a._url, a.title, a.edits)
+    assert sorted(link.listnames()) == ["new", "wiki"]
+    assert replayed._nextlinkid == mydb._nextlinkid
+
+
+def test_journal_snapshot(tmpdir, monkeypatch):
+    """A snapshot empties the journal but for a marker; records it already
+    holds are skipped."""
+    dbpath = str(tmpdir.join("godb.pickle"))
+    path = str(tmpdir.join("godb.journal"))
+    monkeypatch.setattr(core, "cfg_fnDatabase", dbpath)
+
+    mydb = core.LinkDatabase.load(dbpath, path)
+    mydb.addLink("docs", "http://a.example.com/", "a")
+    mydb.snapshot()
+    assert [rec["op"] for rec in core.Journal(path).records()] == ["snapshot"]
+    mydb.addLink("docs", "http://b.example.com/", "b")
+    with open(path, "a") as f:
+        f.write('{"seq": 3, "op": "setVari')  # torn by a crash
+
+    loaded = core.LinkDatabase.load(dbpath, path)
+    assert sorted(L._url for L in loaded.getList("docs").links) == ["http://a.example.com/", "http://b.example.com/"]
+    assert loaded.variables == {}
+    assert open(path).read().endswith("}\n")
+
+
+def test_shared_journal(tmpdir, monkeypatch):
+    """Processes sharing a journal pick up each other's edits, and notice
+    when edits they never read were compacted into a snapshot."""
+    dbpath = str(tmpdir.join("godb.pickle"))
+    path = str(tmpdir.join("godb.journal"))
+    monkeypatch.setattr(core, "cfg_fnDatabase", dbpath)
+
+    one = core.LinkDatabase.load(dbpath, path, shared=True)
+    two = core.LinkDatabase.load(dbpath, path, shared=True)
+    a = one.addLink("docs", "http://a.example.com/", "a")
+    assert two.refresh() == 1
+    assert two.getList("docs").links[0]._url == a._url
+
+    b = two.addLink("docs", "http://b.example.com/", "b")  # catches up first
+    assert b.linkid != a.linkid
+    one.snapshot()
+    two.setVariable("project", "go")
+    assert one.refresh() == 1
+    assert one.variables == {"project": "go"}
+    assert one.version() == two.version()  # so either can answer the other's ETags
+
+    one.snapshot()  # then the journal grows past where two had read up to
+    for i in range(5):
+        one.addLink("docs", "http://c.example.com/%d" % i, "c")
+    assert two.refresh() == 6
+    assert len(two.getList("docs").links) == 7
+
+    one.deleteLink(one.getLink(b.linkid))
+    one.snapshot()
+    with pytest.raises(core.JournalGap):
+        two.refresh()
+
+    three = core.LinkDatabase.load(dbpath, path, shared=True)
+    three.click(three.getList("docs"))
+    one.addLink("docs", "http://d.example.com/", "d")
+    one.snapshot()  # with an edit three never read
+    for i in range(5):
+        one.addLink("docs", "http://e.example.com/%d" % i, "e")
+    with pytest.raises(core.JournalGap):
+        three.flushClicks()
+    assert len(three._clickDeltas) == 1  # not lost, for whatever saves them next
+
+
+def test_version_loaded_apart(tmpdir, monkeypatch):
+    """Processes loaded at different times agree on the version once caught
+    up, whatever clicks each has not flushed yet."""
+    dbpath = str(tmpdir.join("godb.pickle"))
+    path = str(tmpdir.join("godb.journal"))
+    monkeypatch.setattr(core, "cfg_fnDatabase", dbpath)
+
+    one = core.LinkDatabase.load(dbpath, path, shared=True)
+    a = one.addLink("docs", "http://a.example.com/", "a")
+    one.click(a)
+    one.flushClicks()
+    one.snapshot()
+    one.click(a)
+
+    two = core.LinkDatabase.load(dbpath, path, shared=True)
+    assert two.version() == one.version()
+    two.click(two.getLink(a.linkid))
+    assert two.version() == one.version()
+
+    assert two.flushClicks() == 1
+    assert one.version() != two.version()
+    assert one.refresh() == 1
+    assert one.version() == two.version()
+
+
+def test_reload_keeps_clicks(tmpdir, monkeypatch):
+    """A worker that falls too far behind is reloaded in the background,
+    and the clicks it had not saved yet are saved from the new database."""
+    dbpath = str(tmpdir.join("godb.pickle"))
+    path = str(tmpdir.join("godb.journal"))
+    monkeypatch.setattr(core, "cfg_fnDatabase", dbpath)
+    monkeypatch.setattr(core, "cfg_fnJournal", path)
+
+    one = core.LinkDatabase.load(dbpath, path, shared=True)
+    a = one.addLink("docs", "http://a.example.com/", "a")
+    two = core.LinkDatabase.load(dbpath, path, shared=True)
+    monkeypatch.setattr(core.MYGLOBALS, "g_db", two)
+    two.click(two.getLink(a.linkid))
+
+    one.addLink("docs", "http://b.example.com/", "b")
+    one.snapshot()  # with an edit two never read
+    for i in range(5):
+        one.addLink("docs", "http://c.example.com/%d" % i, "c")
+
+    go.workers.refresh_db()  # returns at once, still serving two
+    deadline = time.time() + 5
+    while core.MYGLOBALS.g_db is two and time.time() < deadline:
+        time.sleep(0.01)
+    with go.workers._reloading:  # until the clicks are handed over too
+        mydb = core.MYGLOBALS.g_db
+    assert mydb is not two and len(mydb.getList("docs").links) == 7
+    assert mydb.getLink(a.linkid).totalClicks == 1 and two._clickDeltas == {}
+    assert mydb.flushClicks() == 1
+    assert core.LinkDatabase.load(dbpath, path).getLink(a.linkid).totalClicks == 1
+
+
+def test_click_flush(tmpdir):
+    """Buffered clicks are journaled in one record and replayed."""
+    path = str(tmpdir.join("godb.journal"))
+    mydb = core.LinkDatabase()
+    mydb.openJournal(path)
+    a = mydb.addLink("docs", "http://a.example.com/", "a")
+    LL = mydb.getList("docs")
+    mydb.click(LL, a)
+    mydb.click(LL, a)
+    assert mydb.flushClicks() == 2
+    assert mydb.flushClicks() == 0
+
+    replayed = core.LinkDatabase()
+    replayed.openJournal(path)
+    assert replayed.getLink(a.linkid).totalClicks == 2
+    assert replayed.getList("docs").totalClicks == 2
+
+
+def test_click_flush_keeps_generation(tmpdir):
+    """Journaling clicks changes no redirect, so cached ones stay good."""
+    mydb = core.LinkDatabase()
+    mydb.openJournal(str(tmpdir.join("godb.journal")))
+    a = mydb.addLink("docs", "http://a.example.com/", "a")
+    cache = tools.LRUCache(10)
+    generation = mydb.generation
+    assert cache.get("docs", generation) is None
+    cache.put("docs", a._url, generation)
+
+    mydb.click(a)
+    assert mydb.flushClicks() == 1
+    assert mydb.generation == generation
+    assert cache.get("docs", mydb.generation) == a._url
+
+
+def test_click_flusher_flushes_on_stop(tmpdir):
+    """The click flusher saves whatever is pending when the engine stops."""
+    mydb = core.LinkDatabase()
+    mydb.openJournal(str(tmpdir.join("godb.journal")))
+    a = mydb.addLink("docs", "http://a.example.com/", "a")
+    flusher = core.ClickFlusher(core.cherrypy.engine, mydb, interval=3600)
+    flusher.start()
+    mydb.click(a)
+    flusher.stop()
+    assert mydb._clickDeltas == {}
+    assert '"clicks"' in tmpdir.join("godb.journal").read()
+
+
+def test_clicks_never_wait(tmpdir, monkeypatch):
+    """A click goes through while a save to the store or an edit is under way."""
+    mydb = core.LinkDatabase.load(str(tmpdir.join("godb.sqlite")), None)
+    a = mydb.addLink("docs", "http://a.example.com/", "a")
+    mydb.snapshot()
+
+    saving, release = threading.Event(), threading.Event()
+    save = mydb._store.save
+
+    def slowSave(*args, **kwargs):
+        saving.set()
+        release.wait(5)
+        return save(*args, **kwargs)
+    monkeypatch.setattr(mydb._store, "save", slowSave)
+
+    def clickAlone():
+        t = threading.Thread(target=mydb.click, args=(a,))
+        t.start()
+        t.join(1)
+        return not t.is_alive()
+
+    mydb.click(a)
+    snapshot = threading.Thread(target=mydb.snapshot)
+    snapshot.start()
+    assert saving.wait(5)
+    assert clickAlone()  # counted aside until the save is done
+    release.set()
+    snapshot.join()
+
+    with mydb._logged("setVariable", "project", "go"):
+        assert clickAlone()
+        mydb.variables["project"] = "go"
+
+    mydb.snapshot()
+    assert core.LinkDatabase.load(str(tmpdir.join("godb.sqlite")), None).getLink(a.linkid).totalClicks == 3
+
+
+def test_save_in_background(tmpdir, monkeypatch):
+    """With a click flusher running, save() leaves the snapshot to it."""
+    monkeypatch.setattr(core, "cfg_fnDatabase", str(tmpdir.join("godb.pickle")))
+    mydb = core.LinkDatabase()
+    flusher = core.ClickFlusher(core.cherrypy.engine, mydb, interval=3600)
+    flusher.start()
+    try:
+        mydb.addLink("docs", "http://a.example.com/", "a")
+        mydb.save()
+        deadline = time.time() + 5
+        while not tmpdir.join("godb.pickle").check() and time.time() < deadline:
+            time.sleep(0.01)
+        assert pickle.load(open(core.cfg_fnDatabase)).getList("docs")
+    finally:
+        flusher.stop()
+    assert mydb._saver is None
+
+
+def test_concurrent_edits_and_redirects(tmpdir, monkeypatch):
+    """Edits, redirects and snapshots from many threads keep the database
+    consistent, lose no clicks, and save what it was at some instant.
+    """
+    monkeypatch.setattr(core, "cfg_fnDatabase", str(tmpdir.join("godb.pickle")))
+    monkeypatch.setattr(core.MYGLOBALS, "g_db", core.LinkDatabase())
+    mydb = core.MYGLOBALS.g_db
+    anchor = mydb.addLink("anchor", "http://anchor.example.com/", "anchor")
+    mydb.addLink("src/", "http://src.example.com/{*}", "src")
+    mydb.addLink([r"bug(\d+)"], "http://bugs.example.com/{1}", "bugs")
+    mydb.setBehavior(mydb.getList("anchor"), "top")
+    for i in range(20):
+        mydb.addLink("kw%d shared" % (i % 5), "http://example.com/%d" % i, "link %d" % i)
+
+    errors = []
+    clicks = []
+    stop = threading.Event()
+
+    def forever(fn):
+        def run():
+            try:
+                while not stop.is_set():
+                    fn()
+            except Exception:
+                errors.append(traceback.format_exc())
+        return threading.Thread(target=run)
+
+    def edit(rnd=random.Random(0)):
+        L = mydb.addLink(["kw%d" % rnd.randrange(5), "shared"], "http://new.example.com/%f" % rnd.random(), "new")
+        mydb.editLink(L, L.url() + "x", "edited", ["kw%d" % rnd.randrange(5), "anchor"], "editor")
+        mydb.setBehavior(mydb.getList("shared"), rnd.choice(["top", "freshest", "random"]))
+        mydb.deleteLink(L)
+
+    def redirect(rnd=random.Random(1)):
+        LL = mydb.getList(rnd.choice(["anchor", "shared", "kw1", "kw3"]))
+        L = LL.getDefaultLink()
+        L.url()
+        LL.getLinks()
+        assert [R for R, m in mydb.matchRegexes("bug12")]
+        assert mydb.getFolders() and mydb.getTopLinks(5) and mydb.getAllLists()
+        mydb.click(mydb.getList("anchor"), anchor)
+        clicks.append(1)
+
+    checkinterval = sys.getcheckinterval()
+    sys.setcheckinterval(1)  # switch threads as often as possible
+    try:
+        threads = [forever(edit), forever(edit), forever(redirect), forever(redirect), forever(mydb.snapshot)]
+        for t in threads:
+            t.start()
+        time.sleep(2)
+        stop.set()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setcheckinterval(checkinterval)
+
+    assert errors == []
+    assert anchor.totalClicks == len(clicks) > 0
+    for db in (mydb, pickle.load(open(core.cfg_fnDatabase))):
+        for L in db.linksById.values():
+            assert all(L in LL.links for LL in L.lists)
+        for LL in db.lists.values():
+            assert all(LL in L.lists for L in LL.links)
+    assert mydb.getTopLinks() == sorted(mydb.getTopLinks(), key=lambda L: (-L.recentClicks, -L.totalClicks, L.linkid))
+
+
+def test_export_import(tmpdir, monkeypatch):
+    """An export imports back into the same links, lists and clicks."""
+    monkeypatch.setattr(core, "cfg_fnDatabase", str(tmpdir.join("godb.pickle")))
+    mydb = core.LinkDatabase()
+    a = mydb.addLink("docs wiki", "http://a.example.com/", "a title", "alice", when=1500000000.0)
+    b = mydb.addLink("docs", "http://b.example.com/", "b", "bob", when=1500000001.0)
+    mydb.addLink("src/", "http://c.example.com/{*}", "c")
+    mydb.addRegexList(r"bug(\d+)", "http://bugs/{1}")
+    mydb.setBehavior(mydb.getList("docs"), str(a.linkid))
+    mydb.setVariable("project", "go")
+    a.clicked(3, 700000)
+    a.clicked(2, 735000)
+
+    fn = str(tmpdir.join("export.txt"))
+    mydb._export(fn)
+    assert "eval" not in open(fn).read() and mydb.getList("docs")._url == str(a.linkid)
+    copy = core.LinkDatabase()
+    copy._import(fn)
+
+    def summary(db):
+        return (sorted((L._url, L.title, L.edits, sorted(L.listnames()), L.totalClicks)
+                       for L in db.linksById.values()),
+                sorted((LL.name, [L._url for L in LL.links]) for LL in db.lists.values()),
+                sorted(db.regexes), db.variables)
+    assert summary(copy) == summary(mydb)
+    assert copy.getList("docs")._url == str(copy.linksByUrl[a._url].linkid)
+    assert [(R._url, m.group(1)) for R, m in copy.matchRegexes("bug42")] == [("http://bugs/{1}", "42")]
+
+    copy._import(fn)  # nothing new
+    assert len(copy.linksById) == 3
+
+
+def test_special_links(monkeypatch):
+    """The folder index follows edits and never reloads the database."""
+    monkeypatch.setattr(core.LinkDatabase, "load", None)
+    mydb = core.LinkDatabase()
+    a = mydb.addLink("plain", "http://a.example.com/", "a")
+    b = mydb.addLink("folder/", "http://b.example.com/{*}", "b")
+    assert mydb.getSpecialLinks() == [b]
+
+    c = mydb.addLink([r"bug(\d+)"], "http://bugs.example.com/{1}", "c")
+    mydb.editLink(a, a._url, "a", ["plain", "other/"], "editor")
+    assert sorted(L.linkid for L in mydb.getSpecialLinks()) == [a.linkid, b.linkid, c.linkid]
+
+    mydb.deleteLink(b)
+    mydb.editLink(a, a._url, "a", ["plain"], "editor")
+    assert mydb.getSpecialLinks() == [c]
+
+    mydb.renameList(mydb.getList("plain"), "plain/")
+    assert sorted(L.linkid for L in mydb.getSpecialLinks()) == [a.linkid, c.linkid]
+
+
+def _vformat_with_retry(url, args, d):
+    """How Link.url() used to expand a url."""
+    d = dict(d)
+    while True:
+        try:
+            return string.Formatter().vformat(url, args, d)
+        except KeyError as e:
+            d[e.args[0]] = "{%s}" % e.args[0]
+        except IndexError:
+            return None
+
+
+@pytest.mark.parametrize("url", [
+    "http://example.com/",
+    "http://example.com/{0}/{1}",
+    "http://example.com/{*}?q={project}",
+    "http://example.com/{missing}/{0}",
+    "http://example.com/{5}",
+    "http://example.com/{}{{literal}}",
+    "http://example.com/{0!r:>8}/{project:.2}",
+    "http://example.com/{0[1]}/{project[0]}",
+    "http://example.com/{0:{width}}",
+])
+def test_url_template(url):
+    """UrlTemplate expands exactly like string.Formatter with retries."""
+    args = ["ab", "cd"]
+    scopes = [{"*": "ab/cd", "0": "kw"}, {"project": "gogo", "width": "4"}]
+    d = dict(scopes[0], **scopes[1])
+    assert core.UrlTemplate(url).expand(args, scopes) == _vformat_with_retry(url, args, d)
+
+
+def test_link_url_template_follows_url():
+    """Link.url() reparses its template when the url changes."""
+    mydb = core.LinkDatabase()
+    link = mydb.addLink("kw/", "http://example.com/{*}", "t")
+    assert link.url(keyword="kw/a/b") == "http://example.com/b"
+    mydb._changeLinkUrl(link, "http://other.example.com/{0}")
+    assert link.url(keyword="kw/a/b", args=["x"]) == "http://other.example.com/x"
@@ -3,11 +3,13 @@
 To run these: run 'tox' in the root project directory.
 """
 
+import json
 import pytest
 import cherrypy
 from cherrypy.test import helper
 import sys
 import os
+import time
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
 
@@ -21,7 +23,7 @@ class BasicGoTest(helper.CPWebCase):
             """Use a non-standard port, start the server."""
             # cherrypy.config.update({'server.socket_port': 9090})
             cherrypy.config.update({'port': 35900})
-        cherrypy.tree.mount(Root())
+        cherrypy.tree.mount(Root(), config={'/': {'tools.metrics.on': True}})
 
     setup_server = staticmethod(setup_server)
 
@@ -54,3 +56,196 @@ class BasicGoTest(helper.CPWebCase):
         self.assertStatus('200 OK')
         self.assertInBody('<title>Add Link</title>')  # it rendered
         # pytest.set_trace()
+
+    def test_toplinks_page(self):
+        """200 OK on /toplinks, rendered from the popularity index"""
+        self.getPage('/toplinks?n=10')
+        self.assertStatus('200 OK')
+        self.assertInBody('Top 10 Links')
+
+    def test_metrics_page(self):
+        """Requests and their phases show up at /_metrics_."""
+        before = go.metrics.requests.count("help")
+        self.getPage('/help')
+        self.getPage('/nosuchkeyword', headers=[("Host", "localhost")])
+        for _ in range(100):  # counted once the response is sent, which may be after we read it
+            if go.metrics.requests.count("help") > before:
+                break
+            time.sleep(0.01)
+        self.assertEqual(go.metrics.requests.count("help"), before + 1)
+
+        self.getPage('/_metrics_')
+        self.assertStatus('200 OK')
+        self.assertHeader('Content-Type', 'text/plain;version=0.0.4;charset=utf-8')
+        self.assertInBody('go_request_seconds_count{handler="help"} %d' % (before + 1))
+        self.assertInBody('go_responses_total{handler="help",status="200"}')
+        self.assertInBody('go_phase_seconds_bucket{phase="regex_scan",le="+Inf"}')
+        self.assertInBody('go_phase_seconds_count{phase="render"}')
+        self.assertInBody('# TYPE go_resolution_cache_hits_total counter')
+
+    def test_healthz(self):
+        """/healthz is 503 until the database is loaded, and 200 after."""
+        go.MYGLOBALS.g_db
+        self.getPage('/healthz')
+        self.assertStatus('200 OK')
+        self.assertBody('ok\n')
+
+        go.MYGLOBALS.dbReady.clear()
+        try:
+            self.getPage('/healthz')
+            self.assertStatus('503 Service Unavailable')
+        finally:
+            go.MYGLOBALS.dbReady.set()
+
+    def test_miss_scans_once(self):
+        """A keyword that is not found is looked up, and regexes scanned, once."""
+        scans = go.metrics.phases.count("regex_scan")
+        self.getPage('/nosuchkeywordatall', headers=[("Host", "localhost")])
+        self.assertStatus('200 OK')
+        self.assertInBody('nosuchkeywordatall')
+        self.assertEqual(go.metrics.phases.count("regex_scan"), scans + 1)
+
+    def test_static_assets(self):
+        """/bootstrap.css comes from memory, gzipped if wanted, 304 when unchanged."""
+        self.getPage('/bootstrap.css', headers=[("Accept-Encoding", "gzip")])
+        self.assertStatus('200 OK')
+        self.assertHeader('Content-Encoding', 'gzip')
+        self.assertHeader('Vary', 'Accept-Encoding')
+        etag = self.assertHeader('ETag')
+
+        self.getPage('/bootstrap.css', headers=[("Accept-Encoding", "gzip"), ("If-None-Match", etag)])
+        self.assertStatus('304 Not Modified')
+        self.getPage('/bootstrap.css', headers=[("If-None-Match", etag)])
+        self.assertStatus('200 OK')  # the plain copy has an ETag of its own
+        self.assertNoHeader('Content-Encoding')
+        self.assertInBody('Bootstrap')
+
+        self.getPage('/images/nosuch.gif')
+        self.assertStatus('404 Not Found')
+        for path in ('/images/..%2fgo.cfg', '/images/%2e%2e/go.cfg', '/images/..%2Fcore.py', '/images/'):
+            self.getPage(path)
+            self.assertStatus('404 Not Found')
+
+    def test_redirect_cache(self):
+        """Repeat redirects come from the cache until the link is edited."""
+        db = go.MYGLOBALS.g_db
+        link = db.addLink("cachedkw", "http://one.example.com/", "cached")
+        hits = go.Root.resolutions.hits
+        host = [("Host", "localhost")]
+
+        self.getPage('/cachedkw', headers=host)
+        self.assertStatus(307)
+        self.assertHeader('Location', 'http://one.example.com/')
+        self.getPage('/cachedkw', headers=host)
+        self.assertHeader('Location', 'http://one.example.com/')
+        self.assertEqual(go.Root.resolutions.hits, hits + 1)
+        self.assertEqual(link.totalClicks, 2)
+
+        db.editLink(link, "http://two.example.com/", "cached", ["cachedkw"], "tester")
+        self.getPage('/cachedkw', headers=host)
+        self.assertHeader('Location', 'http://two.example.com/')
+        db.deleteLink(link)
+
+    def test_list_page_not_modified(self):
+        """A list page is 304 until the list, its links or their clicks change."""
+        db = go.MYGLOBALS.g_db
+        link = db.addLink("etagkw", "http://etag.example.com/", "etag")
+        host = [("Host", "localhost")]
+
+        self.getPage('/.etagkw', headers=host)
+        self.assertStatus('200 OK')
+        etag = self.assertHeader('ETag')
+        self.assertHeader('Cache-control', 'no-cache')
+        self.getPage('/.etagkw', headers=host + [("If-None-Match", etag)])
+        self.assertStatus('304 Not Modified')
+        self.assertBody('')
+
+        db.click(link)
+        self.getPage('/.etagkw', headers=host + [("If-None-Match", etag)])
+        self.assertStatus('200 OK')
+        etag = self.assertHeader('ETag')
+
+        db.editLink(link, link._url, "retitled", ["etagkw"], "tester")
+        self.getPage('/.etagkw', headers=host + [("If-None-Match", etag)])
+        self.assertStatus('200 OK')
+        self.assertInBody('retitled')
+        db.deleteLink(link)
+
+    def test_list_page_limit(self):
+        """cfg_listLimit caps the links a list page shows."""
+        db = go.MYGLOBALS.g_db
+        links = [db.addLink("limitkw", "http://limit%d.example.com/" % i, "limited %d" % i) for i in range(3)]
+        db.click(links[2], links[2], links[0])
+        saved = go.MYGLOBALS.cfg_listLimit
+        try:
+            go.MYGLOBALS.cfg_listLimit = 1
+            self.getPage('/.limitkw', headers=[("Host", "localhost")])
+            self.assertStatus('200 OK')
+            self.assertInBody('limited 2')
+            self.assertNotInBody('limited 0')
+        finally:
+            go.MYGLOBALS.cfg_listLimit = saved
+            for link in links:
+                db.deleteLink(link)
+
+    def test_if_modified_since(self):
+        """A page is only 304 by date if nothing changed in or after the second it was dated."""
+        db = go.MYGLOBALS.g_db
+        host = [("Host", "localhost")]
+        saved = db.modified
+        try:
+            db.modified = time.time()  # just now, and more may change this second
+            self.getPage('/toplinks', headers=host)
+            since = self.assertHeader('Last-Modified')
+            self.getPage('/toplinks', headers=host + [("If-Modified-Since", since)])
+            self.assertStatus('200 OK')
+
+            db.modified = time.time() - 10.5
+            self.getPage('/toplinks', headers=host)
+            since = self.assertHeader('Last-Modified')
+            self.getPage('/toplinks', headers=host + [("If-Modified-Since", since)])
+            self.assertStatus('304 Not Modified')
+        finally:
+            db.modified = saved
+
+    def test_keyword_suggestions(self):
+        """/_complete_ answers in JSON, and a missing keyword's page suggests near misses."""
+        db = go.MYGLOBALS.g_db
+        link = db.addLink("suggestedkw", "http://suggested.example.com/", "suggested")
+
+        self.getPage('/_complete_?q=suggest')
+        self.assertStatus('200 OK')
+        self.assertHeader('Content-Type', 'application/json')
+        self.assertEqual(json.loads(self.body)["completions"], ["suggestedkw"])
+        self.getPage('/_complete_?q=suggest&n=many')
+        self.assertStatus('400 Bad Request')
+
+        self.getPage('/suggestedkx', headers=[("Host", "localhost")])
+        self.assertInBody('Did you mean')
+        self.assertInBody('go/suggestedkw')
+        db.deleteLink(link)
+
+    def test_batch_resolve(self):
+        """_resolve_ resolves many keywords, with paths, and counts their clicks."""
+        db = go.MYGLOBALS.g_db
+        link = db.addLink("batchkw", "http://batch.example.com/", "batch")
+        folder = db.addLink("batchdir/", "http://batch.example.com/dir/{*}", "batch folder")
+
+        self.getPage('/_resolve_?q=batchkw&q=batchdir/a/b&q=nosuchbatchkw')
+        self.assertStatus('200 OK')
+        self.assertEqual(json.loads(self.body)["urls"], {"batchkw": "http://batch.example.com/",
+                                                         "batchdir/a/b": "http://batch.example.com/dir/a/b",
+                                                         "nosuchbatchkw": None})
+        self.assertEqual((link.totalClicks, folder.totalClicks), (1, 1))
+
+        body = json.dumps({"keywords": ["batchkw", "/batchkw"]})
+        self.getPage('/_resolve_', method="POST", body=body,
+                     headers=[("Content-Type", "application/json"), ("Content-Length", str(len(body)))])
+        self.assertEqual(json.loads(self.body)["urls"]["/batchkw"], "http://batch.example.com/")
+        self.assertEqual(link.totalClicks, 3)
+
+        self.getPage('/_resolve_', method="POST", body="[]",
+                     headers=[("Content-Type", "application/json"), ("Content-Length", "2")])
+        self.assertStatus(400)
+        db.deleteLink(link)
+        db.deleteLink(folder)
@@ -0,0 +1,30 @@
+"""unit tests for static.py"""
+
+import gzip
+import os
+import StringIO
+import sys
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+
+import static
+
+
+def test_asset_reloads_on_mtime(tmpdir):
+    """An asset is read once, and again once its file has a new mtime."""
+    fn = tmpdir.join("site.css")
+    fn.write("body { color: red; }\n" * 100)
+    assets = static.Assets(str(tmpdir))
+
+    a = assets.get("site.css")
+    assert a.contentType == "text/css" and a.etag != a.gzipEtag
+    assert gzip.GzipFile(fileobj=StringIO.StringIO(a.gzipped)).read() == a.body
+    assert assets.get("site.css") is a
+
+    fn.write("body { color: blue; }\n")
+    os.utime(str(fn), (a.mtime + 10, a.mtime + 10))
+    b = assets.get("site.css")
+    assert b is not a and b.body == "body { color: blue; }\n" and b.etag != a.etag
+    assert b.gzipped is None  # no smaller for it
+
+    assert assets.get("../site.css") is None and assets.get("missing.css") is None
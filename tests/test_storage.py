@@ -0,0 +1,264 @@
+"""unit tests for storage.py"""
+
+import pickle
+import pytest
+import Queue
+import sys
+import os
+import time
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+
+import core
+import storage
+import tools
+
+
+def summary(db):
+    """Everything a store has to keep, comparable across databases."""
+    links = sorted((L.linkid, L._url, L.title, L.edits, sorted(L.listnames()), L.archivedClicks, L.clickData)
+                   for L in db.linksById.values())
+    lists = sorted((LL.linkid, LL.name, LL._url, [L.linkid for L in LL.links], LL.clickData)
+                   for LL in db.lists.values())
+    return links, lists, sorted(db.regexes), db.variables, db._nextlinkid
+
+
+def test_migrate(tmpdir):
+    """A pickled database comes out of the store it is migrated to unchanged."""
+    mydb = core.LinkDatabase()
+    a = mydb.addLink("docs wiki", "http://a.example.com/", "a", "alice")
+    mydb.addLink("docs", "http://b.example.com/", "b\xe9", "bob")
+    mydb.addLink("src/", "http://c.example.com/{*}", "c")
+    mydb.addRegexList(r"bug(\d+)", "http://bugs/{1}")
+    mydb.setBehavior(mydb.getList("docs"), str(a.linkid))
+    mydb.setVariable("project", "go")
+    mydb.click(mydb.getList("wiki"), a)
+    a.clicked(3, 700000)
+    a._recount()
+
+    picklefn = str(tmpdir.join("godb.pickle"))
+    pickle.dump(mydb, file(picklefn, "w"))
+    store = storage.migrate(picklefn, str(tmpdir.join("godb.sqlite")))
+    assert summary(store.load()) == summary(mydb)
+
+
+def test_incremental_save(tmpdir):
+    """Each snapshot writes what changed since the last, deletions included."""
+    path = str(tmpdir.join("godb.sqlite"))
+    mydb = core.LinkDatabase.load(path, None)
+    a = mydb.addLink("docs wiki", "http://a.example.com/", "a", "alice")
+    b = mydb.addLink("docs", "http://b.example.com/", "b", "bob")
+    mydb.snapshot()
+    assert mydb._dirty == set()
+
+    mydb.editLink(a, "http://a2.example.com/", "a2", ["wiki", "new"], "carol")
+    mydb.renameList(mydb.getList("wiki"), "wiki2")
+    mydb.deleteLink(b)
+    mydb.click(mydb.getList("new"), a)
+    mydb.setVariable("project", "go")
+    assert a in mydb._dirty and b in mydb._dirty
+    mydb.snapshot()
+
+    assert summary(core.LinkDatabase.load(path, None)) == summary(mydb)
+    assert mydb._store.conn.execute("SELECT linkid FROM links WHERE url = ?", (b._url,)).fetchall() == []
+
+    # clicks are added to the counts, without writing what was clicked
+    c = mydb.addLink("new", "http://c.example.com/", "c", "dave")
+    mydb.snapshot()
+    mydb.click(mydb.getList("new"), a)
+    assert mydb._dirty == set() and len(mydb._dirtyClicks) == 2
+    mydb.snapshot()
+    assert summary(core.LinkDatabase.load(path, None)) == summary(mydb)
+
+    # a link saved on its own keeps its place among the others in its lists,
+    # and its clicks are not counted twice
+    mydb.click(a)
+    mydb._touch(a)
+    mydb.snapshot()
+    loaded = core.LinkDatabase.load(path, None)
+    assert loaded.getList("new").links[0].linkid == c.linkid
+    assert summary(loaded) == summary(mydb)
+
+
+class FakeRedis(object):
+    """Just enough of redis.StrictRedis, in process, for RedisStore."""
+
+    def __init__(self):
+        self.data = {}
+        self.timeouts = {}  # key -> ms it was last set to expire in
+        self.subscribers = []
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(str(field))
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[str(field)] = str(value)
+
+    def hdel(self, key, field):
+        self.data.get(key, {}).pop(str(field), None)
+
+    def hincrby(self, key, field, n):
+        h = self.data.setdefault(key, {})
+        h[str(field)] = str(int(h.get(str(field), 0)) + n)
+        return int(h[str(field)])
+
+    def rpush(self, key, value):
+        self.data.setdefault(key, []).append(value)
+        return len(self.data[key])
+
+    def llen(self, key):
+        return len(self.data.get(key, []))
+
+    def lrange(self, key, start, end):
+        return self.data.get(key, [])[start:]
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, nx=False, px=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        self.timeouts[key] = px
+        return True
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+        return len(keys)
+
+    def pexpire(self, key, ms):
+        self.timeouts[key] = int(ms)
+        return 1
+
+    def eval(self, script, numkeys, *args):
+        """The scripts RedisJournal runs; each checks the lock is its own."""
+        (key,), argv = args[:numkeys], args[numkeys:]
+        if self.data.get(key) != argv[0]:
+            return 0
+        if script == storage.RedisJournal.releaseScript:
+            return self.delete(key)
+        elif script == storage.RedisJournal.renewScript:
+            return self.pexpire(key, argv[1])
+        raise ValueError("unknown script")
+
+    def publish(self, channel, message):
+        for q in self.subscribers:
+            q.put({"type": "message", "channel": channel, "data": message})
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self)
+
+
+class FakePipeline(object):
+    def __init__(self, r):
+        self.r = r
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.r, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+class FakePubSub(object):
+    def __init__(self, r):
+        self.queue = Queue.Queue()
+        r.subscribers.append(self.queue)
+
+    def subscribe(self, channel):
+        pass
+
+    def unsubscribe(self):
+        self.queue.put({"type": "unsubscribe", "channel": None, "data": 0})
+
+    def listen(self):
+        while True:
+            yield self.queue.get()
+
+
+def test_redis_nodes():
+    """Nodes sharing a RedisStore see each other's edits and clicks."""
+    r = FakeRedis()
+    one = storage.RedisStore(client=r).open()
+    storeTwo = storage.RedisStore(client=r)
+    listener = storeTwo.listen()
+    two = storeTwo.open()
+
+    a = one.addLink("docs", "http://a.example.com/", "a", "alice")
+    assert storeTwo.journal.notified.wait(1)
+    assert two.refresh() == 1
+    b = two.addLink("docs", "http://b.example.com/", "b", "bob")
+    assert b.linkid != a.linkid
+
+    one.refresh()
+    one.click(one.getList("docs"), one.getLink(b.linkid))
+    assert one.flushClicks() == 2
+    deadline = time.time() + 1
+    while two.getLink(b.linkid).totalClicks == 0 and time.time() < deadline:
+        two.refresh()
+    assert two.getLink(b.linkid).totalClicks == 1
+    assert two.version() == one.version()
+    assert r.hgetall("go:clicks") == {"%d:%d" % (b.linkid, tools.today()): "1",
+                                      "%d:%d" % (one.getList("docs").linkid, tools.today()): "1"}
+
+    one.setVariable("project", "go")
+    two.snapshot()
+    assert r.llen("go:journal") == 1  # just the marker
+    three = storage.RedisStore(client=r).open()
+    assert summary(three) == summary(two)
+    assert three.getLink(b.linkid).totalClicks == 1
+    assert three.version() == two.version()  # loaded later, and agreeing
+
+    # a snapshot leaves clicks not yet flushed for flushClicks to add
+    three.click(three.getLink(b.linkid))
+    three.snapshot()
+    assert three.flushClicks() == 1
+    assert r.hgetall("go:clicks")["%d:%d" % (b.linkid, tools.today())] == "2"
+
+    # reloading a node hands its clicks on and stops the old listener
+    two.click(two.getLink(b.linkid))
+    storeFour = storage.RedisStore(client=r)
+    storeFour.listen()
+    four = storeFour.open()
+    two.handOver(four)
+    assert four.flushClicks() == 1 and two._clickDeltas == {}
+    assert four.getLink(b.linkid).totalClicks == 3
+    listener.join(1)
+    assert not listener.is_alive()
+
+
+def test_redis_lock():
+    """A node releases and renews only the journal lock it holds, and
+    only one node of several takes the periodic snapshots."""
+    r = FakeRedis()
+    storeOne = storage.RedisStore(client=r)
+    journal = storeOne.journal
+    journal.lockTimeout = 30
+    one = storeOne.open()
+    two = storage.RedisStore(client=r).open()
+
+    journal.acquire()
+    del r.timeouts["go:lock"]
+    deadline = time.time() + 1
+    while "go:lock" not in r.timeouts and time.time() < deadline:
+        time.sleep(0.005)
+    assert r.timeouts["go:lock"] == 30  # renewed while held
+
+    r.set("go:lock", "another node's")  # as if ours had expired
+    journal.release()
+    assert r.get("go:lock") == "another node's"
+    r.delete("go:lock")
+
+    assert one.snapshotShared(3600)
+    assert not two.snapshotShared(3600)
+    storeOne.close()
+    journal._renewer.join(1)
+    assert not journal._renewer.is_alive()
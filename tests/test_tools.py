@@ -0,0 +1,44 @@
+"""unit tests for tools.py"""
+
+import pytest
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+
+import tools
+
+
+def test_lru_cache():
+    """The LRU evicts the least recently used entry and counts hits/misses."""
+    cache = tools.LRUCache(2)
+    assert cache.get("a", 1) is None
+    cache.put("a", 1, 1)
+    cache.put("b", 2, 1)
+    assert cache.get("a", 1) == 1
+    cache.put("c", 3, 1)
+    assert cache.get("b", 1) is None
+    assert (cache.get("a", 1), cache.get("c", 1)) == (1, 3)
+    assert (cache.hits, cache.misses) == (3, 2)
+
+
+def test_lru_cache_generation():
+    """A new generation empties the cache and stale puts are dropped."""
+    cache = tools.LRUCache(10)
+    cache.get("a", 1)
+    cache.put("a", 1, 1)
+    assert cache.get("a", 2) is None
+    cache.put("a", 1, 1)
+    assert cache.get("a", 2) is None
+
+
+@pytest.mark.parametrize("a, b, limit, expected", [
+    ("docs", "docs", 2, 0),
+    ("docs", "dcos", 2, 2),
+    ("wiki", "wikis", 1, 1),
+    ("jira", "", 2, 3),
+    ("kitten", "sitting", 3, 3),
+    ("kitten", "sitting", 2, 3),
+])
+def test_edit_distance(a, b, limit, expected):
+    assert tools.editDistance(a, b, limit) == expected
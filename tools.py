@@ -1,6 +1,7 @@
 """Smaller helper functions and tools for the Go Redirector"""
 
 import cgi
+import collections
 import re
 import string
 import jinja2
@@ -9,9 +10,9 @@ import urllib2
 import cherrypy
 import urlparse
 import time
-import random
 import datetime
 import base64
+import threading
 import ConfigParser
 
 
@@ -61,13 +62,8 @@ def escapeascii(s):
 
 def randomlink(global_obj):
     """Take in the class of globals and select a random link from the database."""
-    try:
-        selection = random.choice([x for x in global_obj.g_db.linksById.values() if not x.isGenerative() and x.usage()])
-    except IndexError:
-        # Nothing there yet, just return None and move on.
-        return None
-    else:
-        return selection
+    # None if nothing has a keyword yet
+    return global_obj.g_db.getRandomLink(usable=True)
 
 
 def today():
@@ -116,6 +112,31 @@ def is_int(s):
         return False
 
 
+def editDistance(a, b, limit):
+    """The Levenshtein distance between a and b, or limit + 1 if it is
+    more than limit.  Only cells within limit of the diagonal are computed.
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    over = limit + 1
+    if len(b) - len(a) > limit:
+        return over
+
+    prev = [j if j <= limit else over for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        lo, hi = max(1, i - limit), min(len(b), i + limit)
+        cur = [over] * (len(b) + 1)
+        if i <= limit:
+            cur[0] = i
+        ca = a[i - 1]
+        for j in range(lo, hi + 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != b[j - 1]), over)
+        if min(cur[lo - 1:hi + 1]) > limit:
+            return over
+        prev = cur
+    return prev[len(b)]
+
+
 def makeList(s):
     if isinstance(s, basestring):
         return [s]
@@ -125,6 +146,51 @@ def makeList(s):
         return list(s)
 
 
+class LRUCache(object):
+    """A bounded mapping that forgets its least recently used entries, and
+    forgets everything whenever the generation it is asked about moves on.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return '%s(size=%s/%s, hits=%s, misses=%s)' % (self.__class__.__name__,
+                                                       len(self.entries), self.maxsize,
+                                                       self.hits, self.misses)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, generation):
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value, generation):
+        with self.lock:
+            if generation != self.generation or self.maxsize <= 0:
+                return  # computed from data that has since changed
+
+            self.entries[key] = value
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
 def getDictFromCookie(cookiename):
     if cookiename not in cherrypy.request.cookie:
         return {}
@@ -0,0 +1,139 @@
+"""Pre-forked worker processes for the Go Redirector.
+
+The parent binds the listening socket and forks the workers, which all
+accept on it.  Each worker loads its own copy of the link database and
+shares the journal with the others: edits are serialized by a lock on
+the journal file, and a worker picks up the others' edits by replaying
+what they appended, which costs one fstat per request when nothing
+changed.
+"""
+
+import errno
+import os
+import signal
+import socket
+import threading
+import traceback
+
+import cherrypy
+from cherrypy import _cpwsgi_server
+from cherrypy.process import servers
+
+import core
+from core import MYGLOBALS, LinkDatabase, JournalGap
+
+
+class PreforkServer(_cpwsgi_server.CPWSGIServer):
+    """CherryPy's HTTP server, accepting on a socket that is already listening."""
+
+    def __init__(self, listener):
+        _cpwsgi_server.CPWSGIServer.__init__(self, cherrypy.server)
+        self.listener = listener
+
+    def __repr__(self):
+        return '%s(listener=%s)' % (self.__class__.__name__, self.listener.getsockname())
+
+    def bind(self, family, type, proto=0):
+        self.socket = self.listener
+
+
+def adopt(listener):
+    """Serve this process's cherrypy app on listener instead of binding."""
+    cherrypy.server.unsubscribe()
+    servers.ServerAdapter(cherrypy.engine, PreforkServer(listener)).subscribe()
+
+
+_reloading = threading.Lock()  # held while a reload is under way
+
+
+def refresh_db():
+    """Bring this worker's database up to date with the shared journal.
+    When it cannot be, load it again in the background, serving from the
+    database as it was until then.
+    """
+    if not MYGLOBALS.dbReady.is_set():
+        return  # still loading, and will be up to date when it is
+    try:
+        MYGLOBALS.g_db.refresh()
+    except JournalGap as e:
+        if _reloading.acquire(False):
+            print "Reloading DB: %s" % e
+            t = threading.Thread(target=reload_db, name="ReloadDatabase")
+            t.daemon = True
+            t.start()
+
+
+def reload_db():
+    """Replace the database with a fresh load, handing over its unsaved clicks."""
+    try:
+        old = MYGLOBALS.g_db
+        MYGLOBALS.g_db = LinkDatabase.load(core.cfg_fnDatabase, core.cfg_fnJournal, shared=True)
+        old.handOver(MYGLOBALS.g_db)
+    except Exception:
+        cherrypy.engine.log("Error reloading the database", level=40, traceback=True)
+    finally:
+        _reloading.release()
+
+
+cherrypy.tools.refresh_db = cherrypy.Tool('on_start_resource', refresh_db)
+
+
+def listen(host, port, backlog=128):
+    """Return a socket listening on host:port, for the workers to share."""
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    s = socket.socket(family, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if family == socket.AF_INET6:
+        try:
+            s.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        except (AttributeError, socket.error):
+            pass
+    s.bind((host, port))
+    s.listen(backlog)
+    return s
+
+
+def serve(nworkers, run):
+    """Fork nworkers processes calling run(i) for i in range(nworkers), and
+    replace any that die until we get SIGTERM or SIGINT, which is passed on.
+    """
+    children = {}  # pid -> worker number
+    stopping = []
+
+    def spawn(i):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                run(i)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            os._exit(code)
+        print "Started worker %d (pid %d)" % (i, pid)
+        children[pid] = i
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for i in range(nworkers):
+        spawn(i)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        i = children.pop(pid)
+        if not stopping:
+            print "Worker %d (pid %d) exited with status %d; restarting" % (i, pid, status)
+            spawn(i)